@@ -18,6 +18,45 @@
 # Manual or automatic selection of threshold
 # User can estimate the cell sizes that he wants to include to the evaluation
 # User can use exlusion criteria to exclude overexposed cells or include cells that are zero, but in case of normal evaluation would be considered as 1.
+# Headless batch mode: all the parameters from a .json or .yaml file and reevaluation of the saved ROI managers without any window 
+#(see batchArguments and FociMF_params_example.json)
+# Parallel batch mode: the images are split between several headless Fiji processes ("workers" in the parameter file),
+#the CSV files of all the images are merged in Results/<folder>_results_MaxFind_merged.csv (also with one worker)
+# Cells are cropped from the channels before clearing the area around them, the whole image is not duplicated for each cell
+# Find Maxima runs once per cell, the found maxima are kept as a list of points and drawn only for the saved image
+# '% Area above threshold GFP' is counted by ImageJ and only from the pixels inside the cell (before: whole bounding box)
+# Only the DAPI and GFP channels are read, optionally only the bounding boxes of the saved ROIs (crop_to_rois)
+# The next image is read by a background thread while the current one is analysed (prefetch, prefetch_memory)
+# The results of the saved ROI managers are cached: images with the same image file, ROI manager and parameters are not analysed again
+# The raw measurements are saved in Results/*_raw_MaxFind_*.csv, FociMF_Reclassify.py applies other exclusion criteria to them 
+#(also a grid of criteria) without a new analysis. Changing only the exclusion criteria uses the cached measurements.
+# Sweep mode: lists of noise tolerances and thresholds (sweep_noise, sweep_threshold) evaluated from the same crops of the cells, 
+#the results of all the combinations are written in one long table Results/<folder>_sweep_MaxFind_merged.csv
+# No window is shown for the analysed cells, they are measured from their ImagePlus/ImageProcessor only (faster, also headless)
+# Cell Area and the ROI of the cell are taken from the picked ROI (cell_area, the former mask of the crop with "legacy", 
+#cell_area_check compares both)
+# Wall time and heap use of every stage per image and per run in Results/<folder>_profile.json (profile)
+# Images of the analysed cells: all, sampled (every n-th and the OE and zero cells), one montage per image or none, optionally zipped 
+#(cell_images...), they are written by a background thread
+# The results of a batch run can be collected into one Parquet dataset (results_store, see FociMF_Store.py)
+# FociMF_Engine.py runs the same analysis of the saved ROI managers without Fiji (CPython with NumPy, SciPy and scikit-image)
+# FociMF_Benchmark.py measures speed, memory and accuracy of the analysis on synthetic images with known foci (also saved as test images)
+# Automatic picking of the cells from the segmentation by area, solidity, circularity, border contact and DAPI intensity (picking), 
+#the picked cells can be checked in the ROI manager before the analysis
+# Two phases (pick_first): the cells of all the images are picked first, then they are analysed by the batch mode in a headless 
+#Fiji process (also parallel) in the background
+# ThresholdEst shares the 8-bit DAPI channel with Cell_Segmentation, takes the background mean from the histogram (no Measure) 
+#and caches it per image in Results/cache
+# Segmentation of the nuclei on the binned DAPI channel for large images, only the borders of the nuclei are thresholded again at 
+#full resolution (segmentation_bin), optionally checked against the full resolution mask (segmentation_check)
+# Tiled mode for whole-slide and mosaic images (tile_size, tile_overlap): the image is read tile by tile, the cells are picked 
+#automatically per tile and measured tile by tile, only one tile is in the heap at a time
+# Multi-position files: every scene or position is analysed as an image of its own <image>_S<n> with its own ROI manager and results,
+#the parallel batch mode distributes the positions of one file between the workers (series)
+# Z-stacks and time-lapse images: maximum intensity projection of the Z planes read plane by plane (z_projection), every time point 
+#is analysed as an image of its own <image>_T<n> with the cells of the first time point tracked from frame to frame (timepoints)
+# The threshold of the nuclei in Cell_Segmentation is never below the Otsu threshold of the blurred DAPI channel (in sparse fields 
+#the threshold of the equalized channel landed in the background noise and the whole image was segmented as nuclei)
 
 #########################################################################################################################################################
 #########################################IMPORT OF ALL THE USED LIBRARIES AND SELECTION OF PARAMETERS ###################################################
@@ -26,18 +65,75 @@
 from ij import IJ
 from ij import ImageStack
 from ij import ImagePlus
+from ij import Prefs
+from ij.process import ByteProcessor
+from ij.process import FloatProcessor
+from ij.process import ImageProcessor
+from ij.process import ImageStatistics
+from ij.process import Blitter
+from ij.measure import Measurements
 from ij.plugin.frame import RoiManager
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
+from loci.common import Region
+from loci.formats import ImageReader
+from loci.formats import ChannelSeparator
+from loci.formats import MetadataTools
+from ome.units import UNITS
+from loci.plugins.util import ImageProcessorReader
+from loci.plugins.util import LociPrefs
 from ij.gui import WaitForUserDialog
+from ij.gui import ShapeRoi
+from ij.gui import Roi
+from ij.plugin import RoiEnlarger
 from ij.plugin.filter import MaximumFinder
+from ij.plugin.filter import GaussianBlur
+from ij.plugin.filter import ThresholdToSelection
+from ij.plugin.filter import RankFilters
+from ij.plugin import ContrastEnhancer
+from ij.process import ImageConverter
+from ij.measure import Calibration
 from ij.gui import GenericDialog  
 from java.awt import Font
-import csv, os, glob
+from java.awt import Rectangle
+from ij.io import RoiDecoder
+from ij.io import RoiEncoder
+from ij.io import FileSaver
+from ij.macro import Interpreter
+from java.io import ByteArrayOutputStream
+from java.io import BufferedOutputStream
+from java.io import DataOutputStream
+from java.io import FileOutputStream
+from java.util.zip import ZipFile
+from java.util.zip import ZipEntry
+from java.util.zip import ZipOutputStream
+from jarray import zeros
+from java.lang import System
+from java.lang import Math
+from java.lang import Runtime
+from java.lang import ProcessBuilder
+from java.lang.management import ManagementFactory
+from java.io import File
+from java.util.concurrent import Callable
+from java.util.concurrent import Executors
+from collections import deque
+from threading import Lock
+import csv, os, glob, sys, json, subprocess, math, hashlib
 
 # If set to true, windows with selected and analysed cells are left opened
 verify_params = False
 
+# Directory of the cached background means of ThresholdEst, set by AnalyseFolder (see Background_Cache)
+background_cache = None
+
+# The file, the series (Bio-Formats) and the time point of the positions of multi-position files and of the time points of time-lapse
+# images, analysed as the images <image>_S<n>, <image>_T<n> or <image>_S<n>_T<m> (see Image_Units)
+series_units = {}
+
+# SHA-1 of the files hashed by Cache_Key under their path, size and modification time: a multi-position or time-lapse file is
+# hashed once for all its series and time points
+file_digests = {}
+
 # If background set to a different colour than Black, then the script will not work correctly
 IJ.run("Colors...", "foreground=magenta background=black selection=yellow")
 
@@ -54,30 +150,113 @@ def opensavedROIman(ROIopenpath):
 	rm.runCommand("Open", ROIopenpath)	
 	return rm
 
-def ThresholdEst(DAPI, foci, thres_a, thres_b):
-	#estimates the threshold for the MaximumFinder using the background without the cells which are excluded using a mask created from the DAPI channel
-	DAPI_seg = DAPI.duplicate()
-	DAPI_seg.show
-	IJ.run(DAPI_seg, "8-bit", "")
+def DAPI_8bit(DAPI):
+	# 8-bit copy of the DAPI channel, the first step of both ThresholdEst and Cell_Segmentation, made once per image
+	DAPI8 = DAPI.duplicate()
+	IJ.run(DAPI8, "8-bit", "")
+	return DAPI8
+
+def Background_Mean(DAPI8, foci):
+	# Mean of the foci channel outside the cells, which are segmented from the 8-bit DAPI channel (DAPI_8bit).
+	total, count = Background_Sum(DAPI8, foci)
+	return total / count
+
+def Background_Sum(DAPI8, foci, core=None):
+	# Sum and number of the pixels of the foci channel outside the cells, only in core (java.awt.Rectangle, the core of a tile) if given.
+	# They come from the histogram of the whole channel minus the histogram of the cells, no image is cleared or measured.
+	DAPI_seg = DAPI8.duplicate()
 	# run cell segmentation on DAPI channel. Method: Default
 	IJ.run(DAPI_seg, "Subtract Background...", "rolling=100")
 	IJ.run(DAPI_seg, "Gaussian Blur...", "sigma=5")
 	IJ.run(DAPI_seg, "Enhance Contrast...", "saturated=10 normalize equalize")
-	IJ.setAutoThreshold(DAPI, "Default dark no-reset")
 	IJ.run(DAPI_seg, "Convert to Mask", "")
 	IJ.run(DAPI_seg, "Fill Holes", "")
-	IJ.run(DAPI_seg, "Create Selection", "")		
-	roi1 = DAPI_seg.getRoi()	
-	foci_img = foci.duplicate()
-	foci_img.setRoi(roi1)
-	IJ.run(foci_img, "Clear", "slice")
-	IJ.run(foci_img, "Make Inverse", "")
-	IJ.run(foci_img, "Measure", "") # Without this line it does not work correctly. Keep it!!!
-	stat = foci_img.getProcessor().getStatistics()
-	threshold = round(thres_a * stat.mean + thres_b) # Function obtained from threshold analysis 
-	foci_img.hide()
-	DAPI_seg.hide()	
-	return threshold
+	IJ.run(DAPI_seg, "Create Selection", "")
+	roi1 = DAPI_seg.getRoi()
+	DAPI_seg.close()
+	ip = foci.getProcessor()
+	if core is not None:
+		ip.setRoi(core)
+		if roi1 is not None:
+			# ShapeRoi.and (a keyword in Python) keeps the cells in the core
+			roi1 = getattr(ShapeRoi(roi1), 'and')(ShapeRoi(Roi(core)))
+			if roi1.getBounds().isEmpty():
+				roi1 = None
+	whole = ip.getHistogram()
+	ip.resetRoi()
+	cells = zeros(len(whole), 'i')
+	if roi1 is not None:
+		ip.setRoi(roi1)
+		cells = ip.getHistogram()
+		ip.resetRoi()
+	count = 0
+	total = 0.0
+	for value in xrange(len(whole)):
+		n = whole[value] - cells[value]
+		if n:
+			count = count + n
+			total = total + value * n
+	return total, count
+
+def Background_Entry(filename, params, kind='background'):
+	# File of the cached background mean of the image in background_cache, under the path, size and modification time of the image 
+	# (None without cache). With kind 'ranges' the file of the cached minimum and maximum of the whole plane (Plane_Ranges).
+	if not background_cache:
+		return None
+	path, series = Image_File(filename)
+	stat = os.stat(path)
+	described = [os.path.abspath(path), stat.st_size, stat.st_mtime, BACKGROUND_VERSION]
+	if series:
+		described.append(series)
+	if Image_Timepoint(filename):
+		described.append('T' + str(Image_Timepoint(filename)))
+	if params['z_projection'] == 'max':
+		described.append('max')
+	if kind == 'background' and int(params['tile_size']) > 0:
+		# the cells of a tiled image (Tiled_Size) are segmented tile by tile with the overlap (Scan_Tiles). segmentation_bin does not 
+		# change the mean, Background_Sum segments the cells at full resolution.
+		described.extend([int(params['tile_size']), int(params['tile_overlap'])])
+	key = hashlib.sha1(json.dumps(described)).hexdigest()
+	return os.path.join(background_cache, kind + '_' + key + '.json')
+
+def Cached_Background(entry):
+	# The cached background mean or None
+	if entry and os.path.isfile(entry):
+		with open(entry, 'r') as f:
+			return json.load(f)['mean']
+	return None
+
+def Cache_Background(entry, filename, mean):
+	if entry:
+		with open(entry, 'w') as f:
+			json.dump({'image': os.path.basename(filename), 'mean': mean}, f)
+
+def Cached_Ranges(entry):
+	# The cached ranges of Plane_Ranges or None
+	if entry and os.path.isfile(entry):
+		with open(entry, 'r') as f:
+			return [tuple(channel) for channel in json.load(f)['ranges']]
+	return None
+
+def Cache_Ranges(entry, filename, ranges):
+	if entry:
+		with open(entry, 'w') as f:
+			json.dump({'image': os.path.basename(filename), 'ranges': ranges}, f)
+
+def ThresholdEst(filename, DAPI, foci, params):
+	#estimates the threshold for the MaximumFinder using the background without the cells which are excluded using a mask created from the DAPI channel
+	# The background mean of an image is kept in the cache directory (global background_cache, None without cache) under the path, 
+	# size and modification time of the image, so it is estimated only once per image also for other parameters or in the sweep mode.
+	# Returns the threshold and the 8-bit DAPI channel for Cell_Segmentation (None if the mean was cached).
+	DAPI8 = None
+	entry = Background_Entry(filename, params)
+	mean = Cached_Background(entry)
+	if mean is None:
+		DAPI8 = DAPI_8bit(DAPI)
+		mean = Background_Mean(DAPI8, foci)
+		Cache_Background(entry, filename, mean)
+	threshold = round(params['thres_a'] * mean + params['thres_b']) # Function obtained from threshold analysis 
+	return threshold, DAPI8
 	
 def Select_Area(imp): # for the vessel selection in the in vivo samples from the DAPI channel
 	img = imp.duplicate()	
@@ -93,21 +272,134 @@ def Select_Area(imp): # for the vessel selection in the in vivo samples from the
 	img.close()			
 	return roi1	
 	
-def Cell_Segmentation(imp):
-	DAPI = imp.duplicate()
-	IJ.run(DAPI, "8-bit", "")
-	IJ.run(DAPI, "Subtract Background...", "rolling=50")
-	IJ.run(DAPI, "Gaussian Blur...", "sigma=1")
-	IJ.run(DAPI, "Enhance Contrast...", "saturated=10 normalize equalize")
-	IJ.setAutoThreshold(DAPI, "Default dark no-reset")
-	IJ.run(DAPI, "Convert to Mask", "")
-	IJ.run(DAPI, "Fill Holes", "")
+def Cell_Segmentation(imp, factor=1):
+	# With factor > 1 the nuclei are segmented on the DAPI channel binned factor x factor (Segmentation_Pyramid)
+	if factor > 1:
+		DAPI = Segmentation_Pyramid(imp, factor)
+	else:
+		DAPI = imp.duplicate()
+		IJ.run(DAPI, "8-bit", "")
+		IJ.run(DAPI, "Subtract Background...", "rolling=50")
+		IJ.run(DAPI, "Gaussian Blur...", "sigma=1")
+		blurred = DAPI
+		DAPI = Level_Mask(blurred, Nuclei_Level(blurred))
+		blurred.close()
 	IJ.run(DAPI, "Watershed", "")
 	IJ.run(DAPI, "Create Selection", "")	
 	IJ.run(DAPI, "Select None", "")
 	DAPI.setTitle("Cell_Segmentation")
 	return DAPI 
 
+def Nuclei_Level(blurred):
+	# Darkest grey value of the nuclei in the background subtracted and blurred 8-bit DAPI channel (256 without nuclei): the "Default 
+	# dark" threshold after "Enhance Contrast..." with "equalize", but never below the "Otsu dark" threshold of the blurred channel 
+	# itself (nuclei_mask of FociMF_Engine.py). In sparse fields the equalization spreads the background noise over most of the grey 
+	# values and the threshold of the equalized image lands in it.
+	equalized = blurred.duplicate()
+	IJ.run(equalized, "Enhance Contrast...", "saturated=10 normalize equalize")
+	IJ.setAutoThreshold(equalized, "Default dark no-reset")
+	above = ThresholdToSelection.run(equalized)
+	equalized.close()
+	if above is None:
+		return 256
+	# the equalization does not change the order of the grey values, so the threshold is the darkest pixel above it
+	bp = blurred.getProcessor()
+	bp.setRoi(above)
+	level = int(ImageStatistics.getStatistics(bp, Measurements.MIN_MAX, None).min)
+	bp.resetRoi()
+	IJ.setAutoThreshold(blurred, "Otsu dark no-reset")
+	level = max(level, int(bp.getMinThreshold()))
+	bp.resetThreshold()
+	return level
+
+def Level_Mask(imp, level):
+	# Mask of the pixels of the 8-bit image at or above level with the holes filled, 255 are the nuclei (as after "Convert to Mask")
+	ip = imp.getProcessor().duplicate()
+	ip.threshold(level - 1)
+	if not Prefs.blackBackground:
+		ip.invertLut()
+	Mask = ImagePlus(imp.getTitle(), ip)
+	IJ.run(Mask, "Fill Holes", "")
+	return Mask
+
+def Segmentation_Pyramid(imp, factor):
+	# Mask of the nuclei (before the watershed) from the DAPI channel binned factor x factor: background (rolling ball of radius 
+	# 50 / factor), blur, equalization and threshold as in Cell_Segmentation, but on factor^2 times less pixels. The mask is enlarged 
+	# back to the full resolution and the pixels within factor pixels of the borders of the nuclei are thresholded again at full 
+	# resolution with the interpolated background and the threshold of the binned image (in grey values before the equalization).
+	DAPI = imp.duplicate()
+	IJ.run(DAPI, "8-bit", "")
+	ip = DAPI.getProcessor()
+	width, height = ip.getWidth(), ip.getHeight()
+	small = ImagePlus("binned", ip.bin(factor))
+	background = small.duplicate()
+	IJ.run(background, "Subtract Background...", "rolling=" + str(50.0 / factor) + " create")
+	blurred = small.duplicate()
+	blurred.getProcessor().copyBits(background.getProcessor(), 0, 0, Blitter.SUBTRACT)
+	IJ.run(blurred, "Gaussian Blur...", "sigma=" + str(1.0 / factor))
+	level = Nuclei_Level(blurred)
+	mask = ByteProcessor(width, height)
+	if level <= 255:
+		coarse = Level_Mask(blurred, level)
+		mask.insert(Enlarge(coarse.getProcessor(), factor, width, height, ImageProcessor.NONE), 0, 0)
+		coarse.close()
+		full = DAPI.getProcessor()
+		full.copyBits(Enlarge(background.getProcessor(), factor, width, height, ImageProcessor.BILINEAR), 0, 0, Blitter.SUBTRACT)
+		IJ.run(DAPI, "Gaussian Blur...", "sigma=1")
+		full.threshold(level - 1)
+		# border band: the pixels where the maximum and the minimum of the mask within factor pixels differ
+		band = mask.duplicate()
+		eroded = mask.duplicate()
+		RankFilters().rank(band, factor, RankFilters.MAX)
+		RankFilters().rank(eroded, factor, RankFilters.MIN)
+		band.copyBits(eroded, 0, 0, Blitter.DIFFERENCE)
+		# full resolution threshold inside the band, the enlarged mask outside
+		full.copyBits(band, 0, 0, Blitter.AND)
+		band.invert()
+		mask.copyBits(band, 0, 0, Blitter.AND)
+		mask.copyBits(full, 0, 0, Blitter.OR)
+	DAPI.close()
+	# 255 are the nuclei, shown black on white unless "Black background" is set (as after "Convert to Mask")
+	if not Prefs.blackBackground:
+		mask.invertLut()
+	Mask = ImagePlus("Cell_Segmentation", mask)
+	IJ.run(Mask, "Fill Holes", "")
+	return Mask
+
+def Enlarge(ip, factor, width, height, interpolation):
+	# Binned processor back to width x height (enlarge of FociMF_Engine.py): every bin covers factor x factor pixels and the pixels 
+	# left out by ip.bin at the right and bottom (width or height not a multiple of factor) get the last column and row
+	ip.setInterpolationMethod(interpolation)
+	w, h = ip.getWidth() * factor, ip.getHeight() * factor
+	enlarged = ip.createProcessor(width, height)
+	enlarged.insert(ip.resize(w, h), 0, 0)
+	if width > w:
+		enlarged.setRoi(w - 1, 0, 1, h)
+		enlarged.insert(enlarged.crop().resize(width - w, h), w, 0)
+	if height > h:
+		enlarged.setRoi(0, h - 1, width, 1)
+		enlarged.insert(enlarged.crop().resize(width, height - h), 0, h)
+	enlarged.resetRoi()
+	return enlarged
+
+def Segmentation_Check(filename, imp, Cell_Map, factor, params):
+	# Accuracy of the binned segmentation: intersection over union of the nuclei of Cell_Map and of the full resolution segmentation.
+	# Returns the full resolution mask if it is below segmentation_min_iou, otherwise Cell_Map.
+	Full_Map = Cell_Segmentation(imp)
+	both = Cell_Map.getProcessor().duplicate()
+	both.copyBits(Full_Map.getProcessor(), 0, 0, Blitter.AND)
+	union = Cell_Map.getProcessor().duplicate()
+	union.copyBits(Full_Map.getProcessor(), 0, 0, Blitter.OR)
+	n_union = union.getHistogram()[255]
+	iou = both.getHistogram()[255] / float(n_union) if n_union else 1.0
+	print os.path.basename(filename) + ": segmentation binned " + str(factor) + "x, IoU with the full resolution " + "%.4f" % iou
+	if iou < params['segmentation_min_iou']:
+		print os.path.basename(filename) + ": IoU below " + str(params['segmentation_min_iou']) + ", the full resolution mask is used"
+		Cell_Map.close()
+		return Full_Map
+	Full_Map.close()
+	return Cell_Map
+
 def Pick_Cells(Mask, DAPI, RoiManagerInstance, ROIsavepath): 
 	# Pick the right cells ex vivo	
 	DAPI_img = DAPI.duplicate()
@@ -171,16 +463,114 @@ def Pick_Cells_InVivo(Mask, DAPI, RoiManagerInstance, ROIsavepath, roi1):
 	DAPI_img.hide()
 	Mask.hide()	
 	return Mask, RoiManagerInstance
-	
+
+def Mask_Objects(Mask):
+	# The separate objects of the segmentation as ROIs, like "Create Selection" and "Split" of the ROI manager
+	IJ.run(Mask, "Create Selection", "")
+	roi = Mask.getRoi()
+	IJ.run(Mask, "Select None", "")
+	if roi is None:
+		return []
+	if isinstance(roi, ShapeRoi):
+		return list(roi.getRois())
+	return [roi]
+
+def Cell_Shape(ROI, ip):
+	# Area (pixels), solidity, circularity, mean intensity of ip and centroid of one object, as measured by "Analyze Particles"
+	ip.setRoi(ROI)
+	stats = ImageStatistics.getStatistics(ip, Measurements.AREA | Measurements.MEAN | Measurements.CENTROID, None)
+	ip.resetRoi()
+	hull = ROI.getConvexHull()
+	hull_area = 0.0
+	for i in range(hull.npoints):
+		j = (i + 1) % hull.npoints
+		hull_area += hull.xpoints[i] * hull.ypoints[j] - hull.xpoints[j] * hull.ypoints[i]
+	hull_area = abs(hull_area) / 2.0
+	perimeter = ROI.getLength()
+	area = stats.pixelCount
+	solidity = area / hull_area if hull_area > 0 else 0.0
+	circularity = min(4 * math.pi * area / (perimeter * perimeter), 1.0) if perimeter > 0 else 0.0
+	return area, solidity, circularity, stats.mean, stats.xCentroid, stats.yCentroid
+
+def Auto_Pick_Cells(Mask, DAPI, params, roi1=None):
+	# Picks the cells without the operator: all the objects of the segmentation (Cell_Segmentation) with area, solidity, circularity
+	# and mean DAPI intensity within the auto_... limits, optionally not touching the border of the image.
+	# In vivo (roi1 is the selected vessel) only the cells with their centre at most 45 um from the vessel are picked.
+	ip = DAPI.getProcessor()
+	pixel_area = float(params['pixel_size']) * float(params['pixel_size'])
+	if roi1 is not None:
+		band = RoiEnlarger.enlarge(roi1, int(round(45 / float(params['pixel_size']))))
+	picked = []
+	for ROI in Mask_Objects(Mask):
+		bounds = ROI.getBounds()
+		if params['auto_exclude_border'] == True and (bounds.x <= 0 or bounds.y <= 0 or
+			bounds.x + bounds.width >= ip.getWidth() or bounds.y + bounds.height >= ip.getHeight()):
+			continue
+		area, solidity, circularity, mean, x, y = Cell_Shape(ROI, ip)
+		if not params['auto_min_area'] <= area * pixel_area <= params['auto_max_area']:
+			continue
+		if solidity < params['auto_min_solidity'] or circularity < params['auto_min_circularity']:
+			continue
+		if not params['auto_min_DAPI'] <= mean <= params['auto_max_DAPI']:
+			continue
+		if roi1 is not None and not band.contains(int(x), int(y)):
+			continue
+		picked.append(ROI)
+	return picked
+
+def Review_Cells(DAPI, ROIs, RoiManagerInstance, ROIsavepath, params):
+	# Puts the automatically picked cells to the ROI manager and saves it. With auto_review the operator can delete wrong cells
+	# or add missing ones in the ROI manager before it is saved.
+	RoiManagerInstance.runCommand("reset")
+	for ROI in ROIs:
+		RoiManagerInstance.addRoi(ROI)
+	if params['auto_review'] == True:
+		DAPI_img = DAPI.duplicate()
+		DAPI_img.show()
+		RoiManagerInstance.runCommand(DAPI_img, "Show All")
+		WaitForUserDialog("Action required", str(len(ROIs)) + " cells were picked automatically. Delete the wrong ones from the ROI manager"+
+							" \nor add missing ones. Please press OK when done.").show()
+		DAPI_img.close()
+	if RoiManagerInstance.getCount() > 0:
+		RoiManagerInstance.runCommand("Save", ROIsavepath + ".zip")
+	else:
+		print 'No cells were picked in ' + os.path.basename(ROIsavepath)[:-4] + ', no ROI manager is saved.'
+	return RoiManagerInstance
+
+def Clear_Range(imp):
+	# Display range that the thresholding with "reset" gives to the whole channel. "Clear Outside" fills with the background colour
+	# scaled to this range, so the crops have to get the same range to be cleared with the same value as the whole image.
+	stats = imp.getProcessor().getStatistics()
+	return stats.min, stats.max
+
+def Crop_Cell(imp, ROI, clear_range):
+	# Crops the bounding box of the ROI from one channel and clears the area around the cell only in the crop.
+	# Returns the crop and the ROI moved to the coordinates of the crop.
+	# Why? If cells are close to each other, a rectangular image celection around one cell 
+	# might include areas of other cells and we do not want that
+	ip = imp.getProcessor()
+	ip.setRoi(ROI.getBounds())
+	bounds = ip.getRoi()
+	img = ImagePlus(imp.getTitle(), ip.crop())
+	ip.resetRoi()
+	if img.getBitDepth() == 8:
+		img.getProcessor().resetMinAndMax()
+	else:
+		img.getProcessor().setMinAndMax(clear_range[0], clear_range[1])
+	cell_ROI = ROI.clone()
+	cell_ROI.setLocation(ROI.getBounds().x - bounds.x, ROI.getBounds().y - bounds.y)
+	img.setRoi(cell_ROI)
+	IJ.run(img, "Clear Outside", "")
+	img.deleteRoi()
+	return img, cell_ROI
+
 def excludeDAPI(Stack, cell_ROI, filename1):
 	# This fuction gives information about the DAPI channel
 	# The DAPI and GFP channel are in the opposite direction in the .czi and .zvi image formats 
 	if filename1.endswith('.czi'):
-		Stack.setSlice(2)
+		ip = Stack.getStack().getProcessor(2)
 	else:
-		Stack.setSlice(1)
-	img = Stack.crop()
-	ip = img.getProcessor()
+		ip = Stack.getStack().getProcessor(1)
 	ip.setRoi(cell_ROI)
 	stats = ip.getStatistics()
 	DAminV = round(stats.min,2)
@@ -189,41 +579,97 @@ def excludeDAPI(Stack, cell_ROI, filename1):
 	DAhomogen = round(DAmaxV/DAmeanV,3) 
 	return DAmeanV, DAminV, DAmaxV, DAhomogen
 
-def findFoci(Stack, cell_ROI, threshold, filename1):
-	# Uses Find Maxima to detect foci in cell
-	mf = MaximumFinder()
+def Foci_Channel(Stack, filename1):
+	# Copy of the GFP channel of the cell, blurred if the user wants it
 	# The DAPI and GFP channel are in the opposite direction in the .czi and .zvi image formats 
 	if filename1.endswith('.czi'):
-		Stack.setSlice(1)
+		ip = Stack.getStack().getProcessor(1).duplicate()
 	else:
-		Stack.setSlice(2)
-	img = Stack.crop()
+		ip = Stack.getStack().getProcessor(2).duplicate()
 	if Gaussian_blur_use == True:
-		IJ.run(img, "Gaussian Blur...", "sigma="+sigma_foci+"")
-	ip = img.getProcessor()
-	ip2 = img.getProcessor().convertToFloat()
+		# the same as "Gaussian Blur..." with the sigma in pixels
+		if isinstance(ip, ByteProcessor):
+			accuracy = 0.002
+		else:
+			accuracy = 0.0002
+		GaussianBlur().blurGaussian(ip, float(sigma_foci), float(sigma_foci), accuracy)
+	return ip
+
+def findFoci(Stack, cell_ROI, threshold, filename1):
+	# Uses Find Maxima to detect foci in cell
+	mf = MaximumFinder()
+	ip = Foci_Channel(Stack, filename1)
 	ip.setRoi(cell_ROI)
-	ip2.setRoi(cell_ROI)
-	pixels = ip2.getPixels()
 	stats = ip.getStatistics()
 	minV = round(stats.min,2)
 	maxV = round(stats.max,2)
 	meanV = round(stats.mean,2)
-	PecentAreaThres = round(reduce(lambda count, a: count + 1 if a > threshold else count, pixels, 0) / float(len(pixels)) * 100,2)
+	PecentAreaThres = Area_Above(ip, threshold, stats.pixelCount)
 	GFPhomogen = round(maxV/meanV,3)
+	# The maxima are found only once, the count and the image with the found maxima both come from the point list
 	maxima = mf.findMaxima(ip, noise_tolerance, threshold, MaximumFinder.SINGLE_POINTS, False, False)
-	maxima2 =  mf.findMaxima(ip, noise_tolerance, threshold, MaximumFinder.SINGLE_POINTS, False, False)
-	maxima2.invert()
-	findmaxinvert = ImagePlus("Found Maxima", maxima2)
-	findmaximashow = ImagePlus("Maxima", maxima)
-	maximaip = findmaximashow.getProcessor()
-	maximahist = maximaip.getHistogram()
-	CountMethod = maximahist[255]
-	Points = str(CountMethod)								
-	return Points, findmaxinvert, meanV, minV, maxV, PecentAreaThres, GFPhomogen	
+	maxima_points = Maxima_Points(maxima)
+	Points = str(len(maxima_points))								
+	return Points, maxima_points, meanV, minV, maxV, PecentAreaThres, GFPhomogen	
+
+def Sweep_Foci(Stack, cell_ROI, thresholds, tolerances, filename1):
+	# findFoci for all the combinations of thresholds and noise tolerances. The GFP channel is cropped and blurred only once 
+	# and the statistics of the cell are measured once, only the area above threshold and Find Maxima run per combination.
+	# Returns the statistics and a list of (threshold, noise tolerance, Points, PecentAreaThres).
+	mf = MaximumFinder()
+	ip = Foci_Channel(Stack, filename1)
+	ip.setRoi(cell_ROI)
+	stats = ip.getStatistics()
+	minV = round(stats.min,2)
+	maxV = round(stats.max,2)
+	meanV = round(stats.mean,2)
+	GFPhomogen = round(maxV/meanV,3)
+	combinations = []
+	for threshold in thresholds:
+		PecentAreaThres = Area_Above(ip, threshold, stats.pixelCount)
+		for noise_tolerance in tolerances:
+			maxima = mf.findMaxima(ip, noise_tolerance, threshold, MaximumFinder.SINGLE_POINTS, False, False)
+			combinations.append((threshold, noise_tolerance, str(len(Maxima_Points(maxima))), PecentAreaThres))
+	return meanV, minV, maxV, GFPhomogen, combinations
+
+def Area_Above(ip, threshold, pixelCount):
+	# Percentage of the pixels inside the ROI of ip (pixelCount of them) that are higher than the threshold
+	# ImageJ counts them with the threshold as measurement limit, so the pixels are not looped in Python
+	if isinstance(ip, FloatProcessor):
+		lower = Math.nextUp(float(threshold))
+	else:
+		lower = math.floor(threshold) + 1
+	if pixelCount == 0 or lower > ip.maxValue():
+		return 0.0
+	ip.setThreshold(lower, ip.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+	above = ImageStatistics.getStatistics(ip, Measurements.AREA | Measurements.LIMIT, None).pixelCount
+	ip.resetThreshold()
+	return round(above / float(pixelCount) * 100,2)
+
+def Maxima_Points(maxima):
+	# Coordinates (x, y) of the maxima in the SINGLE_POINTS output of the MaximumFinder (255 at the maxima, 0 elsewhere)
+	# The pixels are searched as a string so that the loop runs only over the maxima and not over all the pixels
+	width = maxima.getWidth()
+	pixels = maxima.getPixels().tostring()
+	points = []
+	i = pixels.find('\xff')
+	while i >= 0:
+		points.append((i % width, i // width))
+		i = pixels.find('\xff', i + 1)
+	return points
+
+def Maxima_Image(maxima_points, width, height):
+	# Renders the found maxima as the inverted SINGLE_POINTS output: black points on white background
+	ip = ByteProcessor(width, height)
+	ip.setValue(255)
+	ip.fill()
+	for x, y in maxima_points:
+		ip.set(x, y, 0)
+	return ip
 
 def Postprocess(Stack, cell_ROI):
 	# Does a bit of postprocessing: adjust windowing for every channel and sets the foci as active ROI selection
+	# The commands run on the ImagePlus, it does not need to be shown
 	Stack.setRoi(cell_ROI);
 	IJ.run(Stack, "Enhance Contrast...", "saturated=0.3 normalize process_all")
 	IJ.run(Stack, "8-bit", "")		
@@ -231,37 +677,981 @@ def Postprocess(Stack, cell_ROI):
 def Cell_Area(IMPStack, filename1):
 	# Gets Cell Area
 	# Pick DAPI channel with black background (pixel value = 0)
-	# The DAPI and GFP channel are in the opposite direction in the .czi and .zvi image formats 
-	if filename1.endswith('.czi'):
-		IMPStack.setSlice(1)
-	else:
-		IMPStack.setSlice(0)	
-	# Invert to get correct selection
-	cell_mask = IMPStack.crop()
-	IJ.run(cell_mask, "Enhance Contrast", "saturated=0.35")
-	IJ.run(cell_mask, "8-bit", "slice")
-	cell_mask.show()
-	IJ.setThreshold(1, 255)
-	IJ.run(cell_mask, "Convert to Mask", "background=Dark calculate only black")
-	IJ.run(cell_mask, "Create Selection", "")
+	# The first slice is used for both the .czi and .zvi image formats (setSlice(0) of the .zvi images kept the first slice)
+	cell_mask = ImagePlus("Cell_mask", IMPStack.getStack().getProcessor(1).duplicate())
+	# The same as "Enhance Contrast" and "8-bit", "Convert to Mask" of the pixels 1-255 and "Create Selection" without any window
+	ContrastEnhancer().stretchHistogram(cell_mask, 0.35)
+	ImageConverter(cell_mask).convertToGray8()
+	ip = cell_mask.getProcessor()
+	ip.setThreshold(1, 255, ImageProcessor.NO_LUT_UPDATE)
+	ROI = ThresholdToSelection.run(cell_mask)
+	cell_mask.setProcessor(ip.createMask())
+	cell_mask.setRoi(ROI)
 	Area = round(cell_mask.getStatistics().area,2)
-	ROI = cell_mask.getRoi()
-	cell_mask.hide()
 	return cell_mask, Area, ROI
+
+def Cell_Area_ROI(Stack, cell_ROI):
+	# Gets Cell Area directly from the picked ROI: the pixels inside the ROI scaled by the calibration
+	# The ROI is also the ROI of the cell, no mask is made from the crop
+	ip = Stack.getStack().getProcessor(1)
+	ip.setRoi(cell_ROI)
+	Area = round(ImageStatistics.getStatistics(ip, Measurements.AREA, Stack.getCalibration()).area,2)
+	return Area, cell_ROI
+
+def Measure_Cell_Area(Stack, cell_ROI, filename1, params):
+	# Cell Area and ROI of the cell with the method of params['cell_area']: "roi" (the picked ROI) or "legacy" (Cell_Area)
+	if params['cell_area'] == 'legacy':
+		Cell_mask, Area_Cell, Cell_ROI = Cell_Area(Stack, filename1)
+		return Area_Cell, Cell_ROI
+	return Cell_Area_ROI(Stack, cell_ROI)
+
+def Cell_Area_Check(name, Stack, cell_ROI, filename1):
+	# Row of the check of the cell area: the area of the picked ROI, the area of Cell_Area (mask of the crop) and the difference in %
+	Area_ROI, ROI = Cell_Area_ROI(Stack, cell_ROI)
+	Cell_mask, Area_Legacy, Legacy_ROI = Cell_Area(Stack, filename1)
+	if Area_Legacy > 0:
+		difference = round((Area_ROI - Area_Legacy) / Area_Legacy * 100,2)
+	else:
+		difference = "NA"
+	return [name, Area_ROI, Area_Legacy, difference]
+
+def Write_Area_Check(nameCheck, checks):
+	# Saves the check of the cell areas of one image and prints a summary
+	with open(nameCheck, 'wb') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(['Cell No', 'Cell Area ROI', 'Cell Area legacy', 'Difference %'])
+		for row in checks:
+			spamwriter.writerow(row)
+	differences = [abs(row[3]) for row in checks if row[3] != "NA"]
+	if differences:
+		print 'Cell area check: ' + str(len([d for d in differences if d > 1])) + ' of ' + str(len(checks)) + ' cells differ by more than 1%, ' + \
+			'largest difference ' + str(max(differences)) + '% (' + os.path.basename(nameCheck) + ')'
+
+def Set_Scale(pixel_cal):
+	# The same as "Set Scale..." with "global": all the images get the calibration of the microscope (pixel_cal pixels per micron)
+	cal = Calibration()
+	cal.pixelWidth = 1/float(pixel_cal)
+	cal.pixelHeight = cal.pixelWidth
+	cal.setUnit("micron")
+	ImagePlus.setGlobalCalibration(cal)
+
+# Columns of the results file and of the raw measurements file (before the exclusion criteria, with the threshold of the image)
+HEADER = ['Cell No', 'DAPI min', 'DAPI max', 'DAPI mean', 'DAPI homogeneity', 'GFP min', 'GFP max', 'GFP mean', 'GFP homogeneity', '% Area above threshold GFP', 'Foci size', 'Cell Area', 'N_Foci']
+RAW_HEADER = HEADER + ['Threshold']
+# Columns of the sweep file: the noise tolerance of the parameters, the one used for the image (scaled for low exposures) and the threshold
+SWEEP_HEADER = ['noise_toler', 'Noise tolerance', 'Threshold'] + HEADER
+
+def Classify(Points, FS, Area_Cell, PecentAreaThres, maxV, meanV, GFPhomogen, threshold, params):
+	# Applies the exclusion criteria to the raw measurements of one cell and returns the final Points and FS
+	# The values can be numbers or the strings of a raw measurements file. Same rules as RULES in FociMF_Reclassify.py.
+	if params['ExclutionCriteria'] == True:
+		if float(Area_Cell) < params['Min_cellarea'] or float(Area_Cell) > params['Max_cellarea']:
+			Points = "OE"
+			FS = 0
+		elif float(PecentAreaThres) == 0:
+			Points = 0
+			FS = 0
+		elif (float(maxV) < params['zeroMax'] * threshold and float(GFPhomogen) < params['zeroHom']):
+			Points = 0
+			FS = 0
+		# FS is "NA" for cells without foci, it is compared with MaxFS only if it is a number
+		elif ((float(meanV) > (params['ExcluMean'] * threshold)) or (float(PecentAreaThres) > params['AreaAboveThres']) or (FS != "NA" and float(FS) >= params['MaxFS'])):
+			if params['DivideOEcells'] == True:
+				if (float(GFPhomogen) > params['HomoToDiv']): 
+					help = round(float(Area_Cell)*float(PecentAreaThres)/100/params['UserEstFociSize'])
+					if int(Points) < float(help):
+						Points = help
+			else:
+				Points = "OE"
+		elif Points == 0:
+			FS = 0
+	return Points, FS
+
+def Raw_Name(nameCSV):
+	# Name of the raw measurements file that belongs to a results file
+	return os.path.join(os.path.dirname(nameCSV), os.path.basename(nameCSV).replace('_results_MaxFind_', '_raw_MaxFind_', 1))
+
+def Write_Results(nameCSV, rawRows, params):
+	# Writes the results file from the raw measurements (rows with the RAW_HEADER columns) with the exclusion criteria of params
+	with open(nameCSV, 'wb') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(HEADER)
+		for row in rawRows:
+			Points, FS = Classify(row[12], row[10], row[11], row[9], row[6], row[7], row[8], float(row[13]), params)
+			spamwriter.writerow(row[:10] + [FS, row[11], Points])
+	
+##############################################################################################################################################
+######################################################## HEADLESS BATCH MODE #################################################################
+##############################################################################################################################################
+
+# Parameters of the analysis. The keys are the names of the values asked in the dialogs of main() and the values are the
+# defaults of these dialogs. A parameter file for the batch mode only needs to contain the values that should be different.
+DEFAULT_PARAMS = {
+	'pixel_size': 0.161,
+	'Gaussian_blur_use': False,
+	'sigma_foci': 1.0,
+	'TumorAnalysis': False,
+	'RoiManHave': False,
+	'noise_toler': 100.0,
+	'TresSelect': False,
+	'manualTres': 500.0,
+	'thres_a': 0.65,
+	'thres_b': 350.0,
+	'Min_cellarea': 15.0,
+	'Max_cellarea': 300.0,
+	'ExclutionCriteria': False,
+	'zeroMax': 3.0,
+	'zeroHom': 2.0,
+	'ExcluMean': 4.0,
+	'AreaAboveThres': 75.0,
+	'MaxFS': 5.0,
+	'DivideOEcells': False,
+	'HomoToDiv': 2.3,
+	'UserEstFociSize': 3.5,
+	'image_type': '.czi',
+	# Batch mode only: number of Fiji processes analysing the images in parallel, the Fiji launcher and this script 
+	# (found automatically when started from the command line)
+	'workers': 1,
+	'fiji_executable': '',
+	'script_path': '',
+	# Maximum heap (MB) of every worker process (--mem of the Fiji launcher), 0: three quarters of the physical memory divided by workers
+	'worker_memory': 0,
+	# Read only the bounding boxes of the saved ROIs (only with a saved ROI manager and a manual threshold), the minimum and maximum 
+	# of the whole plane are cached (cache)
+	'crop_to_rois': False,
+	# Number of images read ahead by a background thread during the analysis and the memory (MB) they may take
+	'prefetch': 1,
+	'prefetch_memory': 1024,
+	# Cache of the results of the saved ROI managers (default directory Results/cache) and its size (MB)
+	'cache': True,
+	'cache_dir': '',
+	'cache_size': 500,
+	# Sweep mode (batch mode only): lists of noise tolerances and thresholds that are all evaluated from the same crops of the cells,
+	# e.g. [50, 100, 150]. An empty list uses noise_toler or the threshold of the image (manual or automatic).
+	'sweep_noise': [],
+	'sweep_threshold': [],
+	# "parquet": the results of the batch mode are also collected into one dataset Results/<folder>_results.parquet by FociMF_Store.py, 
+	# which runs with python_executable (CPython with pyarrow)
+	'results_store': '',
+	'python_executable': 'python3',
+	# Images of the analysed cells in Analysed_cells: "all" (one TIFF per cell), "sampled" (every cell_images_every-th cell and, 
+	# with cell_images_flagged, the cells that are OE or zero after the exclusion criteria), "montage" (one multi-page TIFF with all 
+	# the cells of the image) or "none". With cell_images_compress the TIFFs are saved zipped (.zip, opened by ImageJ as TIFF).
+	'cell_images': 'all',
+	'cell_images_every': 10,
+	'cell_images_flagged': True,
+	'cell_images_compress': False,
+	# Cell Area and the ROI of the cell: "roi" (the picked ROI scaled by the calibration) or "legacy" (mask made from the DAPI crop).
+	# cell_area_check saves both areas of every cell in Results/<image>_cell_area_check_*.csv.
+	'cell_area': 'roi',
+	'cell_area_check': False,
+	# Wall time and heap use of the stages of the analysis per image and per run in Results/<folder>_profile.json
+	'profile': False,
+	# Picking of the cells without a saved ROI manager: "manual" (flood-fill of the segmentation) or "auto" (all the objects of the 
+	# segmentation within the limits below). Area in squared um, DAPI as the mean intensity of the object in the DAPI channel.
+	# With auto_review the picked cells are shown in the ROI manager and can be corrected before the analysis.
+	'picking': 'manual',
+	'auto_min_area': 15.0,
+	'auto_max_area': 300.0,
+	'auto_min_solidity': 0.9,
+	'auto_min_circularity': 0.5,
+	'auto_exclude_border': True,
+	'auto_min_DAPI': 0.0,
+	'auto_max_DAPI': 65535.0,
+	'auto_review': True,
+	# Normal mode only: the cells of all the images are picked first, then the images are analysed by the batch mode in the background
+	# (headless Fiji with the parameters saved in Results/<folder>_params.json and "workers" processes)
+	'pick_first': False,
+	# Segmentation of the nuclei on the DAPI channel binned 2x2 or 4x4 (1: full resolution), for large images. segmentation_check 
+	# segments every image also at full resolution and uses that mask if the intersection over union is below segmentation_min_iou.
+	# On the synthetic images of FociMF_Benchmark.py (--images 2 --segmentation 2,4) the intersection over union with the full 
+	# resolution is 0.96-1.00 binned 2x2 and 0.93-1.00 binned 4x4. 4x4 is 25-45% faster for 1024 and 2048 pixels, 2x2 at most 20%
+	# (Subtract Background shrinks the image by itself). The watershed always runs at full resolution.
+	'segmentation_bin': 1,
+	'segmentation_check': False,
+	'segmentation_min_iou': 0.9,
+	# Tiled mode for whole-slide and mosaic images: images larger than tile_size pixels (width or height) are read tile by tile with 
+	# tile_overlap pixels of overlap, which has to be larger than the largest nucleus (0: the whole image is read at once).
+	# The cells of tiled images are always picked automatically (auto_... limits) and are not reviewed.
+	'tile_size': 0,
+	'tile_overlap': 200,
+	# Multi-position files: 'first' analyses the first series only, 'all' every scene or position as an image of its own <image>_S<n>
+	'series': 'first',
+	# Z-stacks: 'first' analyses the first Z plane, 'max' the maximum intensity projection of all the planes (read plane by plane)
+	'z_projection': 'first',
+	# Time-lapse images: 'first' analyses the first time point, 'all' every time point as an image of its own <image>_T<n>. The cells 
+	# are picked at the first time point and tracked to the next ones (the nearest nucleus at most track_distance um away). Not with tile_size.
+	'timepoints': 'first',
+	'track_distance': 5.0,
+}
+
+def batchArguments():
+	# Returns the parameter file and the directory of the images for the batch mode or (None, None) for the normal mode.
+	# They are taken from the command line (script.py params.json /path/to/images) or from the environment variables 
+	# FOCI_PARAMS and FOCI_DIR, e.g. FOCI_PARAMS=params.json FOCI_DIR=/path/to/images ImageJ-linux64 --headless --run script.py
+	args = getattr(sys, 'argv', [])[1:]
+	if len(args) >= 2:
+		return args[0], args[1]
+	param_file = os.environ.get('FOCI_PARAMS')
+	if param_file:
+		return param_file, os.environ.get('FOCI_DIR', os.path.dirname(param_file))
+	return None, None
+
+def loadParams(param_file):
+	# Reads the parameters of the analysis from a .json or .yaml file and completes them with the defaults
+	with open(param_file, 'r') as f:
+		text = f.read()
+	if param_file.endswith('.yaml') or param_file.endswith('.yml'):
+		# SnakeYAML is shipped with Fiji, PyYAML is not available in Jython
+		from org.yaml.snakeyaml import Yaml
+		loaded = dict(Yaml().load(text) or {})
+	else:
+		loaded = json.loads(text)
+	unknown = [key for key in loaded if key not in DEFAULT_PARAMS]
+	if unknown:
+		raise ValueError('Unknown parameters in ' + param_file + ': ' + ', '.join(sorted(unknown)))
+	params = dict(DEFAULT_PARAMS)
+	params.update(loaded)
+	if params['image_type'] not in ('.czi', '.zvi'):
+		raise ValueError('image_type has to be .czi or .zvi')
+	if params['results_store'] not in ('', 'parquet'):
+		raise ValueError('results_store has to be "" (CSV files) or "parquet"')
+	if params['cell_images'] not in ('all', 'sampled', 'montage', 'none'):
+		raise ValueError('cell_images has to be all, sampled, montage or none')
+	if params['cell_area'] not in ('roi', 'legacy'):
+		raise ValueError('cell_area has to be roi or legacy')
+	if params['picking'] not in ('manual', 'auto'):
+		raise ValueError('picking has to be manual or auto')
+	if int(params['segmentation_bin']) not in (1, 2, 4):
+		raise ValueError('segmentation_bin has to be 1, 2 or 4')
+	if params['series'] not in ('first', 'all'):
+		raise ValueError('series has to be first or all')
+	if params['z_projection'] not in ('first', 'max'):
+		raise ValueError('z_projection has to be first or max')
+	if params['timepoints'] not in ('first', 'all'):
+		raise ValueError('timepoints has to be first or all')
+	if int(params['worker_memory']) < 0:
+		raise ValueError('worker_memory has to be 0 (automatic) or the heap of a worker in MB')
+	if int(params['tile_size']) > 0 and int(params['tile_size']) <= int(params['tile_overlap']):
+		raise ValueError('tile_size has to be larger than tile_overlap')
+	if int(params['tile_size']) > 0 and params['timepoints'] == 'all':
+		raise ValueError('The cells are tracked on whole images (Track_Timepoints), tile_size has to be 0 with timepoints all')
+	# lists of YAML files are Java lists
+	params['sweep_noise'] = [float(value) for value in params['sweep_noise']]
+	params['sweep_threshold'] = [float(value) for value in params['sweep_threshold']]
+	if Sweep_Mode(params) and int(params['tile_size']) > 0:
+		raise ValueError('The sweep mode reads whole images, tile_size has to be 0')
+	# The batch mode never picks cells, it always reevaluates the saved ROI managers
+	params['RoiManHave'] = True
+	params['TumorAnalysis'] = False
+	params['pick_first'] = False
+	return params
+
+def readROIs(ROIopenpath):
+	# Reads the ROIs of a saved ROI manager (.zip) without creating the ROI manager window
+	ROIs = []
+	zf = ZipFile(ROIopenpath)
+	try:
+		entries = zf.entries()
+		while entries.hasMoreElements():
+			entry = entries.nextElement()
+			name = entry.getName()
+			if not name.endswith('.roi'):
+				continue
+			stream = zf.getInputStream(entry)
+			out = ByteArrayOutputStream()
+			buf = zeros(8192, 'b')
+			n = stream.read(buf)
+			while n > 0:
+				out.write(buf, 0, n)
+				n = stream.read(buf)
+			stream.close()
+			roi = RoiDecoder(out.toByteArray(), name).getRoi()
+			if roi is None:
+				continue
+			if not roi.getName():
+				roi.setName(name[:-4])
+			ROIs.append(roi)
+	finally:
+		zf.close()
+	return ROIs
+
+def saveROIs(ROIs, ROIsavepath):
+	# Writes the ROIs as a ROI manager (.zip) without creating the ROI manager window, the reverse of readROIs
+	zos = ZipOutputStream(BufferedOutputStream(FileOutputStream(ROIsavepath)))
+	try:
+		out = DataOutputStream(zos)
+		encoder = RoiEncoder(out)
+		for ROI in ROIs:
+			zos.putNextEntry(ZipEntry(ROI.getName() + '.roi'))
+			encoder.write(ROI)
+			out.flush()
+	finally:
+		zos.close()
+
+def Open_Channels(filename, params, region=None):
+	# Opens the first two channels (DAPI and GFP) of the series of the image (Image_File) split, the other channels and series are 
+	# not read at all. If region (java.awt.Rectangle) is given, Bio-Formats reads only this part of the image.
+	# Z-stacks and time-lapse images are read plane by plane (Open_Planes).
+	if params['z_projection'] == 'max' or params['timepoints'] == 'all':
+		return Open_Planes(filename, params, region)
+	path, series = Image_File(filename)
+	options = ImporterOptions()
+	options.setId(path)
+	options.setSplitChannels(True)
+	if series:
+		options.clearSeries()
+		options.setSeriesOn(series, True)
+	options.setCBegin(series, 0)
+	options.setCEnd(series, 1)
+	if region is not None:
+		options.setCrop(True)
+		options.setCropRegion(series, Region(region.x, region.y, region.width, region.height))
+	return BF.openImagePlus(options)
+
+# Rows of the strips that Plane_Ranges reads at a time
+STRIP_ROWS = 512
+
+def Open_Planes(filename, params, region=None):
+	# Reads the DAPI and GFP channels of the time point of the image (Image_Timepoint) plane by plane with one reader: the maximum 
+	# intensity projection of all the Z planes (z_projection 'max') or the first plane. Only two planes are in the heap at a time, 
+	# the hyperstack is never opened. The pixel size is taken from the metadata as by the importer of Open_Channels (Plane_Calibration).
+	path, series = Image_File(filename)
+	timepoint = Image_Timepoint(filename)
+	reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+	meta = MetadataTools.createOMEXMLMetadata()
+	reader.setMetadataStore(meta)
+	try:
+		reader.setId(path)
+		reader.setSeries(series)
+		if region is None:
+			region = Rectangle(0, 0, reader.getSizeX(), reader.getSizeY())
+		if params['z_projection'] == 'max':
+			planes = range(reader.getSizeZ())
+		else:
+			planes = [0]
+		calibration = Plane_Calibration(meta, series)
+		imps = []
+		for channel in (0, 1):
+			projection = None
+			for z in planes:
+				ip = reader.openProcessors(reader.getIndex(z, channel, timepoint), region.x, region.y, region.width, region.height)[0]
+				if projection is None:
+					projection = ip
+				else:
+					projection.copyBits(ip, 0, 0, Blitter.MAX)
+			imp = ImagePlus(os.path.basename(filename) + ' - C=' + str(channel), projection)
+			if calibration is not None:
+				imp.setCalibration(calibration.copy())
+			imps.append(imp)
+		return imps
+	finally:
+		reader.close()
+
+def Plane_Calibration(meta, series):
+	# Calibration with the physical pixel size (microns) of the series from the metadata of the reader, None if it is not known
+	width = meta.getPixelsPhysicalSizeX(series)
+	height = meta.getPixelsPhysicalSizeY(series)
+	if width is None or width.value(UNITS.MICROMETER) is None:
+		return None
+	calibration = Calibration()
+	calibration.pixelWidth = width.value(UNITS.MICROMETER).doubleValue()
+	if height is not None and height.value(UNITS.MICROMETER) is not None:
+		calibration.pixelHeight = height.value(UNITS.MICROMETER).doubleValue()
+	else:
+		calibration.pixelHeight = calibration.pixelWidth
+	calibration.setUnit("micron")
+	return calibration
+
+def Plane_Ranges(filename, params):
+	# Minimum and maximum of the DAPI and GFP channels (in the order of Open_Channels) of the whole plane, the projection of the Z planes 
+	# with z_projection 'max'. The plane is read in strips of STRIP_ROWS rows, only one strip is in the heap at a time.
+	path, series = Image_File(filename)
+	timepoint = Image_Timepoint(filename)
+	reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+	try:
+		reader.setId(path)
+		reader.setSeries(series)
+		width, height = reader.getSizeX(), reader.getSizeY()
+		if params['z_projection'] == 'max':
+			planes = range(reader.getSizeZ())
+		else:
+			planes = [0]
+		ranges = []
+		for channel in (0, 1):
+			low = None
+			high = None
+			for y in range(0, height, STRIP_ROWS):
+				projection = None
+				for z in planes:
+					ip = reader.openProcessors(reader.getIndex(z, channel, timepoint), 0, y, width, min(STRIP_ROWS, height - y))[0]
+					if projection is None:
+						projection = ip
+					else:
+						projection.copyBits(ip, 0, 0, Blitter.MAX)
+				stats = projection.getStatistics()
+				low = stats.min if low is None else min(low, stats.min)
+				high = stats.max if high is None else max(high, stats.max)
+			ranges.append((low, high))
+		return ranges
+	finally:
+		reader.close()
+
+def Image_File(filename):
+	# File and series of an image: the position of a multi-position file (series_units) or the first series of the file
+	return series_units.get(filename, (filename, 0, 0))[:2]
+
+def Image_Timepoint(filename):
+	# Time point of an image: the time point of a time-lapse image (series_units) or the first one
+	return series_units.get(filename, (filename, 0, 0))[2]
+
+def Image_Series(filename):
+	# Series of the file with at least two channels (the scenes or positions) and their number of time points. The resolutions of a
+	# pyramid and the RGB label and overview images are left out. The series are numbered as in the Bio-Formats importer, where 
+	# every resolution is a series.
+	reader = ImageReader()
+	reader.setFlattenedResolutions(False)
+	try:
+		reader.setId(filename)
+		series = []
+		for k in range(reader.getSeriesCount()):
+			reader.setSeries(k)
+			if reader.getSizeC() >= 2 and not reader.isRGB():
+				series.append((reader.seriesToCoreIndex(k), reader.getSizeT()))
+		return series
+	finally:
+		reader.close()
+
+def Image_Units(workDir, params):
+	# The images to be analysed. With series 'all' every position of a multi-position file is an image of its own named 
+	# <image>_S<n> (the n-th position), with the ROI manager <image>_S<n>_ROI.zip and the results <image>_S<n>_results_... 
+	# With timepoints 'all' every time point of a time-lapse image is an image of its own <image>_T<n> (<image>_S<m>_T<n>).
+	# The file, series and time point of the images are kept in series_units, the files with one position and time point keep their name.
+	if params['series'] != 'all' and params['timepoints'] != 'all':
+		return workDir
+	units = []
+	for filename in workDir:
+		if params['series'] == 'all':
+			series = Image_Series(filename) or [(0, 1)]
+		else:
+			series = [(0, Image_Dimensions(filename)[3])]
+		if len(series) > 1:
+			print os.path.basename(filename) + ': ' + str(len(series)) + ' positions are analysed as separate images.'
+		stem, extension = os.path.splitext(filename)
+		for n, (k, timepoints) in enumerate(series):
+			name = stem
+			if len(series) > 1:
+				name = name + '_S' + str(n + 1)
+			if params['timepoints'] != 'all':
+				timepoints = 1
+			for t in range(timepoints):
+				unit = name
+				if timepoints > 1:
+					unit = unit + '_T' + str(t + 1)
+				unit = unit + extension
+				if unit != filename or k:
+					series_units[unit] = (filename, k, t)
+				units.append(unit)
+	return units
+
+def Previous_Timepoint(filename):
+	# The image of the previous time point of a time-lapse image (<image>_T<n-1> of <image>_T<n>), None for the first time point
+	timepoint = Image_Timepoint(filename)
+	if not timepoint:
+		return None
+	stem, extension = os.path.splitext(filename)
+	return stem[:-len('_T' + str(timepoint + 1))] + '_T' + str(timepoint) + extension
+
+def ROI_Zip(filename):
+	# Saved ROI manager of an image
+	return os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] + "_ROI.zip")
+
+def Roi_Centre(ROI):
+	# Centre of the bounding box of a ROI
+	bounds = ROI.getBounds()
+	return bounds.x + bounds.width / 2.0, bounds.y + bounds.height / 2.0
+
+def Track_Cells(ROIs, Mask, max_distance):
+	# Links every cell of the previous time point to the nearest object of the segmentation (Cell_Segmentation) of this time point 
+	# (centres at most max_distance pixels apart), the closest pairs first so that every object follows one cell.
+	# Returns the objects of the linked cells with the names of the cells, the cells without an object are lost from this time point.
+	objects = Mask_Objects(Mask)
+	centres = [Roi_Centre(obj) for obj in objects]
+	grid = {}
+	for j, (x, y) in enumerate(centres):
+		grid.setdefault((int(x // max_distance), int(y // max_distance)), []).append(j)
+	pairs = []
+	for i, ROI in enumerate(ROIs):
+		x, y = Roi_Centre(ROI)
+		gx, gy = int(x // max_distance), int(y // max_distance)
+		for cx in (gx - 1, gx, gx + 1):
+			for cy in (gy - 1, gy, gy + 1):
+				for j in grid.get((cx, cy), []):
+					distance = math.hypot(centres[j][0] - x, centres[j][1] - y)
+					if distance <= max_distance:
+						pairs.append((distance, i, j))
+	pairs.sort()
+	linked = {}
+	used = set()
+	for distance, i, j in pairs:
+		if i in linked or j in used:
+			continue
+		linked[i] = j
+		used.add(j)
+	tracked = []
+	for i, ROI in enumerate(ROIs):
+		if i in linked:
+			obj = objects[linked[i]]
+			obj.setName(ROI.getName())
+			tracked.append(obj)
+	return tracked
+
+def Track_ROIs(filename, DAPI, params):
+	# ROI manager of a later time point of a time-lapse image: the cells of the ROI manager of the previous time point tracked to this
+	# time point (Track_Cells), saved as <image>_T<n>_ROI.zip. Returns the tracked cells, none if the previous time point has no 
+	# ROI manager (no cells were picked or tracked there).
+	previous = ROI_Zip(Previous_Timepoint(filename))
+	if not os.path.isfile(previous):
+		print os.path.basename(filename) + ': no ROI manager of the previous time point, no cells are tracked.'
+		return []
+	Mask = Cell_Segmentation(DAPI, int(params['segmentation_bin']))
+	ROIs = Track_Cells(readROIs(previous), Mask, float(params['track_distance']) / float(params['pixel_size']))
+	Mask.close()
+	print os.path.basename(filename) + ': ' + str(len(ROIs)) + ' cells tracked from the previous time point.'
+	Save_Picked(ROIs, ROI_Zip(filename)[:-4])
+	return ROIs
+
+def Track_Timepoints(workDir, params):
+	# Makes the missing ROI managers of the later time points of the time-lapse images in workDir from the first time point,
+	# one time point after the other (Track_ROIs)
+	for filename in workDir:
+		previous = Previous_Timepoint(filename)
+		if previous is None or os.path.isfile(ROI_Zip(filename)) or not os.path.isfile(ROI_Zip(previous)):
+			continue
+		imps = Open_Channels(filename, params)
+		try:
+			DAPI, GFP = Split_Channels(filename, imps)
+			Track_ROIs(filename, DAPI, params)
+		finally:
+			for imp in imps:
+				imp.close()
+
+def ROIs_Bounds(ROIs):
+	# Smallest rectangle with all the ROIs, None without ROIs (an empty ROI manager)
+	if not ROIs:
+		return None
+	bounds = Rectangle(ROIs[0].getBounds())
+	for ROI in ROIs[1:]:
+		bounds.add(ROI.getBounds())
+	return bounds
+
+def ROIs_Clusters(ROIs):
+	# Rectangles that are read for the ROIs by crop_to_rois: the bounding boxes of the ROIs, two rectangles are merged if they 
+	# intersect or if the rectangle with both has no more pixels than the two together
+	clusters = [Rectangle(ROI.getBounds()) for ROI in ROIs]
+	merged = True
+	while merged:
+		merged = False
+		for i in range(len(clusters)):
+			for j in range(i + 1, len(clusters)):
+				a, b = clusters[i], clusters[j]
+				union = a.union(b)
+				if a.intersects(b) or union.width * union.height <= a.width * a.height + b.width * b.height:
+					clusters[i] = union
+					del clusters[j]
+					merged = True
+					break
+			if merged:
+				break
+	return clusters
+
+def Open_Clusters(filename, params, region, clusters):
+	# Opens the DAPI and GFP channels of region (ROIs_Bounds) with only the pixels of the clusters (ROIs_Clusters) read, the rest of 
+	# region is 0. Every cell is cropped from its bounding box (Crop_Cell), which is inside one cluster.
+	if len(clusters) == 1:
+		return Open_Channels(filename, params, region)
+	imps = None
+	for cluster in clusters:
+		parts = Open_Channels(filename, params, cluster)
+		if imps is None:
+			# the first cluster gives the titles and the calibration, its pixels go to the processors of the whole region
+			imps = parts
+			canvases = [imp.getProcessor().createProcessor(region.width, region.height) for imp in imps]
+		for canvas, part in zip(canvases, parts):
+			canvas.insert(part.getProcessor(), cluster.x - region.x, cluster.y - region.y)
+		if parts is not imps:
+			for part in parts:
+				part.close()
+	for imp, canvas in zip(imps, canvases):
+		imp.setProcessor(canvas)
+	return imps
+
+def Image_Size(filename):
+	# Width and height of the series of the image (Image_File) from the metadata, no pixels are read
+	return Image_Dimensions(filename)[:2]
+
+def Image_Dimensions(filename):
+	# Width, height, number of Z planes and of time points of the series of the image (Image_File) from the metadata
+	path, series = Image_File(filename)
+	reader = ImageReader()
+	try:
+		reader.setId(path)
+		reader.setSeries(series)
+		return reader.getSizeX(), reader.getSizeY(), reader.getSizeZ(), reader.getSizeT()
+	finally:
+		reader.close()
+
+def Tiled_Size(filename, params):
+	# Size of the image (java.awt.Rectangle) if it is analysed tile by tile (larger than tile_size), otherwise None
+	if int(params['tile_size']) <= 0:
+		return None
+	width, height = Image_Size(filename)
+	if max(width, height) <= int(params['tile_size']):
+		return None
+	return Rectangle(0, 0, width, height)
+
+def Tiles(size, params):
+	# Tiles of the image row by row as (region, core): the cores of tile_size x tile_size pixels cover the image without overlap,
+	# the regions that are read are the cores with tile_overlap pixels on every side (within the image)
+	step = int(params['tile_size'])
+	overlap = int(params['tile_overlap'])
+	tiles = []
+	for y in range(0, size.height, step):
+		for x in range(0, size.width, step):
+			core = Rectangle(x, y, min(step, size.width - x), min(step, size.height - y))
+			region = Rectangle(core)
+			region.grow(overlap, overlap)
+			tiles.append((region.intersection(size), core))
+	return tiles
+
+def Tile_Index(ROI, size, params):
+	# Index of the tile whose core has the centre of the bounding box of the ROI. Every cell belongs to one tile: if tile_overlap 
+	# is larger than the cell, the whole cell is in the region of this tile and the parts of the cell cut by the border of the region
+	# of another tile have their centre outside its core.
+	bounds = ROI.getBounds()
+	step = int(params['tile_size'])
+	columns = (size.width + step - 1) // step
+	x = min(max(int(math.floor(bounds.x + bounds.width / 2.0)), 0), size.width - 1)
+	y = min(max(int(math.floor(bounds.y + bounds.height / 2.0)), 0), size.height - 1)
+	return (y // step) * columns + x // step
+
+def Scan_Tiles(filename, size, params, background, pick):
+	# First pass over the tiles of a tiled image, one tile in the heap at a time. Returns the display ranges of the channels of the whole
+	# image (Clear_Range), the maximum of the foci channel, the sum and number of the pixels of the foci channel outside the cells in the
+	# cores (Background_Sum, with background) and the automatically picked cells in the coordinates of the image (with pick).
+	# A cell is picked in the tile whose core has the centre of the cell (Tile_Index), so the cells in the overlap are picked once.
+	tiles = Tiles(size, params)
+	clear_ranges = None
+	foci_max = 0
+	total = 0.0
+	count = 0
+	ROIs = []
+	names = set()
+	for k, (region, core) in enumerate(tiles):
+		start = System.nanoTime()
+		imps = Open_Channels(filename, params, region)
+		profile.record('load', start, filename)
+		try:
+			ranges = [Clear_Range(imp) for imp in imps]
+			if clear_ranges is None:
+				clear_ranges = ranges
+			else:
+				clear_ranges = [(min(a[0], b[0]), max(a[1], b[1])) for a, b in zip(clear_ranges, ranges)]
+			DAPI, GFP = Split_Channels(filename, imps)
+			foci_max = max(foci_max, ranges[list(imps).index(GFP)][1])
+			DAPI8 = None
+			if background:
+				start = System.nanoTime()
+				DAPI8 = DAPI_8bit(DAPI)
+				tile_total, tile_count = Background_Sum(DAPI8, GFP, Rectangle(core.x - region.x, core.y - region.y, core.width, core.height))
+				total = total + tile_total
+				count = count + tile_count
+				profile.record('ThresholdEst', start, filename)
+			if pick:
+				start = System.nanoTime()
+				factor = int(params['segmentation_bin'])
+				Cell_Map = Cell_Segmentation(DAPI8 or DAPI, factor)
+				if factor > 1 and params['segmentation_check'] == True:
+					Cell_Map = Segmentation_Check(filename, DAPI8 or DAPI, Cell_Map, factor, params)
+				profile.record('Cell_Segmentation', start, filename)
+				start = System.nanoTime()
+				for ROI in Auto_Pick_Cells(Cell_Map, DAPI, params):
+					bounds = ROI.getBounds()
+					ROI.setLocation(bounds.x + region.x, bounds.y + region.y)
+					if Tile_Index(ROI, size, params) != k:
+						continue
+					# named like in the ROI manager (centre y-x), a number is added to the same names
+					bounds = ROI.getBounds()
+					name = '%04d-%04d' % (bounds.y + bounds.height // 2, bounds.x + bounds.width // 2)
+					unique = name
+					n = 1
+					while unique in names:
+						unique = name + '-' + str(n)
+						n = n + 1
+					names.add(unique)
+					ROI.setName(unique)
+					ROIs.append(ROI)
+				Cell_Map.close()
+				profile.record('picking', start, filename)
+			if DAPI8 is not None:
+				DAPI8.close()
+		finally:
+			for imp in imps:
+				imp.close()
+		print 'Tile ' + str(k + 1) + ' of ' + str(len(tiles)) + ' of ' + os.path.basename(filename) + ' read.'
+	return clear_ranges, foci_max, total, count, ROIs
+
+def Tile_Cells(filename, size, ROIs, params):
+	# Second pass over the tiles of a tiled image: yields (imps, ROI) for all the cells, tile by tile. Only the bounding box of the 
+	# cells of one tile is read, the ROIs are moved to its coordinates.
+	groups = {}
+	for ROI in ROIs:
+		groups.setdefault(Tile_Index(ROI, size, params), []).append(ROI)
+	for k in sorted(groups):
+		region = ROIs_Bounds(groups[k])
+		start = System.nanoTime()
+		imps = Open_Channels(filename, params, region)
+		profile.record('load', start, filename)
+		try:
+			for ROI in groups[k]:
+				bounds = ROI.getBounds()
+				ROI.setLocation(bounds.x - region.x, bounds.y - region.y)
+				yield imps, ROI
+		finally:
+			for imp in imps:
+				imp.close()
+
+def Save_Picked(ROIs, ROIsavepath):
+	# Saves the automatically picked cells of a tiled image as ROI manager
+	if ROIs:
+		saveROIs(ROIs, ROIsavepath + ".zip")
+	else:
+		print 'No cells were picked in ' + os.path.basename(ROIsavepath)[:-4] + ', no ROI manager is saved.'
+
+def runWorkers(param_file, AnalysisDir, workDir, params):
+	# Splits the images between params['workers'] headless Fiji processes, waits for them and merges their CSV files
+	fiji = params['fiji_executable'] or System.getProperty('ij.executable')
+	script = params['script_path'] or getattr(sys, 'argv', [''])[0]
+	if not fiji or not script or not os.path.isfile(script):
+		raise ValueError('The parallel batch mode needs fiji_executable and script_path in the parameter file')
+	resultpath2 = os.path.normpath(os.path.join(AnalysisDir, "Results"))
+	if not (createDir(resultpath2) and createDir(os.path.join(AnalysisDir, "Analysed_cells"))):
+		return 0
+	command = [fiji, '--headless', '--console', '--run', script]
+	memory = Worker_Memory(params)
+	if memory > 0:
+		command.insert(1, '--mem=' + str(memory) + 'm')
+	workers = []
+	for k in range(min(int(params['workers']), len(workDir))):
+		env = dict(os.environ)
+		env['FOCI_PARAMS'] = param_file
+		env['FOCI_DIR'] = AnalysisDir
+		# every worker gets every n-th image so that the big and small images are distributed evenly
+		env['FOCI_IMAGES'] = os.pathsep.join(workDir[k::int(params['workers'])])
+		# the positions of multi-position files are distributed like images, the worker gets their file and series
+		env['FOCI_SERIES'] = json.dumps(dict((unit, series_units[unit]) for unit in workDir[k::int(params['workers'])] if unit in series_units))
+		env['FOCI_MANIFEST'] = os.path.join(resultpath2, '.worker_' + str(k) + '_csv.txt')
+		env['FOCI_WORKER'] = str(k)
+		if os.path.isfile(env['FOCI_MANIFEST']):
+			os.remove(env['FOCI_MANIFEST'])
+		workers.append((subprocess.Popen(command, env=env), env['FOCI_MANIFEST']))
+	print 'Batch mode: ' + str(len(workDir)) + ' images (positions) analysed by ' + str(len(workers)) + ' workers.'
+	if memory > 0:
+		print 'Maximum heap of every worker: ' + str(memory) + ' MB.'
 	
+	nameCSVs = []
+	for worker, manifest in workers:
+		if worker.wait() != 0:
+			print 'A worker finished with an error, see its output above.'
+		if os.path.isfile(manifest):
+			with open(manifest, 'r') as f:
+				nameCSVs.extend([line.strip() for line in f if line.strip()])
+			os.remove(manifest)
+	mergeCSVs(sorted(nameCSVs), Merged_Name(AnalysisDir, params))
+	return nameCSVs
+
+def Worker_Memory(params):
+	# Maximum heap of a worker in MB: worker_memory or three quarters of the physical memory shared by the workers 
+	# (0 if the physical memory is not known, the workers then get the default heap of the Fiji launcher)
+	if int(params['worker_memory']) > 0:
+		return int(params['worker_memory'])
+	try:
+		physical = ManagementFactory.getOperatingSystemMXBean().getTotalPhysicalMemorySize()
+	except:
+		return 0
+	return int(physical * 3 / 4 / 1048576 / max(int(params['workers']), 1))
+
+def Merged_Name(AnalysisDir, params):
+	# CSV file with the results of all the images (or with all the combinations of the sweep mode)
+	if Sweep_Mode(params):
+		kind = '_sweep_MaxFind_merged.csv'
+	else:
+		kind = '_results_MaxFind_merged.csv'
+	return os.path.join(AnalysisDir, "Results", os.path.basename(os.path.normpath(AnalysisDir)) + kind)
+
+def mergeCSVs(nameCSVs, nameMerged):
+	# Writes the results of all the images in one CSV file with an additional column with the name of the image
+	with open(nameMerged, 'wb') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		header = False
+		for nameCSV in nameCSVs:
+			image = os.path.basename(nameCSV).split('_results_MaxFind_')[0].split('_sweep_MaxFind')[0]
+			with open(nameCSV, 'rb') as f:
+				rows = csv.reader(f, delimiter=',', quotechar='|')
+				row = next(rows, None)
+				if row is None:
+					continue
+				if not header:
+					spamwriter.writerow(['Image'] + row)
+					header = True
+				for row in rows:
+					spamwriter.writerow([image] + row)
+
+def runBatch(param_file, AnalysisDir):
+	# Analyses all the images in AnalysisDir that have a saved ROI manager without any dialog or window
+	params = loadParams(param_file)
+	Interpreter.batchMode = True
+	if os.environ.get('FOCI_IMAGES'):
+		# this is one of the workers started by runWorkers
+		workDir = os.environ['FOCI_IMAGES'].split(os.pathsep)
+		for unit, described in json.loads(os.environ.get('FOCI_SERIES', '{}')).items():
+			series_units[unit] = tuple(described)
+	else:
+		workDir = Image_Units(sorted(glob.glob(os.path.join(AnalysisDir, '*' + params['image_type']))), params)
+		print 'Batch mode: parameters from ' + param_file + ', images from ' + AnalysisDir
+		if int(params['workers']) > 1:
+			# the time points are tracked before the workers analyse them independently
+			Track_Timepoints(workDir, params)
+			nameCSVs = runWorkers(param_file, AnalysisDir, workDir, params)
+			Store_Results(AnalysisDir, nameCSVs, params)
+			return nameCSVs
+	nameCSVs = AnalyseFolder(AnalysisDir, workDir, params)
+	if nameCSVs and os.environ.get('FOCI_MANIFEST'):
+		with open(os.environ['FOCI_MANIFEST'], 'w') as f:
+			f.write('\n'.join(nameCSVs) + '\n')
+	elif nameCSVs:
+		# the results of all the images (all the combinations in the sweep mode) in one table, as with several workers
+		mergeCSVs(sorted(nameCSVs), Merged_Name(AnalysisDir, params))
+		Store_Results(AnalysisDir, nameCSVs, params)
+	return nameCSVs
+
+def Store_Results(AnalysisDir, nameCSVs, params):
+	# Collects the results files of the run into the dataset Results/<folder>_results.parquet (see FociMF_Store.py).
+	# Jython can not write Parquet, so FociMF_Store.py (next to this script) runs in CPython.
+	if params['results_store'] != 'parquet' or not nameCSVs or Sweep_Mode(params):
+		return
+	resultpath2 = os.path.normpath(os.path.join(AnalysisDir, "Results"))
+	store = os.path.join(os.path.dirname(params['script_path'] or getattr(sys, 'argv', [''])[0]), 'FociMF_Store.py')
+	if not os.path.isfile(store):
+		print 'FociMF_Store.py was not found next to this script (script_path), the results are only in the CSV files.'
+		return
+	listCSV = os.path.join(resultpath2, '.store_csv.txt')
+	with open(listCSV, 'w') as f:
+		f.write('\n'.join(sorted(nameCSVs)) + '\n')
+	try:
+		if subprocess.call([params['python_executable'], store, 'import', resultpath2, '--list', listCSV]) != 0:
+			print 'The results could not be written to the dataset, they are only in the CSV files.'
+	finally:
+		os.remove(listCSV)
+
+def PickFolder(workDir, params):
+	# First phase of pick_first: segmentation and picking of the cells of all the images, the ROI managers are saved as <image>_ROI.zip 
+	# and nothing is measured. Returns the number of images with picked cells.
+	global profile
+	profile = Profile()
+	rm = RoiManager.getInstance()
+	if not rm:
+		rm = RoiManager()
+	picked = 0
+	for k, filename in enumerate(workDir):
+		print 'Picking the cells of image ' + str(k + 1) + ' of ' + str(len(workDir)) + ': ' + os.path.basename(filename)
+		try: 
+			IJ.run("Close All", "")
+		except:
+			pass
+		resultpathROI = os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] +"_ROI")
+		size = Tiled_Size(filename, params)
+		if size is not None:
+			Save_Picked(Scan_Tiles(filename, size, params, False, True)[4], resultpathROI)
+			if os.path.isfile(resultpathROI + ".zip"):
+				picked = picked + 1
+			continue
+		imps = Open_Channels(filename, params)
+		try:
+			DAPI, GFP = Split_Channels(filename, imps)
+			if Previous_Timepoint(filename) is not None:
+				# the later time points are not picked, the cells of the previous time point are tracked
+				Track_ROIs(filename, DAPI, params)
+			else:
+				rm.reset()
+				rm = Pick_Image(filename, DAPI, rm, resultpathROI, params)
+			if os.path.isfile(resultpathROI + ".zip"):
+				picked = picked + 1
+		finally:
+			for imp in imps:
+				imp.close()
+	rm.reset()
+	return picked
+
+def Script_Path(params):
+	# Path of this script for the headless Fiji processes: script_path, the command line or asked from the user
+	script = params['script_path'] or getattr(sys, 'argv', [''])[0]
+	if script and os.path.isfile(script):
+		return script
+	return IJ.getFilePath('Where is this script (20210126 FociMF_ThresholdAuto.py)? It is needed for the analysis in the background.')
+
+def Launch_Analysis(AnalysisDir, params):
+	# Second phase of pick_first: saves the parameters for the batch mode in Results/<folder>_params.json and starts the batch mode 
+	# with them in a headless Fiji process that is not waited for (with workers > 1 it starts the workers itself).
+	# Its output goes to Results/<folder>_analysis.log. Returns the parameter file and the log file or None if Fiji could not be started.
+	resultpath2 = os.path.normpath(os.path.join(AnalysisDir, "Results"))
+	if not createDir(resultpath2):
+		return None
+	folder = os.path.basename(os.path.normpath(AnalysisDir))
+	fiji = params['fiji_executable'] or System.getProperty('ij.executable')
+	script = Script_Path(params)
+	batch = dict((key, params[key]) for key in DEFAULT_PARAMS)
+	batch['RoiManHave'] = True
+	batch['TumorAnalysis'] = False
+	batch['pick_first'] = False
+	batch['fiji_executable'] = fiji or ''
+	batch['script_path'] = script or ''
+	param_file = os.path.join(resultpath2, folder + '_params.json')
+	with open(param_file, 'w') as f:
+		json.dump(batch, f, indent=1, sort_keys=True)
+	if not fiji or not script:
+		print 'Fiji or this script was not found, start the analysis with: ImageJ --headless --run <this script> ' + param_file + ' ' + AnalysisDir
+		return None
+	log = os.path.join(resultpath2, folder + '_analysis.log')
+	builder = ProcessBuilder([fiji, '--headless', '--console', '--run', script])
+	builder.environment().put('FOCI_PARAMS', param_file)
+	builder.environment().put('FOCI_DIR', AnalysisDir)
+	builder.redirectErrorStream(True)
+	builder.redirectOutput(File(log))
+	builder.start()
+	return param_file, log
+
+def Sweep_Mode(params):
+	# The sweep mode evaluates several noise tolerances or thresholds at once (see SweepImage)
+	return len(params['sweep_noise']) > 0 or len(params['sweep_threshold']) > 0
+
 ##############################################################################################################################################
 ######################################################## MAIN FUNCTION #######################################################################
 ##############################################################################################################################################
 
-def main():
+def createDir(path):
+	# Creates the directory if it does not exist yet. Returns False if it could not be created.
+	path = os.path.normpath(path)
+	if not os.path.isdir(path):
+		try:
+			os.mkdir(path)
+		except:
+			return False
+	return True
+
+def askParams():
 	#################################### Welcome message and choise of parameters of analysis ################################################
-	# Definition of global variables
-	global threshold
-	global noise_tolerance
-	global TresSelect
-	global RoiManHave
-	global sigma_foci
-	global Gaussian_blur_use
+	params = dict(DEFAULT_PARAMS)
 	
 	#First script's dialog about microscope and pixel calibration
 	font = Font("Arial", Font.BOLD, 14)
@@ -285,22 +1675,59 @@ def main():
 	gd.addMessage("If you already have the ROI manager then check the next box.",font)		
 	gd.setInsets(5,40,5)
 	gd.addCheckbox("I already have the ROI manager saved and I want to analyse these cells again.", False)	
+	gd.addMessage("The cells can be picked automatically from the segmentation instead of the flood-fill (you can check them before the analysis).",font)
+	gd.setInsets(5,40,5)
+	gd.addCheckbox("I want the cells to be picked automatically.", False)
+	gd.addMessage("The cells of all the images can be picked first. They are then analysed in the background by headless Fiji processes.",font)
+	gd.setInsets(5,40,5)
+	gd.addCheckbox("I want to pick the cells of all the images first and analyse them afterwards.", False)
+	gd.setInsets(10,40,10)
+	gd.addNumericField("Number of Fiji processes for the analysis", 1, 0)
+	gd.addMessage("Large images can be segmented faster on the binned DAPI channel (only the borders of the nuclei at full resolution).",font)
+	gd.setInsets(10,40,10)
+	gd.addChoice("Binning of the segmentation", ["1", "2", "4"], "1")
+	gd.addMessage("Whole-slide and mosaic images larger than the tile size are read and analysed tile by tile (0: whole images).",font)
+	gd.setInsets(10,40,10)
+	gd.addNumericField("Tile size (pixels)", 0, 0)
+	gd.addMessage("Every scene or position of multi-position files can be analysed as an image of its own.",font)
+	gd.setInsets(5,40,5)
+	gd.addCheckbox("I want to analyse all the positions of multi-position files.", False)
+	gd.addMessage("Z-stacks can be projected (maximum intensity) and every time point of time-lapse images analysed (the cells are tracked).",font)
+	gd.setInsets(5,40,5)
+	gd.addCheckbox("I want to analyse the maximum intensity projection of Z-stacks.", False)
+	gd.setInsets(5,40,5)
+	gd.addCheckbox("I want to analyse all the time points of time-lapse images.", False)
 	gd.setCancelLabel("Exit")
 	gd.setOKLabel("Next step")
 	gd.showDialog()
 	if gd.wasCanceled(): 
-		return 0   
+		return None   
 	elif gd.wasOKed():
-		pixel_size = gd.getNextNumber()
-		pixel_cal = 1/pixel_size
-		pixel_cal = str(pixel_cal)
-		Gaussian_blur_use = gd.getNextBoolean()
-		sigma_foci = gd.getNextNumber()
-		sigma_foci = str(sigma_foci)
-		TumorAnalysis = gd.getNextBoolean()	
-		RoiManHave = gd.getNextBoolean()
-		if (RoiManHave == True and TumorAnalysis == True):
-			TumorAnalysis == False
+		params['pixel_size'] = gd.getNextNumber()
+		params['Gaussian_blur_use'] = gd.getNextBoolean()
+		params['sigma_foci'] = gd.getNextNumber()
+		params['TumorAnalysis'] = gd.getNextBoolean()	
+		params['RoiManHave'] = gd.getNextBoolean()
+		if gd.getNextBoolean():
+			params['picking'] = 'auto'
+		params['pick_first'] = gd.getNextBoolean()
+		params['workers'] = max(int(gd.getNextNumber()), 1)
+		params['segmentation_bin'] = int(gd.getNextChoice())
+		params['tile_size'] = max(int(gd.getNextNumber()), 0)
+		if gd.getNextBoolean():
+			params['series'] = 'all'
+		if gd.getNextBoolean():
+			params['z_projection'] = 'max'
+		if gd.getNextBoolean():
+			params['timepoints'] = 'all'
+		if (params['RoiManHave'] == True and params['TumorAnalysis'] == True):
+			params['TumorAnalysis'] == False
+		if int(params['tile_size']) > 0 and params['timepoints'] == 'all':
+			gd = GenericDialog("Error") 
+			gd.addMessage("The cells are tracked on whole images, all the time points can not be analysed tile by tile.\nRun the script again with the tile size 0.")
+			gd.hideCancelButton()	
+			gd.showDialog()
+			return None
 	
 	#Definition of noise tolerance and threshold
 	gd = GenericDialog("Noise toleracne and threshold")
@@ -324,13 +1751,13 @@ def main():
 	gd.setOKLabel("Next step")
 	gd.showDialog()
 	if gd.wasCanceled(): 
-		return 0   
+		return None   
 	elif gd.wasOKed():
-		noise_toler = gd.getNextNumber()
-		TresSelect = gd.getNextBoolean()		
-		manualTres = gd.getNextNumber()	
-		thres_a = gd.getNextNumber() # The "a" parameter of the used calibration threshold = a * MEAN + b.
-		thres_b = gd.getNextNumber() # The "b" parameter of the used calibration threshold = a * MEAN + b.		
+		params['noise_toler'] = gd.getNextNumber()
+		params['TresSelect'] = gd.getNextBoolean()		
+		params['manualTres'] = gd.getNextNumber()	
+		params['thres_a'] = gd.getNextNumber() # The "a" parameter of the used calibration threshold = a * MEAN + b.
+		params['thres_b'] = gd.getNextNumber() # The "b" parameter of the used calibration threshold = a * MEAN + b.		
 				
 	
 	#Definition of cell parameters		
@@ -345,10 +1772,45 @@ def main():
 	gd.setOKLabel("Next step")
 	gd.showDialog()
 	if gd.wasCanceled(): 
-		return 0   
+		return None   
 	elif gd.wasOKed():
-		Min_cellarea = gd.getNextNumber()
-		Max_cellarea = gd.getNextNumber()
+		params['Min_cellarea'] = gd.getNextNumber()
+		params['Max_cellarea'] = gd.getNextNumber()
+
+	#Limits of the automatic picking
+	if params['picking'] == 'auto' and params['RoiManHave'] == False:
+		gd = GenericDialog("Automatic picking of the cells")
+		gd.addMessage("Only the segmented objects within these limits are picked as cells.",font)
+		gd.setInsets(10,40,10)
+		gd.addNumericField("Smallest area (in squared um)", 15, 1)
+		gd.setInsets(10,40,10)
+		gd.addNumericField("Largest area (in squared um)", 300, 1)
+		gd.setInsets(10,40,10)
+		gd.addNumericField("Smallest solidity (area / area of the convex hull)", 0.9, 2)
+		gd.setInsets(10,40,10)
+		gd.addNumericField("Smallest circularity (4pi * area / perimeter^2)", 0.5, 2)
+		gd.setInsets(10,40,10)
+		gd.addNumericField("Smallest mean DAPI intensity", 0, 1)
+		gd.setInsets(10,40,10)
+		gd.addNumericField("Largest mean DAPI intensity", 65535, 1)
+		gd.setInsets(5,40,5)
+		gd.addCheckbox("Do not pick cells touching the border of the image", True)
+		gd.setInsets(5,40,5)
+		gd.addCheckbox("I want to check the picked cells before the analysis", True)
+		gd.setCancelLabel("Exit")
+		gd.setOKLabel("Next step")
+		gd.showDialog()
+		if gd.wasCanceled(): 
+			return None   
+		elif gd.wasOKed():
+			params['auto_min_area'] = gd.getNextNumber()
+			params['auto_max_area'] = gd.getNextNumber()
+			params['auto_min_solidity'] = gd.getNextNumber()
+			params['auto_min_circularity'] = gd.getNextNumber()
+			params['auto_min_DAPI'] = gd.getNextNumber()
+			params['auto_max_DAPI'] = gd.getNextNumber()
+			params['auto_exclude_border'] = gd.getNextBoolean()
+			params['auto_review'] = gd.getNextBoolean()
 
 	#Exclution criteria
 	gd = GenericDialog("Definition of exclusion criteria")
@@ -378,247 +1840,791 @@ def main():
 	gd.setOKLabel("Start calculating!")
 	gd.showDialog()
 	if gd.wasCanceled(): 
-		return 0   
+		return None   
 	elif gd.wasOKed():
-		ExclutionCriteria = gd.getNextBoolean()
-		zeroMax = gd.getNextNumber()	
-		zeroHom = gd.getNextNumber()
-		ExcluMean = gd.getNextNumber()
-		AreaAboveThres = gd.getNextNumber()
-		MaxFS = gd.getNextNumber()
-		DivideOEcells = gd.getNextBoolean()
-		HomoToDiv = gd.getNextNumber()
-		UserEstFociSize = gd.getNextNumber()
-		 
-	############################## Pick an image from a directory that you want to analyze ##################################################
+		params['ExclutionCriteria'] = gd.getNextBoolean()
+		params['zeroMax'] = gd.getNextNumber()	
+		params['zeroHom'] = gd.getNextNumber()
+		params['ExcluMean'] = gd.getNextNumber()
+		params['AreaAboveThres'] = gd.getNextNumber()
+		params['MaxFS'] = gd.getNextNumber()
+		params['DivideOEcells'] = gd.getNextBoolean()
+		params['HomoToDiv'] = gd.getNextNumber()
+		params['UserEstFociSize'] = gd.getNextNumber()
+	return params
+
+def AnalyseFolder(AnalysisDir, workDir, params):
+	# Analysis of all the images in workDir with the parameters of the analysis. Returns the list of the CSV files or 0 in case of an error.
+	# Definition of global variables used by the functions above
+	global sigma_foci
+	global Gaussian_blur_use
+	global profile
+	global background_cache
+	
+	Gaussian_blur_use = params['Gaussian_blur_use']
+	sigma_foci = str(params['sigma_foci'])
+	profile = Profile()
+	background_cache = Background_Cache(AnalysisDir, params)
 	
-	filename1 = IJ.getFilePath('Pick an image (.czi or .zvi) from the directory you want to analyze')	
-	if not filename1:
-		gd = GenericDialog("Error") 
-		gd.addMessage("An image was not picked. Run the script again and pick an image.")	
-		gd.hideCancelButton()	
-		gd.showDialog()
-		return 0
-	if not (filename1.endswith('.czi') or filename1.endswith('.zvi')): 
-		gd = GenericDialog("Error") 
-		gd.addMessage("File is not .czi neither .zvi. Run the script again and pick an image .czi or .zvi.")
-		gd.hideCancelButton()		
-		gd.showDialog()
-		return 0
-		
 	############################################ Definition of direcories ##################################################################
 	
-	# Τhe directory with images acquired with the same parameters	
-	AnalysisDir = os.path.dirname(filename1) 
 	# Creating directory to collect all the CSV files		
-	resultpath2 = os.path.join(os.path.dirname(filename1), "Results") 
-	resultpath2 = os.path.normpath(resultpath2)	
-	if not os.path.isdir(resultpath2):
-		try:
-			os.mkdir(resultpath2)
-		except:
-			return 0
+	resultpath2 = os.path.normpath(os.path.join(AnalysisDir, "Results"))
 	# Creating directory for saving the individual imeges of the cells	
-	Imagespath = os.path.join(os.path.dirname(filename1), "Analysed_cells") 
-	Imagespath = os.path.normpath(Imagespath)	
-	if not os.path.isdir(Imagespath):
-		try:
-			os.mkdir(Imagespath)
-		except:
-			return 0
-	
-	####################### Threshold establishment in case of manual and general threshold for one image in the directory #############
-	
-	if TresSelect == True:
-		threshold = manualTres
+	Imagespath = os.path.normpath(os.path.join(AnalysisDir, "Analysed_cells"))
+	if not (createDir(resultpath2) and createDir(Imagespath)):
+		return 0
+	# the saved ROI managers of the first time points of time-lapse images are tracked to the next time points
+	if params['RoiManHave'] == True:
+		Track_Timepoints(workDir, params)
 			
     ##################################################### MAIN ANALYSIS ###############################################################
 	
-	# Definition of the directory with the images to be analysed
-	if filename1.endswith('.czi'):
-		workDir = glob.glob(os.path.join(AnalysisDir,'*.czi'))
-		
-	else:
-		workDir = glob.glob(os.path.join(AnalysisDir,'*.zvi')) 
-	
 	NoImages = len(workDir) # number of images in the directory
 	print 'There are ' + str(NoImages) + ' images for analysis in this folder.'
 			
-	for filename in workDir: # Analysis of all the images in the chosen directory	
+	nameCSVs = []
+	# The images that were already analysed with the same ROI manager and parameters are taken from the cache
+	cache_dir = Cache_Dir(AnalysisDir, params)
+	cache_keys = {}
+	if cache_dir:
+		toAnalyse = []
+		for filename in workDir:
+			resultpathROI = os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] +"_ROI.zip")
+			if not os.path.isfile(resultpathROI):
+				toAnalyse.append(filename)
+				continue
+			start = System.nanoTime()
+			cache_keys[filename] = Cache_Key(filename, resultpathROI, params)
+			nameCSV = Cache_Restore(cache_dir, cache_keys[filename], resultpath2, params)
+			profile.record('cache', start, filename)
+			if nameCSV:
+				nameCSVs.append(nameCSV)
+				NoImages = NoImages - 1
+				print 'Results of ' + os.path.basename(filename) + ' taken from the cache.'
+			else:
+				toAnalyse.append(filename)
+		workDir = toAnalyse
+	images = Prefetched_Images(workDir, params)
+	writer = Image_Writer(WRITE_QUEUE)
+	try:
+		for filename, loaded in images: # Analysis of all the images in the chosen directory	
+			start = System.nanoTime()
+			if Sweep_Mode(params):
+				nameCSV = SweepImage(filename, loaded, params, resultpath2)
+			else:
+				nameCSV = AnalyseImage(filename, loaded, params, resultpath2, Imagespath, writer)
+			profile.record('image', start, filename)
+			if nameCSV == 0:
+				return 0
+			if nameCSV:
+				nameCSVs.append(nameCSV)
+				if filename in cache_keys:
+					Cache_Store(cache_dir, cache_keys[filename], nameCSV, params)
+			NoImages = NoImages - 1
+			print 'The are still ' + str(NoImages) + ' images for analysis in the folder.'
+	finally:
+		# stops the background thread of the prefetching also if the analysis stops, the images of the cells are all written
+		images.close()
+		writer.close()
+		if params['profile'] == True:
+			profile.write(Profile_Name(AnalysisDir), params)
+	return nameCSVs
+
+# Parameters of the exclusion criteria, they are applied to the raw measurements only (see Write_Results)
+EXCLUSION_PARAMS = ('Min_cellarea', 'Max_cellarea', 'ExclutionCriteria', 'zeroMax', 'zeroHom', 'ExcluMean', 'AreaAboveThres', 'MaxFS', 
+	'DivideOEcells', 'HomoToDiv', 'UserEstFociSize')
+# Parameters that do not change the raw measurements and so are not part of the cache key. 
+# Change CACHE_VERSION if the analysis changes.
+CACHE_IGNORED = ('workers', 'fiji_executable', 'script_path', 'worker_memory', 'prefetch', 'prefetch_memory', 'cache', 'cache_dir', 'cache_size', 
+	'sweep_noise', 'sweep_threshold', 'results_store', 'python_executable', 'cell_images', 'cell_images_every', 'cell_images_flagged',
+	'cell_images_compress', 'cell_area_check', 'profile', 'picking', 'auto_min_area', 'auto_max_area', 'auto_min_solidity',
+	'auto_min_circularity', 'auto_exclude_border', 'auto_min_DAPI', 'auto_max_DAPI', 'auto_review', 'pick_first',
+	'segmentation_bin', 'segmentation_check', 'segmentation_min_iou', 'series',
+	'timepoints', 'track_distance') + EXCLUSION_PARAMS
+CACHE_VERSION = 3
+# Change BACKGROUND_VERSION if the background estimation of ThresholdEst changes
+BACKGROUND_VERSION = 1
+
+def Cache_Dir(AnalysisDir, params):
+	# Directory of the result cache or None if the cache is not used. The cache needs saved ROI managers and is not used by the sweep mode.
+	if params['cache'] != True or params['RoiManHave'] != True or Sweep_Mode(params):
+		return None
+	cache_dir = params['cache_dir'] or os.path.join(AnalysisDir, "Results", "cache")
+	if not createDir(cache_dir):
+		return None
+	return cache_dir
+
+def Background_Cache(AnalysisDir, params):
+	# Directory of the cached background means of ThresholdEst and of the plane ranges of crop_to_rois (the same as the result cache) 
+	# or None if the cache is not used
+	if params['cache'] != True or (params['TresSelect'] == True and params['crop_to_rois'] != True):
+		return None
+	cache_dir = params['cache_dir'] or os.path.join(AnalysisDir, "Results", "cache")
+	if not createDir(cache_dir):
+		return None
+	return cache_dir
+
+def Cache_Key(filename, resultpathROI, params):
+	# Hash of the image file, of the ROI manager and of all the parameters that change the results
+	digest = hashlib.sha1()
+	used = dict((key, value) for key, value in params.items() if key not in CACHE_IGNORED)
+	digest.update(json.dumps(used, sort_keys=True) + str(CACHE_VERSION))
+	image, series = Image_File(filename)
+	if series:
+		digest.update('series ' + str(series))
+	if Image_Timepoint(filename):
+		digest.update('timepoint ' + str(Image_Timepoint(filename)))
+	for path in (image, resultpathROI):
+		digest.update(File_Digest(path))
+	return digest.hexdigest()
+
+def File_Digest(path):
+	# SHA-1 of the content of a file, kept in file_digests until the file changes
+	stat = os.stat(path)
+	known = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+	if known not in file_digests:
+		digest = hashlib.sha1()
+		with open(path, 'rb') as f:
+			chunk = f.read(1 << 20)
+			while chunk:
+				digest.update(chunk)
+				chunk = f.read(1 << 20)
+		file_digests[known] = digest.hexdigest()
+	return file_digests[known]
+
+def Cache_Restore(cache_dir, key, resultpath2, params):
+	# Writes the raw measurements of a cached image again and its results file with the exclusion criteria of params.
+	# Returns the name of the results file or None if the image is not in the cache.
+	entry = os.path.join(cache_dir, key + '.json')
+	if not os.path.isfile(entry):
+		return None
+	with open(entry, 'r') as f:
+		cached = json.load(f)
+	# the access time is kept in the modification time for the eviction of the least recently used results
+	os.utime(entry, None)
+	nameCSV = os.path.join(resultpath2, cached['nameCSV'])
+	with open(Raw_Name(nameCSV), 'wb') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(RAW_HEADER)
+		for row in cached['rows']:
+			spamwriter.writerow(row)
+	Write_Results(nameCSV, cached['rows'], params)
+	return nameCSV
+
+def Cache_Store(cache_dir, key, nameCSV, params):
+	# Saves the raw measurements of an image and removes the least recently used results above cache_size MB.
+	# The background means and plane ranges (background_*.json and ranges_*.json, Background_Entry) are not results and are never removed. The workers of runWorkers
+	# share the cache directory, so an entry can be removed by another worker at any time: missing entries are skipped.
+	with open(Raw_Name(nameCSV), 'rb') as f:
+		rows = [row for row in csv.reader(f, delimiter=',', quotechar='|')][1:]
+	with open(os.path.join(cache_dir, key + '.json'), 'w') as f:
+		json.dump({'nameCSV': os.path.basename(nameCSV), 'rows': rows}, f)
+	entries = []
+	for name in os.listdir(cache_dir):
+		if not name.endswith('.json') or name.startswith(('background_', 'ranges_')):
+			continue
+		entry = os.path.join(cache_dir, name)
+		try:
+			entries.append((os.path.getmtime(entry), os.path.getsize(entry), entry))
+		except OSError:
+			continue
+	entries.sort()
+	total = sum([size for mtime, size, _ in entries])
+	while entries and total > float(params['cache_size']) * 1024 * 1024:
+		mtime, size, entry = entries.pop(0)
+		total = total - size
+		try:
+			os.remove(entry)
+		except OSError:
+			pass
+
+class Image_Loader(Callable):
+	# Reads one image in the background thread of Prefetched_Images
+	def __init__(self, filename, params):
+		self.filename = filename
+		self.params = params
+	def call(self):
+		return Load_Image(self.filename, self.params)
+
+def Prefetched_Images(workDir, params):
+	# Yields (filename, Load_Image(filename)) for all the images. With params['prefetch'] > 0 a background thread reads the next
+	# images (at most prefetch of them) while the current one is analysed. The images read ahead take at most prefetch_memory MB,
+	# estimated from the size of the last image.
+	prefetch = int(params['prefetch'])
+	if prefetch <= 0:
+		for filename in workDir:
+			yield filename, Load_Image(filename, params)
+		return
+	cap = float(params['prefetch_memory']) * 1024 * 1024
+	executor = Executors.newSingleThreadExecutor()
+	pending = deque()
+	estimate = 0
+	next_image = 0
+	try:
+		while pending or next_image < len(workDir):
+			# the first pending image is the current one, the others are read ahead
+			while next_image < len(workDir) and len(pending) <= prefetch and (not pending or len(pending) * estimate <= cap):
+				pending.append((workDir[next_image], executor.submit(Image_Loader(workDir[next_image], params))))
+				next_image = next_image + 1
+			filename, future = pending.popleft()
+			start = System.nanoTime()
+			loaded = future.get()
+			profile.record('load_wait', start, filename)
+			if loaded is not None and loaded[0] is not None:
+				estimate = sum([imp.getSizeInBytes() for imp in loaded[0]])
+			yield filename, loaded
+	finally:
+		executor.shutdownNow()
+
+class Profile(object):
+	# Wall time (s) and used heap (MB, after the stage) of the stages of the analysis per image and for the whole run.
+	# The stages of the background threads (load, save) are recorded with the image they belong to.
+	def __init__(self):
+		self.lock = Lock()
+		self.start = System.nanoTime()
+		self.run = {}
+		self.images = {}
+		self.order = []
+		self.heap_max = 0.0
+	def record(self, stage, start, filename):
+		seconds = (System.nanoTime() - start) / 1e9
+		runtime = Runtime.getRuntime()
+		heap = (runtime.totalMemory() - runtime.freeMemory()) / 1048576.0
+		image = os.path.basename(filename)
+		self.lock.acquire()
+		try:
+			if image not in self.images:
+				self.images[image] = {}
+				self.order.append(image)
+			for stages in (self.run, self.images[image]):
+				entry = stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'heap_max_mb': 0.0})
+				entry['count'] += 1
+				entry['seconds'] += seconds
+				entry['max_seconds'] = max(entry['max_seconds'], seconds)
+				entry['heap_max_mb'] = max(entry['heap_max_mb'], heap)
+			self.heap_max = max(self.heap_max, heap)
+		finally:
+			self.lock.release()
+	def summary(self, stages):
+		# stages with rounded values, the number of cells is the number of measured cell areas
+		rounded = {}
+		for stage, entry in stages.items():
+			rounded[stage] = {'count': entry['count'], 'seconds': round(entry['seconds'], 4), 'max_seconds': round(entry['max_seconds'], 4), 
+				'heap_max_mb': round(entry['heap_max_mb'], 1)}
+		return {'cells': stages.get('area', {'count': 0})['count'], 'stages': rounded}
+	def write(self, path, params):
+		self.lock.acquire()
+		try:
+			run = self.summary(self.run)
+			run['seconds'] = round((System.nanoTime() - self.start) / 1e9, 3)
+			run['images'] = len(self.order)
+			run['heap_max_mb'] = round(self.heap_max, 1)
+			run['heap_limit_mb'] = round(Runtime.getRuntime().maxMemory() / 1048576.0, 1)
+			run['processors'] = Runtime.getRuntime().availableProcessors()
+			images = []
+			for image in self.order:
+				summary = self.summary(self.images[image])
+				summary['image'] = image
+				images.append(summary)
+		finally:
+			self.lock.release()
+		with open(path, 'w') as f:
+			json.dump({'run': run, 'images': images, 'params': params}, f, indent=1, sort_keys=True)
+		print 'Profile of the analysis written to ' + path
+
+def Profile_Name(AnalysisDir):
+	# Results/<folder>_profile.json, the workers of the parallel batch mode write Results/<folder>_profile_worker_<k>.json
+	name = os.path.basename(os.path.normpath(AnalysisDir)) + '_profile'
+	if os.environ.get('FOCI_WORKER'):
+		name = name + '_worker_' + os.environ['FOCI_WORKER']
+	return os.path.join(AnalysisDir, "Results", name + '.json')
+
+# Number of images of cells that can wait for the background thread of Image_Writer
+WRITE_QUEUE = 64
+# Cells per montage of a tiled image (cell_images 'montage'), the montage of all the cells of a whole slide would not fit in the heap
+TILED_MONTAGE = 500
+
+class Save_Image(Callable):
+	# Saves one image (of the cells of filename) in the background thread of Image_Writer, .zip is a zipped TIFF
+	def __init__(self, imp, path, filename):
+		self.imp = imp
+		self.path = path
+		self.filename = filename
+	def call(self):
+		start = System.nanoTime()
+		if self.path.endswith('.zip'):
+			saved = FileSaver(self.imp).saveAsZip(self.path)
+		else:
+			saved = FileSaver(self.imp).saveAsTiff(self.path)
+		self.imp.flush()
+		profile.record('save', start, self.filename)
+		return saved
+
+class Image_Writer(object):
+	# Writes the images of the cells in a background thread so that the analysis does not wait for the file system.
+	# If queue images are waiting, the analysis waits for the oldest one.
+	def __init__(self, queue):
+		self.executor = Executors.newSingleThreadExecutor()
+		self.pending = deque()
+		self.queue = queue
+	def save(self, imp, path, filename):
+		self.pending.append(self.executor.submit(Save_Image(imp, path, filename)))
+		while len(self.pending) > self.queue:
+			self.pending.popleft().get()
+	def close(self):
+		try:
+			while self.pending:
+				self.pending.popleft().get()
+		finally:
+			self.executor.shutdown()
+
+def Cell_Image_Wanted(k, row, params):
+	# True if the image of the k-th cell of an image (raw measurements row) is saved with the policy of params['cell_images']
+	if params['cell_images'] in ('all', 'montage'):
+		return True
+	if params['cell_images'] != 'sampled':
+		return False
+	if int(params['cell_images_every']) > 0 and k % int(params['cell_images_every']) == 0:
+		return True
+	if params['cell_images_flagged'] == True:
+		# overexposed and zero cells after the exclusion criteria
+		Points, FS = Classify(row[12], row[10], row[11], row[9], row[6], row[7], row[8], float(row[13]), params)
+		return Points == "OE" or float(Points) == 0
+	return False
+
+def Image_Copy(imp):
+	# Copy of a cell image for the background thread, the pixels of imp are released when imp is closed
+	copy = ImagePlus(imp.getTitle(), imp.getStack().duplicate())
+	copy.setCalibration(imp.getCalibration())
+	return copy
+
+def Cells_Montage(cells, title):
+	# One stack with all the slices of all the cells, every cell in the top left corner of a slice of the size of the largest cell
+	width = max([cell.getWidth() for cell in cells])
+	height = max([cell.getHeight() for cell in cells])
+	montage = ImageStack(width, height)
+	for cell in cells:
+		stack = cell.getStack()
+		for i in range(1, stack.getSize() + 1):
+			ip = stack.getProcessor(i).createProcessor(width, height)
+			ip.insert(stack.getProcessor(i), 0, 0)
+			montage.addSlice(cell.getTitle() + ': ' + str(stack.getSliceLabel(i)), ip)
+	imp = ImagePlus(title, montage)
+	imp.setCalibration(cells[0].getCalibration())
+	return imp
+
+def Load_Image(filename, params):
+	# Opens the DAPI and GFP channels of the image. Returns (imps, region, ROIs, ranges) or None if the image is skipped in the batch mode.
+	# If the saved ROI manager is reevaluated with a manual threshold, crop_to_rois reads only the bounding boxes of the cells 
+	# (Open_Clusters). The minimum and maximum of the channels (ranges, for the noise tolerance and Clear_Range) are then taken from 
+	# the whole plane (Plane_Ranges, cached in background_cache), so that the results are the same as without crop_to_rois. 
+	# Otherwise region, ROIs and ranges are None.
+	# Tiled images (Tiled_Size) are not read here, imps is None and region the size of the image.
+	resultpathROI = os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] +"_ROI.zip")
+	if Interpreter.batchMode and not os.path.isfile(resultpathROI):
+		return None
+	size = Tiled_Size(filename, params)
+	if size is not None:
+		return None, size, None, None
+	region = None
+	ROIs = None
+	ranges = None
+	if params['crop_to_rois'] == True and params['RoiManHave'] == True and params['TresSelect'] == True:
+		ROIs = readROIs(resultpathROI)
+		region = ROIs_Bounds(ROIs)
+		if region is None:
+			ROIs = None
+		else:
+			start = System.nanoTime()
+			entry = Background_Entry(filename, params, 'ranges')
+			ranges = Cached_Ranges(entry)
+			if ranges is None:
+				ranges = Plane_Ranges(filename, params)
+				Cache_Ranges(entry, filename, ranges)
+			profile.record('ranges', start, filename)
+	start = System.nanoTime()
+	if region is None:
+		imps = Open_Channels(filename, params)
+	else:
+		imps = Open_Clusters(filename, params, region, ROIs_Clusters(ROIs))
+	profile.record('load', start, filename)
+	return imps, region, ROIs, ranges
+
+def Pick_Image(filename, DAPI, rm, resultpathROI, params, DAPI8=None):
+	# Segmentation of the DAPI channel and picking of the cells (flood-fill or automatic, in vivo with the selected vessel).
+	# The picked cells are in the ROI manager rm and saved as resultpathROI.zip. DAPI8 is the 8-bit DAPI channel if ThresholdEst made it.
+	start = System.nanoTime()
+	factor = int(params['segmentation_bin'])
+	Cell_Map = Cell_Segmentation(DAPI8 or DAPI, factor)
+	profile.record('Cell_Segmentation', start, filename)
+	if factor > 1 and params['segmentation_check'] == True:
+		start = System.nanoTime()
+		Cell_Map = Segmentation_Check(filename, DAPI8 or DAPI, Cell_Map, factor, params)
+		profile.record('segmentation_check', start, filename)
+	start = System.nanoTime()
+	if params['picking'] == 'auto':
+		roi1 = None
+		if params['TumorAnalysis'] == True:
+			roi1 = Select_Area(DAPI)
+		rm = Review_Cells(DAPI, Auto_Pick_Cells(Cell_Map, DAPI, params, roi1), rm, resultpathROI, params)
+	elif params['TumorAnalysis'] == True:
+		roi1 = Select_Area(DAPI)
+		Cell_Map, rm = Pick_Cells_InVivo(Cell_Map, DAPI, rm, resultpathROI,roi1)
+	else:
+		Cell_Map, rm = Pick_Cells(Cell_Map, DAPI, rm, resultpathROI)
+	profile.record('picking', start, filename)
+	return rm
+
+def Split_Channels(filename, imps):
+	# Returns the DAPI and GFP channels. The DAPI and GFP channel are in the opposite direction in the .czi and .zvi image formats 
+	if filename.endswith('.czi'):	
+		imps[1].setTitle("DAPI")
+		imps[0].setTitle("GFP")
+		return imps[1], imps[0]
+	imps[0].setTitle("DAPI")
+	imps[1].setTitle("GFP")
+	return imps[0], imps[1]
+
+def Image_Ranges(imps, ranges):
+	# Minimum and maximum of the channels of the whole plane: ranges of Load_Image if only a region was read, otherwise Clear_Range
+	if ranges is not None:
+		return ranges
+	return [Clear_Range(imp) for imp in imps]
+
+def Scaled_Noise_Tolerance(maxV, noise_toler):
+	# In case that the acquisition of the images was done with a low exposure, 
+	# then I will try to change to noisetolerance accordingly.
+	# maxV is the maximum of the foci channel of the whole plane (Image_Ranges, Scan_Tiles in the tiled mode)
+	helpNoise =  4095/maxV
+	if maxV < 4095:
+		return round(float(noise_toler)/float(helpNoise))
+	return noise_toler
+
+def Cell_Stack(ROI, imps, clear_ranges):
+	# Stack with the crops of the cell from all the channels and the ROI of the cell in the coordinates of the stack
+	Stack = ImageStack(int(ROI.getFloatWidth()),int(ROI.getFloatHeight()))
+	# browse all channels
+	for imp, clear_range in zip(imps, clear_ranges):
+		# crop the cell and clear the area around the ROI, the whole image is not duplicated
+		img, cell_ROI = Crop_Cell(imp, ROI, clear_range)
+		# add channels to Stack
+		Stack.addSlice(img.getTitle(), img.getProcessor())
+	# Turn Stack into ImagePlus, the calibration is the global one of Set_Scale
+	return ImagePlus(ROI.getName(), Stack), cell_ROI
+
+def AnalyseImage(filename, loaded, params, resultpath2, Imagespath, writer):
+	# Analysis of all the selected cells of one image (loaded by Load_Image). The results are saved in resultpath2 and the images 
+	# of the cells in Imagespath by writer (Image_Writer). Returns the name of the CSV file, '' if the image was skipped or 0 in case of an error.
+	global threshold
+	global noise_tolerance
+	
+	pixel_cal = str(1/float(params['pixel_size']))
+	RoiManHave = params['RoiManHave']
+	noise_toler = params['noise_toler']
+	
+	####################### Threshold establishment in case of manual and general threshold for one image in the directory #############
+	
+	if params['TresSelect'] == True:
+		threshold = params['manualTres']
+	
+	# In the batch mode the images without saved ROI manager are skipped and no ROI manager window is created
+	resultpathROI = os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] +"_ROI")
+	if loaded is None:
+		print 'No saved ROI manager for ' + filename + ', the image is skipped.'
+		return ''
+	imps, region, ROIs, ranges = loaded
+	# tiled images are read tile by tile (Scan_Tiles and Tile_Cells), their cells are not put in the ROI manager
+	tiled = imps is None
+	if Interpreter.batchMode or tiled:
+		rm = None
+	else:
 		try:
 			rm = RoiManager.getInstance()
 			rm.reset()
 		except:
 			rm = RoiManager()
-		try: 
-			IJ.run("Close All", "")
-		except:
-			pass			
-	
-		# Open the image
-		options = ImporterOptions()
-		options.setId(filename)
-		options.setSplitChannels(True)		
-		imps = BF.openImagePlus(options)	
-		if filename1.endswith('.czi'):	
-			imps[1].setTitle("DAPI")
-			DAPI = imps[1]
-			imps[0].setTitle("GFP")
-			GFP = imps[0]
-		else: 
-			imps[0].setTitle("DAPI")
-			DAPI = imps[0]
-			imps[1].setTitle("GFP")
-			GFP = imps[1]
-
-		# In case that the acquisition of the images was done with a low exposure, 
-		# then I will try to change to noisetolerance accordingly.
-		helpStat = GFP.getProcessor().getStatistics() 
-		helpNoise =  4095/helpStat.max
-		if helpStat.max < 4095:
-			noise_tolerance = round(float(noise_toler)/float(helpNoise))
-		else:
-			noise_tolerance = noise_toler	
-			
+	try: 
+		IJ.run("Close All", "")
+	except:
+		pass			
+
+	DAPI8 = None
+	if tiled:
+		# first pass over the tiles: maximum of the foci channel, background of the automatic threshold and picking of the cells
+		entry = Background_Entry(filename, params)
+		mean = Cached_Background(entry)
+		background = params['TresSelect'] == False and mean is None
+		clear_ranges, foci_max, total, count, picked = Scan_Tiles(filename, region, params, background, RoiManHave == False)
+		noise_tolerance = Scaled_Noise_Tolerance(foci_max, noise_toler)
+		if background:
+			mean = total / count
+			Cache_Background(entry, filename, mean)
+		if params['TresSelect'] == False:
+			threshold = round(params['thres_a'] * mean + params['thres_b'])
+	else:
+		DAPI, GFP = Split_Channels(filename, imps)
+		clear_ranges = Image_Ranges(imps, ranges)
+		noise_tolerance = Scaled_Noise_Tolerance(clear_ranges[list(imps).index(GFP)][1], noise_toler)
+		
 		# Setting the threshold from each image automatically			
-		if TresSelect == False:	
-			threshold = ThresholdEst(DAPI,GFP,thres_a,thres_b)			
-
-		# Creation of folder with the analysed cells					
-		resultpath = os.path.join(Imagespath, os.path.basename(filename)[:-4] + "_analyzed_cells_MaxFind_noiseTol_" + str(noise_tolerance)+ '_Threshold_' + str(threshold))
-		resultpath = os.path.normpath(resultpath)	
-		if not os.path.isdir(resultpath):
-			try:
-				os.mkdir(resultpath)
-			except:
-				return 0
-				
+		if params['TresSelect'] == False:	
+			start = System.nanoTime()
+			threshold, DAPI8 = ThresholdEst(filename, DAPI, GFP, params)
+			profile.record('ThresholdEst', start, filename)
+
+	# Creation of folder with the analysed cells (the montage is one file named as the folder)
+	resultpath = os.path.join(Imagespath, os.path.basename(filename)[:-4] + "_analyzed_cells_MaxFind_noiseTol_" + str(noise_tolerance)+ '_Threshold_' + str(threshold))
+	resultpath = os.path.normpath(resultpath)	
+	if params['cell_images'] in ('all', 'sampled') and not createDir(resultpath):
+		return 0
+	if params['cell_images_compress'] == True:
+		extension = '.zip'
+	else:
+		extension = '.tif'
+	montage = []
+	parts = 0
+			
+	if tiled:
+		if RoiManHave == True:
+			ROIs = readROIs(resultpathROI + ".zip")
+		else:
+			ROIs = picked
+			Save_Picked(ROIs, resultpathROI)
+	elif region is not None:
+		# the ROIs are already read, they are moved to the coordinates of the opened region
+		for ROI in ROIs:
+			bounds = ROI.getBounds()
+			ROI.setLocation(bounds.x - region.x, bounds.y - region.y)
+	elif rm is None:
+		ROIs = readROIs(resultpathROI + ".zip")
+	else:
 		if RoiManHave == True: 
-			resultpathROI = os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] +"_ROI.zip")
-			rm = opensavedROIman(resultpathROI)
+			rm = opensavedROIman(resultpathROI + ".zip")
+		elif Previous_Timepoint(filename) is not None:
+			# the later time points of a time-lapse image are not picked, the cells of the previous time point are tracked
+			for ROI in Track_ROIs(filename, DAPI, params):
+				rm.addRoi(ROI)
 		elif RoiManHave == False:
-			resultpathROI = os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] +"_ROI")				
-		
 			# Process DAPI channel - make the segmentation and select the cell to be analysed
-			Cell_Map = Cell_Segmentation(DAPI)			
-			if TumorAnalysis == True: 
-				roi1 = Select_Area(DAPI)
-				Cell_Map, rm = Pick_Cells_InVivo(Cell_Map, DAPI, rm, resultpathROI,roi1)
-			else:	
-				Cell_Map, rm = Pick_Cells(Cell_Map, DAPI, rm, resultpathROI)				
+			rm = Pick_Image(filename, DAPI, rm, resultpathROI, params, DAPI8)
+		ROIs = rm.getRoisAsArray()
+		rm.reset()
 
-		######################################## Creation of the csv textbook for the results #################################################
-		if RoiManHave == True:
-			nameCSV = resultpath2 + '\\' + os.path.basename(filename)[:-4]+'_results_MaxFind_ROI_noiseTol_' + str(noise_tolerance) + '_UserThreshold_' + str(threshold) + '.csv'
+	######################################## Creation of the csv textbook for the results #################################################
+	# The raw measurements (before the exclusion criteria) are saved too, so that the criteria can be changed without a new analysis
+	if RoiManHave == True:
+		nameCSV = os.path.join(resultpath2, os.path.basename(filename)[:-4]+'_results_MaxFind_ROI_noiseTol_' + str(noise_tolerance) + '_UserThreshold_' + str(threshold) + '.csv')
+	else:
+		nameCSV = os.path.join(resultpath2, os.path.basename(filename)[:-4]+'_results_MaxFind_ORIG_noiseTol_' + str(noise_tolerance) + '_UserThreshold_' + str(threshold) + '.csv')
+	nameRaw = Raw_Name(nameCSV)
+		
+	rawRows = []
+	checks = []
+	with open(nameRaw, 'wb') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(RAW_HEADER)				
+
+	######################################	Analysis of all selected cells ##############################################################
+		Set_Scale(pixel_cal)
+		if tiled:
+			cells = Tile_Cells(filename, region, ROIs, params)
 		else:
-			nameCSV = resultpath2 + '\\' + os.path.basename(filename)[:-4]+'_results_MaxFind_ORIG_noiseTol_' + str(noise_tolerance) + '_UserThreshold_' + str(threshold) + '.csv'
+			cells = [(imps, ROI) for ROI in ROIs]
+		for imps, ROI in cells: 	
+			if rm is not None:
+				rm.addRoi(ROI)
+			# copy cropped cell to separate image (all channels)
+			start = System.nanoTime()
+			Stack, cell_ROI = Cell_Stack(ROI, imps, clear_ranges)
+			profile.record('crop', start, filename)
+
+			# Get Cell Area and ROI of Cell
+			start = System.nanoTime()
+			Area_Cell, Cell_ROI = Measure_Cell_Area(Stack, cell_ROI, filename, params)
+			profile.record('area', start, filename)
+			if params['cell_area_check'] == True:
+				checks.append(Cell_Area_Check(ROI.getName(), Stack, cell_ROI, filename))
+
+			# Get info from DAPI channell
+			start = System.nanoTime()
+			DAmeanV, DAminV, DAmaxV, DAhomogen = excludeDAPI(Stack, Cell_ROI, filename)
+			profile.record('DAPI', start, filename)
 			
-		with open(nameCSV, 'wb') as csvfile:
-			spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-			spamwriter.writerow(['Cell No', 'DAPI min', 'DAPI max', 'DAPI mean', 'DAPI homogeneity', 'GFP min', 'GFP max', 'GFP mean', 'GFP homogeneity', '% Area above threshold GFP', 'Foci size', 'Cell Area', 'N_Foci'])				
-
-		######################################	Analysis of all selected cells ##############################################################
-			Data = []
-			N = rm.getCount()	
-			ROIs = rm.getRoisAsArray()
-			rm.reset()
+			# Get Maxima/foci and several parameters of interest
+			start = System.nanoTime()
+			Points, maxima_points, meanV, minV, maxV, PecentAreaThres, GFPhomogen = findFoci(Stack, Cell_ROI, threshold, filename)
+			profile.record('foci', start, filename)
 			
-			for ROI in ROIs: 	
-				rm.addRoi(ROI)
-				# copy cropped cell to separate image (all channels)
-				Stack = ImageStack(int(ROI.getFloatWidth()),int(ROI.getFloatHeight()))
-				
-				# browse all channels
-				for imp in imps:
-					# duplicate image, clear area around ROI and add the remains to the Stack
-					# Why? If cells are close to each other, a rectangular image celection around one cell 
-					# might include areas of other cells and we do not want that
-					imp_buffer = imp.duplicate()
-					imp_buffer.setRoi(ROI)
-					IJ.setAutoThreshold(imp_buffer, "Default dark reset")
-					IJ.run(imp_buffer, "Clear Outside", "") 
-					img = imp_buffer.crop()
-					imp_buffer.close()	
-					# add channels to Stack
-					ip = img.getProcessor()
-					Stack.addSlice(img.getTitle(), ip)
-					
-				# Turn Stack into ImagePlus
-				Stack = ImagePlus(ROI.getName(), Stack)
-				IJ.run(Stack, "Set Scale...", "distance="+pixel_cal+" known=1 pixel=1 unit=micron global")
-	
-				# Get Cell Area and ROI of Cell
-				Stack.show()
-				Cell_mask, Area_Cell, Cell_ROI = Cell_Area(Stack, filename1)
+			# Mean foci size
+			if (int(Points) == 0):
+				FS = "NA"
+			else:	
+				FS = round(float(Area_Cell) * float(PecentAreaThres) / 100 / int(Points),3)
 
-				# Get info from DAPI channell
-				DAmeanV, DAminV, DAmaxV, DAhomogen = excludeDAPI(Stack, Cell_ROI, filename1)
-				
-				# Get Maxima/foci and several parameters of interest
-				Points, findmaxinvert, meanV, minV, maxV, PecentAreaThres, GFPhomogen = findFoci(Stack, Cell_ROI, threshold, filename1)
-				
-				# Mean foci size
-				if (int(Points) == 0):
-					FS = "NA"
-				else:	
-					FS = round(float(Area_Cell) * float(PecentAreaThres) / 100 / int(Points),3)
+			# Write to raw results file
+			rawRows.append([ROI.getName(), DAminV, DAmaxV, DAmeanV, DAhomogen, minV, maxV, meanV, GFPhomogen, PecentAreaThres, FS, Area_Cell, Points, threshold])
+			spamwriter.writerow(rawRows[-1])
 
-				############################################### EXCLUSION CRITERIA ##############################################################
-				if ExclutionCriteria == True:
-					if float(Area_Cell) < Min_cellarea or float(Area_Cell) > Max_cellarea:
-						Points = "OE"
-						FS = 0
-						FA = "NA"
-					elif PecentAreaThres == 0:
-						Points = 0
-						FS = 0
-						FA = 0	
-					elif (float(maxV) < zeroMax * threshold and float(GFPhomogen) < zeroHom):
-						Points = 0
-						FS = 0
-						FA = 0	
-					elif ((float(meanV) > (ExcluMean * threshold)) or (float(PecentAreaThres) > AreaAboveThres) or (float(FS) >= MaxFS)):
-						if DivideOEcells == True:
-							if (float(GFPhomogen) > HomoToDiv): 
-								help = round(float(Area_Cell)*float(PecentAreaThres)/100/UserEstFociSize)
-								if int(Points) < float(help):
-									Points = help
-								else:
-									Points = Points		
-						else:
-							Points = "OE"
-							FA = "NA"
-					elif Points == 0:
-						FA = 0	
-						FS = 0
-
-				########################################## FINAL PROCESSING OF THE RESULTS ######################################################
-						
+			########################################## FINAL PROCESSING OF THE RESULTS ######################################################
+			
+			# The image of the cell is only made if it is saved or left opened
+			if verify_params or Cell_Image_Wanted(len(rawRows) - 1, rawRows[-1], params):
+				start = System.nanoTime()
 				#Postprocess
 				Postprocess(Stack, Cell_ROI)
-	
+
 				#Add another slice to the stack with the points that MaximumFinder took into account			
-				Stack.getStack().addSlice('Found Maxima', findmaxinvert.getProcessor())			
+				Stack.getStack().addSlice('Found Maxima', Maxima_Image(maxima_points, Stack.getWidth(), Stack.getHeight()))			
 											
-				# Save image of cell
+				# Save image of cell by the background thread or keep it for the montage
+				if params['cell_images'] == 'montage':
+					montage.append(Image_Copy(Stack))
+					if tiled and len(montage) == TILED_MONTAGE:
+						parts = parts + 1
+						writer.save(Cells_Montage(montage, os.path.basename(resultpath)), resultpath + '_part_' + str(parts) + extension, filename)
+						montage = []
+				elif params['cell_images'] != 'none':
+					writer.save(Image_Copy(Stack), os.path.join(resultpath, ROI.getName() + extension), filename)
+				profile.record('postprocess', start, filename)
+						
+			# If parameter verification is disabled: Close cell image.
+			if verify_params:
 				Stack.show()
-				IJ.saveAs("Tiff", resultpath + "\\" + Stack.getTitle())
-							
-				# If parameter verification is disabled: Close cell image.
-				if verify_params:
-					Stack.setSlice(5)
-					IJ.run(Stack, "Options...", "black")
-				else:
-					Stack.close()
-				# Write to results file
-				spamwriter.writerow([Stack.getTitle()[:-4], DAminV, DAmaxV, DAmeanV, DAhomogen, minV, maxV, meanV, GFPhomogen, PecentAreaThres, FS, Area_Cell, Points])
+				Stack.setSlice(5)
+				IJ.run(Stack, "Options...", "black")
+			else:
+				Stack.close()
+		if rm is not None:
 			rm.runCommand("reset")
-		NoImages = NoImages - 1
-		print 'The are still ' + str(NoImages) + ' images for analysis in the folder.'					
+	if montage and parts:
+		writer.save(Cells_Montage(montage, os.path.basename(resultpath)), resultpath + '_part_' + str(parts + 1) + extension, filename)
+	elif montage:
+		writer.save(Cells_Montage(montage, os.path.basename(resultpath)), resultpath + extension, filename)
+	if checks:
+		Write_Area_Check(nameCSV.replace('_results_MaxFind_', '_cell_area_check_', 1), checks)
+	# Results file with the exclusion criteria applied to the raw measurements
+	start = System.nanoTime()
+	Write_Results(nameCSV, rawRows, params)
+	profile.record('results', start, filename)
+	return nameCSV
+
+def SweepImage(filename, loaded, params, resultpath2):
+	# Sweep mode: all the combinations of sweep_noise and sweep_threshold for the saved ROI manager of one image (loaded by Load_Image).
+	# Every cell is cropped and measured once, only the detection of the foci runs per combination. The results with the exclusion
+	# criteria are written in one long table Results/<image>_sweep_MaxFind.csv. Returns its name or '' if the image was skipped.
+	if loaded is None:
+		print 'No saved ROI manager for ' + filename + ', the image is skipped.'
+		return ''
+	imps, region, ROIs, ranges = loaded
+	pixel_cal = str(1/float(params['pixel_size']))
+	DAPI, GFP = Split_Channels(filename, imps)
+	clear_ranges = Image_Ranges(imps, ranges)
+	
+	if params['sweep_threshold']:
+		thresholds = params['sweep_threshold']
+	elif params['TresSelect'] == True:
+		thresholds = [params['manualTres']]
+	else:
+		start = System.nanoTime()
+		thresholds = [ThresholdEst(filename, DAPI, GFP, params)[0]]
+		profile.record('ThresholdEst', start, filename)
+	noise_tolers = sorted(set(params['sweep_noise'] or [params['noise_toler']]))
+	# noise tolerances of the parameters and the noise tolerances used for this image (two can be the same after the scaling)
+	tolerances = [(noise_toler, Scaled_Noise_Tolerance(clear_ranges[list(imps).index(GFP)][1], noise_toler)) for noise_toler in noise_tolers]
+	
+	if region is not None:
+		for ROI in ROIs:
+			bounds = ROI.getBounds()
+			ROI.setLocation(bounds.x - region.x, bounds.y - region.y)
+	else:
+		ROIs = readROIs(os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] +"_ROI.zip"))
+	
+	nameCSV = os.path.join(resultpath2, os.path.basename(filename)[:-4] + '_sweep_MaxFind.csv')
+	with open(nameCSV, 'wb') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(SWEEP_HEADER)
+		Set_Scale(pixel_cal)
+		rows = []
+		for ROI in ROIs:
+			start = System.nanoTime()
+			Stack, cell_ROI = Cell_Stack(ROI, imps, clear_ranges)
+			profile.record('crop', start, filename)
+			start = System.nanoTime()
+			Area_Cell, Cell_ROI = Measure_Cell_Area(Stack, cell_ROI, filename, params)
+			profile.record('area', start, filename)
+			start = System.nanoTime()
+			DAmeanV, DAminV, DAmaxV, DAhomogen = excludeDAPI(Stack, Cell_ROI, filename)
+			profile.record('DAPI', start, filename)
+			start = System.nanoTime()
+			meanV, minV, maxV, GFPhomogen, combinations = Sweep_Foci(Stack, Cell_ROI, thresholds, sorted(set([used for noise_toler, used in tolerances])), filename)
+			profile.record('foci', start, filename)
+			Stack.close()
+			for threshold, noise_tolerance, Points, PecentAreaThres in combinations:
+				if (int(Points) == 0):
+					FS = "NA"
+				else:	
+					FS = round(float(Area_Cell) * float(PecentAreaThres) / 100 / int(Points),3)
+				Points, FS = Classify(Points, FS, Area_Cell, PecentAreaThres, maxV, meanV, GFPhomogen, threshold, params)
+				for noise_toler, used in tolerances:
+					if used == noise_tolerance:
+						rows.append([noise_toler, noise_tolerance, threshold, ROI.getName(), DAminV, DAmaxV, DAmeanV, DAhomogen, 
+							minV, maxV, meanV, GFPhomogen, PecentAreaThres, FS, Area_Cell, Points])
+		# one block of cells per combination
+		rows.sort(key=lambda row: (row[0], row[2]))
+		for row in rows:
+			spamwriter.writerow(row)
+	return nameCSV
+
+def main():
+	# Without dialogs and windows if started with a parameter file (see batchArguments)
+	param_file, AnalysisDir = batchArguments()
+	if param_file:
+		runBatch(param_file, AnalysisDir)
+		return 0
+
+	params = askParams()
+	if params is None:
+		return 0
+		 
+	############################## Pick an image from a directory that you want to analyze ##################################################
+	
+	filename1 = IJ.getFilePath('Pick an image (.czi or .zvi) from the directory you want to analyze')	
+	if not filename1:
+		gd = GenericDialog("Error") 
+		gd.addMessage("An image was not picked. Run the script again and pick an image.")	
+		gd.hideCancelButton()	
+		gd.showDialog()
+		return 0
+	if not (filename1.endswith('.czi') or filename1.endswith('.zvi')): 
+		gd = GenericDialog("Error") 
+		gd.addMessage("File is not .czi neither .zvi. Run the script again and pick an image .czi or .zvi.")
+		gd.hideCancelButton()		
+		gd.showDialog()
+		return 0
+	params['image_type'] = filename1[-4:]
+	
+	# Τhe directory with images acquired with the same parameters	
+	AnalysisDir = os.path.dirname(filename1) 
+	
+	# Definition of the directory with the images to be analysed
+	workDir = Image_Units(sorted(glob.glob(os.path.join(AnalysisDir, '*' + params['image_type']))), params)
+	if params['pick_first'] == True and params['RoiManHave'] == False:
+		# all the cells are picked first, the analysis runs afterwards without windows while Fiji can be used again
+		picked = PickFolder(workDir, params)
+		launched = Launch_Analysis(AnalysisDir, params)
+		gd = GenericDialog("Progress") 
+		if launched is None:
+			gd.addMessage("The cells of " + str(picked) + " images have been picked, but the analysis could not be started. See the Log window.")
+		else:
+			gd.addMessage("The cells of " + str(picked) + " images have been picked. They are now analysed in the background." +
+			"\nThe results will be in " + os.path.join(AnalysisDir, "Results") + ", the progress is in " + launched[1])
+		gd.showDialog()
+		return 0
+	if AnalyseFolder(AnalysisDir, workDir, params) == 0:
+		return 0
 	gd = GenericDialog("Progress") 
 	gd.addMessage("All the images from the selected folder have been evaluated. Good job!")
 	gd.showDialog()
 
 main()
-
-
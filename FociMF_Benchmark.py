@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#########################################################################################################################################################
+##################################################### BENCHMARK WITH SYNTHETIC gH2AX IMAGES ############################################################
+#########################################################################################################################################################
+
+# Generates synthetic two-channel 12-bit images (DAPI and GFP) with nuclei of a given size and number, Gaussian foci at known
+# positions, background noise and a random exposure per image. The stages of the analysis of FociMF_Engine.py run on them and
+# the throughput (cells/s, images/s), the peak memory and the accuracy of the foci detection against the known foci are reported:
+#
+#     python3 FociMF_Benchmark.py [--sizes 512,1024,2048] [--cells 10,50,200] [--images 3] [--params params.json]
+#                                 [--output benchmark.json] [--write /path/to/images] [--segmentation 2,4]
+#
+# Every combination of image size and number of cells is one configuration. --params takes the parameter file of the batch mode
+# (noise tolerance, threshold, blur...), --output saves all the results as JSON (to compare versions of the script) and --write
+# saves the images (.tif, DAPI first), their ROI managers (_ROI.zip) and the known foci (_foci.json) so that the same images can
+# be analysed again by FociMF_Engine.py. Only the engine is benchmarked: the Fiji script reads only .czi and .zvi images.
+# The accuracy: a found maximum is a true focus if it is at most MATCH_DISTANCE pixels from a known focus (every known focus
+# can be matched once), precision/recall/F1 over all the foci and the fraction of cells with exactly the right number of foci.
+# --segmentation compares the binned segmentation of the nuclei (segmentation_bin) with the full resolution: time of Cell_Segmentation
+# per image, intersection over union (IoU) of the mask with the known nuclei for the full resolution and every binning factor and 
+# IoU of the binned mask with the full resolution mask (IoU full, what segmentation_check of the Fiji script tests).
+
+#########################################################################################################################################################
+#########################################IMPORT OF ALL THE USED LIBRARIES AND SELECTION OF PARAMETERS ###################################################
+#########################################################################################################################################################
+
+import argparse, json, os, resource, time, tracemalloc
+
+import numpy as np
+
+from FociMF_Engine import (DEFAULT_PARAMS, Cell_ROI, Cell_Segmentation, Crop_Cell, Mask_IoU, Measure_Cell_Area, Noise_Tolerance,
+	ThresholdEst, excludeDAPI, findFoci, load_params, write_rois)
+
+# Properties of the synthetic images. The intensities are those of the 12-bit images of the AxioImager before the exposure factor.
+SYNTHETIC = {
+	'nucleus_radius': (18, 30),		# half axes of the elliptic nuclei (pixels)
+	'foci': (0, 15),			# number of foci per nucleus
+	'foci_sigma': (1.0, 2.0),		# size of the foci (sigma of the Gaussian, pixels)
+	'foci_intensity': (600, 2000),		# height of the foci above the nucleus
+	'foci_distance': 5,			# smallest distance between two foci (pixels)
+	'DAPI': (1000, 2500),			# mean DAPI intensity of the nuclei
+	'DAPI_background': 150,
+	'GFP_nucleus': 80,			# GFP intensity of the nuclei above the background
+	'GFP_background': 250,
+	'noise': 20,				# sigma of the Gaussian noise
+	'exposure': (0.6, 1.0),			# intensity factor of the whole image
+}
+MATCH_DISTANCE = 2.0
+
+#########################################################################################################################################################
+#################################################### DEFINITION OF FUNCTIONS TO BE USED IN THE MAIN #####################################################
+#########################################################################################################################################################
+
+def synthetic_image(size, n_cells, rng, synthetic=SYNTHETIC):
+	# Returns DAPI, GFP (uint16 arrays), the cells: list of (name, xs, ys, foci) with the outline of the nucleus
+	# and the (x, y) positions of its foci, and the mask of the nuclei. The nuclei do not overlap, fewer than n_cells are placed 
+	# in a too small image.
+	s = synthetic
+	DAPI = np.full((size, size), float(s['DAPI_background']))
+	GFP = np.full((size, size), float(s['GFP_background']))
+	nuclei = np.zeros((size, size), dtype=bool)
+	yy, xx = np.mgrid[0:size, 0:size]
+	cells = []
+	placed = []
+	for attempt in range(n_cells * 50):
+		if len(cells) == n_cells:
+			break
+		rx, ry = rng.uniform(*s['nucleus_radius'], size=2)
+		margin = max(rx, ry) + 3
+		cx, cy = rng.uniform(margin, size - margin, size=2)
+		if any(np.hypot(cx - x, cy - y) < max(rx, ry) + r + 3 for x, y, r in placed):
+			continue
+		angle = rng.uniform(0, np.pi)
+		placed.append((cx, cy, max(rx, ry)))
+		# elliptic nucleus rotated by angle
+		y0, y1 = int(cy - margin), int(cy + margin) + 1
+		x0, x1 = int(cx - margin), int(cx + margin) + 1
+		dx, dy = xx[y0:y1, x0:x1] - cx, yy[y0:y1, x0:x1] - cy
+		u = (dx * np.cos(angle) + dy * np.sin(angle)) / rx
+		v = (-dx * np.sin(angle) + dy * np.cos(angle)) / ry
+		inside = u * u + v * v <= 1
+		DAPI[y0:y1, x0:x1][inside] += rng.uniform(*s['DAPI']) - s['DAPI_background']
+		GFP[y0:y1, x0:x1][inside] += s['GFP_nucleus']
+		nuclei[y0:y1, x0:x1] |= inside
+		# foci inside the nucleus, at least 3 pixels from its border
+		foci = []
+		for k in range(rng.integers(s['foci'][0], s['foci'][1] + 1)):
+			for trial in range(20):
+				r, t = np.sqrt(rng.uniform(0, 1)), rng.uniform(0, 2 * np.pi)
+				a, b = r * (rx - 3) * np.cos(t), r * (ry - 3) * np.sin(t)
+				fx = cx + a * np.cos(angle) - b * np.sin(angle)
+				fy = cy + a * np.sin(angle) + b * np.cos(angle)
+				if all(np.hypot(fx - x, fy - y) >= s['foci_distance'] for x, y in foci):
+					foci.append((fx, fy))
+					break
+		for fx, fy in foci:
+			sigma = rng.uniform(*s['foci_sigma'])
+			half = int(4 * sigma) + 1
+			fy0, fx0 = max(int(fy) - half, 0), max(int(fx) - half, 0)
+			fy1, fx1 = min(int(fy) + half + 1, size), min(int(fx) + half + 1, size)
+			patch = np.exp(-((xx[fy0:fy1, fx0:fx1] - fx) ** 2 + (yy[fy0:fy1, fx0:fx1] - fy) ** 2) / (2 * sigma * sigma))
+			GFP[fy0:fy1, fx0:fx1] += rng.uniform(*s['foci_intensity']) * patch
+		# outline of the nucleus one pixel outside of it, like a ROI picked from the segmentation
+		t = np.linspace(0, 2 * np.pi, 48, endpoint=False)
+		a, b = (rx + 1) * np.cos(t), (ry + 1) * np.sin(t)
+		xs = cx + a * np.cos(angle) - b * np.sin(angle)
+		ys = cy + a * np.sin(angle) + b * np.cos(angle)
+		cells.append(('%04d-%04d' % (int(cy), int(cx)), xs, ys, foci))
+	exposure = rng.uniform(*s['exposure'])
+	DAPI = DAPI * exposure + rng.normal(0, s['noise'], DAPI.shape)
+	GFP = GFP * exposure + rng.normal(0, s['noise'], GFP.shape)
+	return np.clip(DAPI, 0, 4095).astype(np.uint16), np.clip(GFP, 0, 4095).astype(np.uint16), cells, nuclei
+
+def match_foci(found, known):
+	# Number of found maxima that are known foci: greedy matching of the closest pairs within MATCH_DISTANCE
+	if not found or not known:
+		return 0
+	found = np.array(found, dtype=float)
+	known = np.array(known, dtype=float)
+	distances = np.hypot(found[:, None, 0] - known[None, :, 0], found[:, None, 1] - known[None, :, 1])
+	matched = 0
+	for k in np.argsort(distances, axis=None):
+		i, j = np.unravel_index(k, distances.shape)
+		if distances[i, j] > MATCH_DISTANCE:
+			break
+		if np.isfinite(distances[i, j]):
+			matched += 1
+			distances[i, :] = np.inf
+			distances[:, j] = np.inf
+	return matched
+
+def analyse(DAPI, GFP, cells, params, timings):
+	# The stages of AnalyseImage of FociMF_Engine.py for the cells of one synthetic image. Adds the time of every stage to timings
+	# and returns the accuracy counts (found, known, matched, cells with the right number of foci, sum of the count errors).
+	start = time.perf_counter()
+	noise_tolerance = Noise_Tolerance(GFP, params['noise_toler'])
+	if params['TresSelect']:
+		threshold = params['manualTres']
+	else:
+		threshold = ThresholdEst(DAPI, GFP, params['thres_a'], params['thres_b'])
+	timings['ThresholdEst'] += time.perf_counter() - start
+	sigma_foci = params['sigma_foci'] if params['Gaussian_blur_use'] else None
+	accuracy = np.zeros(5)
+	for name, xs, ys, foci in cells:
+		start = time.perf_counter()
+		bounds, inside = Cell_ROI([(xs, ys)], DAPI.shape)
+		DAPI_crop = Crop_Cell(DAPI, bounds, inside)
+		GFP_crop = Crop_Cell(GFP, bounds, inside)
+		timings['crop'] += time.perf_counter() - start
+		start = time.perf_counter()
+		cell_mask, Area_Cell = Measure_Cell_Area(DAPI_crop, inside, params)
+		timings['area'] += time.perf_counter() - start
+		if not cell_mask.any():
+			continue
+		start = time.perf_counter()
+		excludeDAPI(DAPI_crop, cell_mask)
+		timings['DAPI'] += time.perf_counter() - start
+		start = time.perf_counter()
+		Points, maxima_points = findFoci(GFP_crop, cell_mask, threshold, noise_tolerance, sigma_foci)[:2]
+		timings['findFoci'] += time.perf_counter() - start
+		y0, y1, x0, x1 = bounds
+		found = [(x + x0, y + y0) for x, y in maxima_points]
+		accuracy += [len(found), len(foci), match_foci(found, foci), len(found) == len(foci), abs(len(found) - len(foci))]
+	return accuracy
+
+def benchmark(size, n_cells, n_images, params, rng, write=None):
+	# Throughput, memory and accuracy of one configuration
+	stages = ('ThresholdEst', 'crop', 'area', 'DAPI', 'findFoci')
+	timings = dict((stage, 0.0) for stage in stages)
+	accuracy = np.zeros(5)
+	cells_analysed = 0
+	peak = 0
+	for k in range(n_images):
+		DAPI, GFP, cells = synthetic_image(size, n_cells, rng)[:3]
+		if write:
+			save_image(write, 'synthetic_%d_%d_%d' % (size, n_cells, k), DAPI, GFP, cells)
+		# peak memory of the analysis of the first image (tracemalloc slows down the analysis, so it is not timed)
+		if k == 0:
+			tracemalloc.start()
+			analyse(DAPI, GFP, cells, params, dict(timings))
+			peak = tracemalloc.get_traced_memory()[1] + DAPI.nbytes + GFP.nbytes
+			tracemalloc.stop()
+		accuracy += analyse(DAPI, GFP, cells, params, timings)
+		cells_analysed += len(cells)
+	found, known, matched, exact, errors = accuracy
+	per_cell = sum(timings[stage] for stage in stages if stage != 'ThresholdEst')
+	total = sum(timings.values())
+	precision = matched / found if found else 1.0
+	recall = matched / known if known else 1.0
+	return {
+		'image_size': size,
+		'cells_per_image': n_cells,
+		'images': n_images,
+		'cells': cells_analysed,
+		'cells_per_s': round(cells_analysed / per_cell, 1) if per_cell else None,
+		'images_per_s': round(n_images / total, 3) if total else None,
+		'seconds': dict((stage, round(value, 4)) for stage, value in timings.items()),
+		'peak_memory_mb': round(peak / 1048576.0, 1),
+		'precision': round(precision, 4),
+		'recall': round(recall, 4),
+		'F1': round(2 * precision * recall / (precision + recall), 4) if precision + recall else 0.0,
+		'exact_count': round(exact / cells_analysed, 4) if cells_analysed else None,
+		'mean_count_error': round(errors / cells_analysed, 3) if cells_analysed else None,
+	}
+
+def segmentation(size, n_cells, n_images, factors, rng):
+	# Time of Cell_Segmentation per image and intersection over union of the masks with the known nuclei (IoU) for the full resolution
+	# and every binning factor, and of the binned masks with the full resolution mask (IoU_full)
+	seconds = dict((factor, 0.0) for factor in [1] + factors)
+	iou = dict((factor, 0.0) for factor in [1] + factors)
+	iou_full = dict((factor, 0.0) for factor in factors)
+	for k in range(n_images):
+		DAPI, GFP, cells, nuclei = synthetic_image(size, n_cells, rng)
+		t0 = time.perf_counter()
+		reference = Cell_Segmentation(DAPI)
+		seconds[1] += time.perf_counter() - t0
+		iou[1] += Mask_IoU(reference, nuclei)
+		for factor in factors:
+			t0 = time.perf_counter()
+			mask = Cell_Segmentation(DAPI, factor)
+			seconds[factor] += time.perf_counter() - t0
+			iou[factor] += Mask_IoU(mask, nuclei)
+			iou_full[factor] += Mask_IoU(mask, reference)
+	return {
+		'image_size': size,
+		'cells_per_image': n_cells,
+		'images': n_images,
+		'seconds_per_image': dict((str(factor), round(value / n_images, 4)) for factor, value in seconds.items()),
+		'IoU': dict((str(factor), round(value / n_images, 4)) for factor, value in iou.items()),
+		'IoU_full': dict((str(factor), round(value / n_images, 4)) for factor, value in iou_full.items()),
+	}
+
+def save_image(directory, name, DAPI, GFP, cells):
+	# The synthetic image as .tif (DAPI first, as the .zvi images) for FociMF_Engine.py, its ROI manager and its known foci
+	import tifffile
+	tifffile.imwrite(os.path.join(directory, name + '.tif'), np.stack([DAPI, GFP]), metadata={'axes': 'CYX'})
+	write_rois(os.path.join(directory, name + '_ROI.zip'), [(cell, xs, ys) for cell, xs, ys, foci in cells])
+	with open(os.path.join(directory, name + '_foci.json'), 'w') as f:
+		json.dump(dict((cell, [[round(x, 2), round(y, 2)] for x, y in foci]) for cell, xs, ys, foci in cells), f)
+
+def main():
+	parser = argparse.ArgumentParser(description='Throughput and accuracy of the foci analysis on synthetic images.')
+	parser.add_argument('--sizes', default='512,1024,2048', help='image sizes (pixels, square images)')
+	parser.add_argument('--cells', default='10,50,200', help='numbers of cells per image')
+	parser.add_argument('--images', type=int, default=3, help='images per configuration')
+	parser.add_argument('--params', help='parameter file (.json or .yaml) of the batch mode')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--output', help='save the results as JSON')
+	parser.add_argument('--write', help='directory for the synthetic images, ROI managers and known foci')
+	parser.add_argument('--segmentation', help='binning factors of the segmentation to compare with the full resolution, e.g. 2,4')
+	args = parser.parse_args()
+
+	params = load_params(args.params) if args.params else dict(DEFAULT_PARAMS)
+	rng = np.random.default_rng(args.seed)
+	if args.write and not os.path.isdir(args.write):
+		os.makedirs(args.write)
+	results = []
+	print('%6s %6s %7s %9s %9s %9s %9s %7s %7s %7s' % ('size', 'cells', 'images', 'cells/s', 'images/s', 'peak MB', 'F1', 'prec', 'recall', 'exact'))
+	for size in [int(value) for value in args.sizes.split(',')]:
+		for n_cells in [int(value) for value in args.cells.split(',')]:
+			result = benchmark(size, n_cells, args.images, params, rng, args.write)
+			results.append(result)
+			print('%6d %6d %7d %9s %9s %9.1f %9.4f %7.4f %7.4f %7s' % (size, result['cells'], args.images, result['cells_per_s'],
+				result['images_per_s'], result['peak_memory_mb'], result['F1'], result['precision'], result['recall'], result['exact_count']))
+	segmentations = []
+	if args.segmentation:
+		factors = [int(value) for value in args.segmentation.split(',')]
+		print('%6s %6s %7s %9s %9s %9s' % ('size', 'cells', 'bin', 's/image', 'IoU', 'IoU full'))
+		for size in [int(value) for value in args.sizes.split(',')]:
+			for n_cells in [int(value) for value in args.cells.split(',')]:
+				result = segmentation(size, n_cells, args.images, factors, rng)
+				segmentations.append(result)
+				print('%6d %6d %7d %9.3f %9.4f %9s' % (size, n_cells, 1, result['seconds_per_image']['1'], result['IoU']['1'], ''))
+				for factor in factors:
+					print('%6d %6d %7d %9.3f %9.4f %9.4f' % (size, n_cells, factor, result['seconds_per_image'][str(factor)],
+						result['IoU'][str(factor)], result['IoU_full'][str(factor)]))
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+	print('Peak memory of the process: %.1f MB' % maxrss)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({'params': params, 'synthetic': SYNTHETIC, 'seed': args.seed, 'process_peak_memory_mb': round(maxrss, 1),
+				'results': results, 'segmentation': segmentations}, f, indent=1)
+	return 0
+
+if __name__ == '__main__':
+	raise SystemExit(main())
@@ -0,0 +1,827 @@
+#!/usr/bin/env python3
+#########################################################################################################################################################
+######################################## STANDALONE (NUMPY) ENGINE OF THE FOCI SCRIPT "20210126 FociMF_ThresholdAuto.py" #################################
+#########################################################################################################################################################
+
+# Runs the same analysis as the Fiji script, but in CPython with NumPy/SciPy/scikit-image, so no Fiji and no JVM are needed.
+# It always reevaluates the saved ROI managers (<image>_ROI.zip), like the batch mode of the Fiji script, and reads the same
+# parameter file (see FociMF_params_example.json):
+#
+#     python3 FociMF_Engine.py params.json /path/to/images [--compare]
+#
+# The CSV files are written to Results_numpy/ with the same names and columns as the CSV files of the Fiji script in Results/.
+# With --compare every CSV file is compared with the Fiji CSV file of the same name and the differences are checked against
+# TOLERANCE below.
+#
+# Every ImageJ command of the Fiji script is reimplemented after the ImageJ source code (Subtract Background with the rolling
+# ball, Gaussian Blur, Enhance Contrast with equalization, the "Default" and "Otsu" auto-thresholds, Fill Holes, Watershed, Find Maxima,
+# 16-bit to 8-bit conversion). Known differences to Fiji:
+# - Subtract Background uses the rolling ball of scikit-image on the shrunken image, the interpolation back to full size is linear
+# - Watershed uses the watershed of scikit-image on the Euclidean distance map (ImageJ: its own EDM and flooding)
+# - ThresholdEst applies the "Default dark" threshold to the segmented DAPI image. The Fiji script sets no threshold on its
+#   segmentation, so "Convert to Mask" thresholds it with the ImageJ default instead.
+# - Find Maxima follows ImageJ MaximumFinder (non-strict, SINGLE_POINTS), float sorting errors are not corrected
+# With "results_store": "parquet" the results of all the images are written to one dataset Results_numpy/<folder>_results.parquet
+# instead of the CSV files (see FociMF_Store.py, export writes the CSV files from it).
+# With sweep_noise or sweep_threshold in the parameter file all the combinations are written to one long table
+# Results_numpy/<folder>_sweep_MaxFind_merged.csv, as in the sweep mode of the Fiji script.
+# The exclusion criteria come from FociMF_Reclassify.py, the raw measurements are saved in Results_numpy/*_raw_MaxFind_*.csv.
+# Images: .czi need the package czifile, .tif/.tiff need tifffile, .zvi can not be read without Bio-Formats.
+
+#########################################################################################################################################################
+#########################################IMPORT OF ALL THE USED LIBRARIES AND SELECTION OF PARAMETERS ###################################################
+#########################################################################################################################################################
+
+import argparse, csv, glob, json, math, os, struct, zipfile
+from collections import deque
+
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.restoration import rolling_ball
+from skimage.segmentation import watershed
+
+from FociMF_Reclassify import HEADER, RAW_HEADER, Raw_Name, Write_Results, classify_table, legacy_rows, raw_table
+from FociMF_Store import ResultsStore, default_path
+
+# Columns of the sweep files, as in the Fiji script
+SWEEP_HEADER = ['noise_toler', 'Noise tolerance', 'Threshold'] + HEADER
+
+# The same parameters as DEFAULT_PARAMS of the Fiji script
+DEFAULT_PARAMS = {
+	'pixel_size': 0.161,
+	'Gaussian_blur_use': False,
+	'sigma_foci': 1.0,
+	'TumorAnalysis': False,
+	'RoiManHave': False,
+	'noise_toler': 100.0,
+	'TresSelect': False,
+	'manualTres': 500.0,
+	'thres_a': 0.65,
+	'thres_b': 350.0,
+	'Min_cellarea': 15.0,
+	'Max_cellarea': 300.0,
+	'ExclutionCriteria': False,
+	'zeroMax': 3.0,
+	'zeroHom': 2.0,
+	'ExcluMean': 4.0,
+	'AreaAboveThres': 75.0,
+	'MaxFS': 5.0,
+	'DivideOEcells': False,
+	'HomoToDiv': 2.3,
+	'UserEstFociSize': 3.5,
+	'image_type': '.czi',
+	'workers': 1,
+	'fiji_executable': '',
+	'script_path': '',
+	'worker_memory': 0,
+	'crop_to_rois': False,
+	'prefetch': 1,
+	'prefetch_memory': 1024,
+	'cache': True,
+	'cache_dir': '',
+	'cache_size': 500,
+	'sweep_noise': [],
+	'sweep_threshold': [],
+	'results_store': '',
+	'python_executable': 'python3',
+	'cell_images': 'all',
+	'cell_images_every': 10,
+	'cell_images_flagged': True,
+	'cell_images_compress': False,
+	'cell_area': 'roi',
+	'cell_area_check': False,
+	'profile': False,
+	'picking': 'manual',
+	'auto_min_area': 15.0,
+	'auto_max_area': 300.0,
+	'auto_min_solidity': 0.9,
+	'auto_min_circularity': 0.5,
+	'auto_exclude_border': True,
+	'auto_min_DAPI': 0.0,
+	'auto_max_DAPI': 65535.0,
+	'auto_review': True,
+	'pick_first': False,
+	'segmentation_bin': 1,
+	'segmentation_check': False,
+	'segmentation_min_iou': 0.9,
+	'tile_size': 0,
+	'tile_overlap': 200,
+	'series': 'first',
+	'z_projection': 'first',
+	'timepoints': 'first',
+	'track_distance': 5.0,
+}
+
+# Parameters of the Fiji script that this engine does not implement: only these values (the defaults) are accepted by load_params
+UNSUPPORTED_PARAMS = {
+	'crop_to_rois': False,
+	'tile_size': 0,
+	'series': 'first',
+	'z_projection': 'first',
+	'timepoints': 'first',
+}
+
+# Accepted differences between the results of this engine and of Fiji for the same image and ROI manager (see compare_results).
+# Columns not listed have to be equal within the rounding of the CSV files.
+TOLERANCE = {
+	'N_Foci': 0.95,				# fraction of the cells with exactly the same number of foci
+	'N_Foci_diff': 1,			# largest accepted difference of the number of foci of one cell
+	'Cell Area': 0.02,			# relative difference
+	'% Area above threshold GFP': 1.0,	# absolute difference in %
+	'Foci size': 0.05,			# relative difference
+	'threshold': 0.02,			# relative difference of the automatic threshold of the image
+}
+
+def ij_round(x, ndigits=0):
+	# round() of the Jython 2 used by Fiji: halves are rounded away from zero (Python 3 rounds them to even)
+	factor = 10.0 ** ndigits
+	return math.copysign(math.floor(abs(x) * factor + 0.5), x) / factor
+
+def load_params(param_file):
+	# Reads the parameter file like loadParams of the Fiji script
+	with open(param_file, 'r') as f:
+		if param_file.endswith('.yaml') or param_file.endswith('.yml'):
+			import yaml
+			loaded = yaml.safe_load(f) or {}
+		else:
+			loaded = json.load(f)
+	unknown = [key for key in loaded if key not in DEFAULT_PARAMS]
+	if unknown:
+		raise ValueError('Unknown parameters in ' + param_file + ': ' + ', '.join(sorted(unknown)))
+	params = dict(DEFAULT_PARAMS)
+	params.update(loaded)
+	params['sweep_noise'] = [float(value) for value in params['sweep_noise']]
+	params['sweep_threshold'] = [float(value) for value in params['sweep_threshold']]
+	if params['results_store'] not in ('', 'parquet'):
+		raise ValueError('results_store has to be "" (CSV files) or "parquet"')
+	for key, value in sorted(UNSUPPORTED_PARAMS.items()):
+		if params[key] != value:
+			raise ValueError(key + ' ' + repr(params[key]) + ' is not supported by FociMF_Engine.py, it has to be ' + repr(value))
+	params['RoiManHave'] = True
+	params['TumorAnalysis'] = False
+	return params
+
+#########################################################################################################################################################
+############################################################ READING OF IMAGES AND ROIs ################################################################
+#########################################################################################################################################################
+
+def load_channels(filename):
+	# Returns the channels of a two-channel image as 2D arrays in the order of Bio-Formats (split channels)
+	if filename.endswith('.czi'):
+		import czifile
+		with czifile.CziFile(filename) as czi:
+			data = czi.asarray()
+			axes = czi.axes
+	elif filename.endswith('.tif') or filename.endswith('.tiff'):
+		import tifffile
+		with tifffile.TiffFile(filename) as tif:
+			data = tif.series[0].asarray()
+			axes = tif.series[0].axes
+	else:
+		raise ValueError('Only .czi and .tif images can be read without Bio-Formats: ' + filename)
+	# keep the channel, Y and X axes, take the first plane of all the others
+	index = tuple(slice(None) if axis in 'CYX' else 0 for axis in axes)
+	kept = [axis for axis in axes if axis in 'CYX']
+	data = data[index]
+	if 'C' not in kept:
+		return [data]
+	data = np.moveaxis(data, kept.index('C'), 0)
+	return [data[c] for c in range(data.shape[0])]
+
+def read_rois(ROIopenpath):
+	# Reads a ROI manager saved by ImageJ (.zip of .roi files). Returns a list of (name, polygons), where polygons is a list of
+	# (xs, ys) outlines in pixel coordinates. Rectangles, ovals, polygons and composite ROIs are supported.
+	ROIs = []
+	with zipfile.ZipFile(ROIopenpath) as zf:
+		for name in zf.namelist():
+			if name.endswith('.roi'):
+				ROIs.append(decode_roi(zf.read(name), name[:-4]))
+	return ROIs
+
+def decode_roi(data, default_name):
+	# Decodes one .roi file, see ij.io.RoiDecoder
+	if data[0:4] != b'Iout':
+		raise ValueError('Not an ImageJ ROI: ' + default_name)
+	version = struct.unpack('>h', data[4:6])[0]
+	roi_type = data[6]
+	top, left, bottom, right, n = struct.unpack('>hhhhH', data[8:18])
+	options = struct.unpack('>h', data[50:52])[0]
+	shape_length = struct.unpack('>i', data[36:40])[0]
+	header2 = struct.unpack('>i', data[60:64])[0]
+	name = default_name
+	if version >= 218 and header2 > 0 and header2 + 24 <= len(data):
+		name_offset, name_length = struct.unpack('>ii', data[header2 + 16:header2 + 24])
+		if name_offset > 0 and name_length > 0:
+			name = data[name_offset:name_offset + 2 * name_length].decode('utf-16-be')
+	if shape_length > 0:
+		# composite ROI: path segments as floats (type 0: moveTo, 1: lineTo, 4: close)
+		values = struct.unpack('>' + 'f' * shape_length, data[64:64 + 4 * shape_length])
+		polygons = []
+		xs, ys = [], []
+		i = 0
+		while i < len(values):
+			segment = int(values[i])
+			if segment in (0, 1):
+				if segment == 0 and xs:
+					polygons.append((np.array(xs), np.array(ys)))
+					xs, ys = [], []
+				xs.append(values[i + 1])
+				ys.append(values[i + 2])
+				i += 3
+			elif segment == 4:
+				if xs:
+					polygons.append((np.array(xs), np.array(ys)))
+				xs, ys = [], []
+				i += 1
+			else:
+				raise ValueError('Curved composite ROIs are not supported: ' + name)
+		if xs:
+			polygons.append((np.array(xs), np.array(ys)))
+		return name, polygons
+	if roi_type == 1:
+		xs = np.array([left, right, right, left], dtype=float)
+		ys = np.array([top, top, bottom, bottom], dtype=float)
+		return name, [(xs, ys)]
+	if roi_type == 2:
+		t = np.linspace(0, 2 * np.pi, max(4 * (right - left + bottom - top), 16), endpoint=False)
+		xs = (left + right) / 2.0 + (right - left) / 2.0 * np.cos(t)
+		ys = (top + bottom) / 2.0 + (bottom - top) / 2.0 * np.sin(t)
+		return name, [(xs, ys)]
+	if roi_type in (0, 7, 8):
+		base = 64
+		xs = np.array(struct.unpack('>' + 'h' * n, data[base:base + 2 * n]), dtype=float) + left
+		ys = np.array(struct.unpack('>' + 'h' * n, data[base + 2 * n:base + 4 * n]), dtype=float) + top
+		if options & 128:
+			# sub-pixel resolution coordinates follow the integer ones
+			base = 64 + 4 * n
+			xs = np.array(struct.unpack('>' + 'f' * n, data[base:base + 4 * n]), dtype=float)
+			ys = np.array(struct.unpack('>' + 'f' * n, data[base + 4 * n:base + 8 * n]), dtype=float)
+		return name, [(xs, ys)]
+	raise ValueError('ROI type ' + str(roi_type) + ' is not supported: ' + name)
+
+def encode_roi(xs, ys):
+	# .roi file of a polygon with integer coordinates, see ij.io.RoiEncoder
+	xs = np.round(np.asarray(xs)).astype(int)
+	ys = np.round(np.asarray(ys)).astype(int)
+	left, top = int(xs.min()), int(ys.min())
+	header = bytearray(64)
+	header[0:4] = b'Iout'
+	struct.pack_into('>h', header, 4, 227)
+	header[6] = 0
+	struct.pack_into('>hhhhH', header, 8, top, left, int(ys.max()), int(xs.max()), len(xs))
+	return bytes(header) + struct.pack('>' + 'h' * len(xs), *(xs - left)) + struct.pack('>' + 'h' * len(ys), *(ys - top))
+
+def write_rois(ROIsavepath, ROIs):
+	# Saves a list of (name, xs, ys) polygons as a ROI manager (.zip of .roi files) that the Fiji script can open
+	with zipfile.ZipFile(ROIsavepath, 'w') as zf:
+		for name, xs, ys in ROIs:
+			zf.writestr(name + '.roi', encode_roi(xs, ys))
+
+def roi_mask(polygons, shape):
+	# Pixels of the image whose centres are inside the ROI (even-odd rule over all the outlines, like ImageJ)
+	mask = np.zeros(shape, dtype=bool)
+	centres_x = np.arange(shape[1]) + 0.5
+	for y in range(shape[0]):
+		yc = y + 0.5
+		crossings = []
+		for xs, ys in polygons:
+			x0, y0 = xs, ys
+			x1, y1 = np.roll(xs, -1), np.roll(ys, -1)
+			hit = (y0 <= yc) != (y1 <= yc)
+			if np.any(hit):
+				crossings.extend(x0[hit] + (yc - y0[hit]) * (x1[hit] - x0[hit]) / (y1[hit] - y0[hit]))
+		if crossings:
+			inside = np.sum(centres_x[:, None] > np.array(crossings)[None, :], axis=1) % 2 == 1
+			mask[y] = inside
+	return mask
+
+def roi_bounds(polygons, shape):
+	# Bounding box (y0, y1, x0, x1) of the ROI clipped to the image
+	xs = np.concatenate([p[0] for p in polygons])
+	ys = np.concatenate([p[1] for p in polygons])
+	x0 = max(int(math.floor(xs.min())), 0)
+	y0 = max(int(math.floor(ys.min())), 0)
+	x1 = min(int(math.ceil(xs.max())), shape[1])
+	y1 = min(int(math.ceil(ys.max())), shape[0])
+	return y0, y1, x0, x1
+
+#########################################################################################################################################################
+############################################################### IMAGEJ COMMANDS #########################################################################
+#########################################################################################################################################################
+
+def to_8bit(img, display_min=None, display_max=None):
+	# "8-bit" of a 16-bit image with the display range (default: min and max of the image), see ij.process.TypeConverter
+	if img.dtype == np.uint8:
+		return img.copy()
+	lo = int(img.min()) if display_min is None else int(display_min)
+	hi = int(img.max()) if display_max is None else int(display_max)
+	scale = 256.0 / (hi - lo + 1)
+	value = np.maximum(img.astype(np.float64) - lo, 0)
+	return np.minimum((value * scale + 0.5).astype(np.int64), 255).astype(np.uint8)
+
+def subtract_background(img8, radius):
+	# "Subtract Background..." with rolling ball, dark background and smoothing, see ij.plugin.filter.BackgroundSubtracter
+	shrink = 1 if radius <= 10 else 2 if radius <= 30 else 4 if radius <= 100 else 8
+	smoothed = ndi.uniform_filter(img8.astype(np.float64), size=3, mode='nearest')
+	h, w = smoothed.shape
+	sh, sw = int(math.ceil(h / float(shrink))), int(math.ceil(w / float(shrink)))
+	padded = np.pad(smoothed, ((0, sh * shrink - h), (0, sw * shrink - w)), mode='edge')
+	small = padded.reshape(sh, shrink, sw, shrink).min(axis=(1, 3))
+	background = rolling_ball(small, radius=radius / float(shrink))
+	if shrink > 1:
+		# linear interpolation between the centres of the shrunken pixels
+		centres_y = np.arange(sh) * shrink + (shrink - 1) / 2.0
+		centres_x = np.arange(sw) * shrink + (shrink - 1) / 2.0
+		rows = np.array([np.interp(np.arange(w), centres_x, row) for row in background])
+		background = np.array([np.interp(np.arange(h), centres_y, col) for col in rows.T]).T
+	result = img8.astype(np.float64) - background
+	return np.clip(np.floor(result + 0.5), 0, 255).astype(np.uint8)
+
+def bin_image(img8, factor):
+	# "Bin" with the average of factor x factor pixels (ImageProcessor.bin), the incomplete blocks at the right and bottom are left out
+	h, w = img8.shape[0] // factor, img8.shape[1] // factor
+	blocks = img8[:h * factor, :w * factor].astype(np.float64).reshape(h, factor, w, factor)
+	return np.floor(blocks.mean(axis=(1, 3)) + 0.5).astype(np.uint8)
+
+def enlarge(img, factor, shape, order=1):
+	# Binned image back to the full shape: nearest pixel (order=0) or linear interpolation between the centres of the bins (order=1)
+	if order == 0:
+		zoomed = np.repeat(np.repeat(img, factor, axis=0), factor, axis=1)
+	else:
+		zoomed = ndi.zoom(img.astype(np.float64), factor, order=1, mode='nearest', grid_mode=True)
+	zoomed = zoomed[:shape[0], :shape[1]]
+	return np.pad(zoomed, ((0, shape[0] - zoomed.shape[0]), (0, shape[1] - zoomed.shape[1])), mode='edge')
+
+def enlarge_region(img, factor, y0, y1, x0, x1):
+	# enlarge(img, factor, shape)[y0:y1, x0:x1] (linear interpolation between the centres of the bins) without the rest of the image
+	def weights(start, stop, n):
+		# the pixels beyond the last bin have the values of its last row or column (as after np.pad with 'edge' in enlarge)
+		centre = np.clip((np.minimum(np.arange(start, stop), n * factor - 1) + 0.5) / factor - 0.5, 0, n - 1)
+		low = np.minimum(np.floor(centre).astype(np.int64), max(n - 2, 0))
+		return low, np.minimum(low + 1, n - 1), centre - low
+	top, bottom, wy = weights(y0, y1, img.shape[0])
+	left, right, wx = weights(x0, x1, img.shape[1])
+	rows = img[top] * (1 - wy)[:, None] + img[bottom] * wy[:, None]
+	return rows[:, left] * (1 - wx) + rows[:, right] * wx
+
+# Radius of the kernel of gaussian_blur with sigma 1 (truncate 4.0)
+BLUR_MARGIN = 4
+
+def gaussian_blur(img, sigma):
+	# "Gaussian Blur..." with the same bit depth as the input
+	blurred = ndi.gaussian_filter(img.astype(np.float64), sigma, mode='nearest', truncate=4.0)
+	info = np.iinfo(img.dtype)
+	return np.clip(np.floor(blurred + 0.5), info.min, info.max).astype(img.dtype)
+
+def equalize(img8):
+	# "Enhance Contrast..." with "equalize": square root histogram equalization, see ij.plugin.ContrastEnhancer
+	histogram = np.bincount(img8.ravel(), minlength=256).astype(np.float64)
+	weighted = np.where(histogram < 2, histogram, np.sqrt(histogram))
+	total = weighted[0] + 2 * weighted[1:255].sum() + weighted[255]
+	scale = 255.0 / total
+	lut = np.zeros(256, dtype=np.int64)
+	running = 0.0
+	for i in range(1, 255):
+		running += weighted[i]
+		lut[i] = int(ij_round(running * scale))
+		running += weighted[i]
+	lut[255] = 255
+	return lut[img8].astype(np.uint8)
+
+def default_threshold(histogram):
+	# The "Default" (modified IsoData) auto-threshold of ImageJ, see ij.process.AutoThresholder.IJDefault
+	data = np.array(histogram, dtype=np.float64)
+	maxValue = len(data) - 1
+	data[0] = 0
+	data[maxValue] = 0
+	nonzero = np.nonzero(data)[0]
+	if len(nonzero) == 0 or nonzero[0] >= nonzero[-1]:
+		return len(data) // 2
+	lo, hi = nonzero[0], nonzero[-1]
+	index = np.arange(len(data))
+	movingIndex = lo
+	while True:
+		below = data[lo:movingIndex + 1]
+		above = data[movingIndex + 1:hi + 1]
+		result = ((index[lo:movingIndex + 1] * below).sum() / below.sum() + (index[movingIndex + 1:hi + 1] * above).sum() / above.sum()) / 2.0
+		movingIndex += 1
+		if not ((movingIndex + 1) <= result and movingIndex < hi - 1):
+			break
+	return int(ij_round(result))
+
+def otsu_threshold(histogram):
+	# The "Otsu" auto-threshold of ImageJ, see ij.process.AutoThresholder.Otsu (the last grey value with the largest between-class variance)
+	data = np.array(histogram, dtype=np.float64)
+	index = np.arange(len(data))
+	N, S = data.sum(), (index * data).sum()
+	N1, Sk = np.cumsum(data)[1:-1], np.cumsum(index * data)[1:-1]
+	denom = N1 * (N - N1)
+	bcv = np.where(denom != 0, (N1 / N * S - Sk) ** 2 / np.where(denom != 0, denom, 1), 0.0)
+	return len(bcv) - int(np.argmax(bcv[::-1]))
+
+def dark_mask(img8):
+	# setAutoThreshold "Default dark" followed by "Convert to Mask"
+	level = default_threshold(np.bincount(img8.ravel(), minlength=256))
+	return img8 > level
+
+def ij_watershed(mask):
+	# "Watershed" of a binary mask: separation lines between touching objects along the Euclidean distance map
+	edm = ndi.distance_transform_edt(mask)
+	# maxima of the EDM with a prominence of 0.5 like the EDM maxima of ImageJ
+	seeds = find_maxima(edm, 0.5, None, mask)
+	markers = np.zeros(mask.shape, dtype=np.int32)
+	for i, (x, y) in enumerate(seeds):
+		markers[y, x] = i + 1
+	labels = watershed(-edm, markers, mask=mask, watershed_line=True)
+	return labels > 0
+
+def find_maxima(img, tolerance, threshold, mask=None):
+	# "Find Maxima" with SINGLE_POINTS output (non-strict, edges included), see ij.plugin.filter.MaximumFinder.analyseMaxima
+	# Returns the list of (x, y) of the maxima inside mask.
+	values = img.astype(np.float64)
+	h, w = values.shape
+	neighbours = ndi.maximum_filter(values, size=3, mode='constant', cval=-np.inf)
+	candidates = (values >= neighbours) & (values > values.min())
+	if threshold is not None:
+		candidates &= values >= threshold
+	if mask is not None:
+		candidates &= mask
+	ys, xs = np.nonzero(candidates)
+	order = np.argsort(-values[ys, xs], kind='stable')
+	processed = np.zeros((h, w), dtype=bool)
+	maxima = []
+	for k in order:
+		x0, y0 = xs[k], ys[k]
+		if processed[y0, x0]:
+			continue
+		v0 = values[y0, x0]
+		listed = {(x0, y0)}
+		queue = deque([(x0, y0)])
+		equal = [(x0, y0)]
+		maxPossible = True
+		while queue and maxPossible:
+			x, y = queue.popleft()
+			for dy in (-1, 0, 1):
+				for dx in (-1, 0, 1):
+					x2, y2 = x + dx, y + dy
+					if (dx == 0 and dy == 0) or x2 < 0 or y2 < 0 or x2 >= w or y2 >= h or (x2, y2) in listed:
+						continue
+					if processed[y2, x2]:
+						# reached the area of a higher maximum
+						maxPossible = False
+						break
+					v2 = values[y2, x2]
+					if v2 > v0:
+						maxPossible = False
+						break
+					if v2 >= v0 - tolerance:
+						listed.add((x2, y2))
+						queue.append((x2, y2))
+						if v2 == v0:
+							equal.append((x2, y2))
+				if not maxPossible:
+					break
+		for x, y in listed:
+			processed[y, x] = True
+		if maxPossible:
+			# one point of a flat maximum: the one nearest to the centre of the equal points
+			cx = np.mean([p[0] for p in equal])
+			cy = np.mean([p[1] for p in equal])
+			maxima.append(min(equal, key=lambda p: (p[0] - cx) ** 2 + (p[1] - cy) ** 2))
+	return maxima
+
+#########################################################################################################################################################
+#################################################### DEFINITION OF FUNCTIONS TO BE USED IN THE MAIN #####################################################
+#########################################################################################################################################################
+
+def ThresholdEst(DAPI, foci, thres_a, thres_b):
+	# threshold = a * MEAN + b with the mean of the foci channel outside the cells segmented from the DAPI channel
+	DAPI_seg = to_8bit(DAPI)
+	DAPI_seg = subtract_background(DAPI_seg, 100)
+	DAPI_seg = gaussian_blur(DAPI_seg, 5)
+	DAPI_seg = equalize(DAPI_seg)
+	cells = ndi.binary_fill_holes(dark_mask(DAPI_seg))
+	return ij_round(thres_a * foci[~cells].mean() + thres_b)
+
+def Cell_Segmentation(DAPI, factor=1):
+	# Binary mask of the nuclei, the same steps as Cell_Segmentation of the Fiji script. With factor > 1 the nuclei are segmented
+	# on the DAPI channel binned factor x factor and only their borders are thresholded again at full resolution (Binned_Segmentation).
+	DAPI8 = to_8bit(DAPI)
+	if factor > 1:
+		return ij_watershed(Binned_Segmentation(DAPI8, factor))
+	DAPI8 = subtract_background(DAPI8, 50)
+	DAPI8 = gaussian_blur(DAPI8, 1)
+	return ij_watershed(ndi.binary_fill_holes(nuclei_mask(DAPI8)))
+
+def nuclei_mask(blurred):
+	# "Enhance Contrast..." with "equalize" and the "Default dark" threshold of the background subtracted and blurred DAPI channel, 
+	# but never below the "Otsu dark" threshold of the blurred channel itself (Nuclei_Level of the Fiji script). In sparse fields
+	# the equalization spreads the background noise over most of the grey values and the threshold of the equalized image lands in it.
+	# Both thresholds are thresholds of the blurred grey values (the equalization keeps their order), so the higher one is the intersection.
+	return dark_mask(equalize(blurred)) & (blurred > otsu_threshold(np.bincount(blurred.ravel(), minlength=256)))
+
+def Binned_Segmentation(DAPI8, factor):
+	# Mask of the nuclei (before the watershed) like Segmentation_Pyramid of the Fiji script: background, threshold and mask of the 
+	# binned image, then the pixels within factor pixels of the borders of the mask are thresholded at full resolution with the 
+	# interpolated background and the threshold of the binned image (in grey values before the equalization).
+	small = bin_image(DAPI8, factor)
+	subtracted = subtract_background(small, 50.0 / factor)
+	background = small.astype(np.float64) - subtracted
+	blurred = gaussian_blur(subtracted, 1.0 / factor)
+	above = nuclei_mask(blurred)
+	if not above.any():
+		return np.zeros(DAPI8.shape, dtype=bool)
+	# the equalization does not change the order of the grey values, so the threshold is the darkest pixel above it
+	level = blurred[above].min()
+	filled = ndi.binary_fill_holes(above)
+	mask = enlarge(filled, factor, DAPI8.shape, order=0)
+	# the pixels within factor pixels of a border of the enlarged mask are the bins next to a border of the binned mask
+	border = ndi.maximum_filter(filled, size=3) != ndi.minimum_filter(filled, size=3)
+	# the full resolution DAPI channel is background subtracted and blurred only in the boxes around the borders, with a margin of
+	# the radius of the blur (BLUR_MARGIN), so the pixels of the boxes are the same as with the whole image
+	h, w = DAPI8.shape
+	for box in ndi.find_objects(ndi.label(border, structure=np.ones((3, 3)))[0]):
+		y0, y1 = box[0].start * factor, (h if box[0].stop == filled.shape[0] else box[0].stop * factor)
+		x0, x1 = box[1].start * factor, (w if box[1].stop == filled.shape[1] else box[1].stop * factor)
+		Y0, Y1, X0, X1 = max(y0 - BLUR_MARGIN, 0), min(y1 + BLUR_MARGIN, h), max(x0 - BLUR_MARGIN, 0), min(x1 + BLUR_MARGIN, w)
+		subtracted = np.floor(DAPI8[Y0:Y1, X0:X1] - enlarge_region(background, factor, Y0, Y1, X0, X1) + 0.5)
+		full = gaussian_blur(np.clip(subtracted, 0, 255).astype(np.uint8), 1)[y0 - Y0:y1 - Y0, x0 - X0:x1 - X0]
+		band = enlarge(border[box], factor, (y1 - y0, x1 - x0), order=0)
+		mask[y0:y1, x0:x1][band] = full[band] >= level
+	return ndi.binary_fill_holes(mask)
+
+def Mask_IoU(mask, reference):
+	# Intersection over union of two masks (1.0 if both are empty)
+	union = np.count_nonzero(mask | reference)
+	return np.count_nonzero(mask & reference) / float(union) if union else 1.0
+
+def Cell_ROI(polygons, shape):
+	# Bounding box of the ROI in an image of the given shape and the mask of the ROI in this box
+	y0, y1, x0, x1 = roi_bounds(polygons, shape)
+	shifted = [(xs - x0, ys - y0) for xs, ys in polygons]
+	return (y0, y1, x0, x1), roi_mask(shifted, (y1 - y0, x1 - x0))
+
+def Crop_Cell(channel, bounds, inside):
+	# Crops the bounding box of the ROI and sets the pixels outside the ROI to the minimum of the channel (the value that
+	# "Clear Outside" uses with black background after the display range of the channel is reset)
+	y0, y1, x0, x1 = bounds
+	crop = channel[y0:y1, x0:x1].copy()
+	crop[~inside] = channel.min()
+	return crop
+
+def Cell_Area(crop, pixel_size):
+	# Mask and area (um^2) of the cell: Enhance Contrast (saturated=0.35), 8-bit and threshold 1-255 of the cropped channel
+	values = np.sort(crop.ravel())
+	saturated = int(len(values) * 0.35 / 200.0)
+	display_min = values[min(saturated, len(values) - 1)]
+	display_max = values[max(len(values) - 1 - saturated, 0)]
+	if display_max <= display_min:
+		display_min, display_max = values[0], values[-1]
+	cell_mask = to_8bit(crop, display_min, display_max) >= 1
+	Area = ij_round(cell_mask.sum() * pixel_size * pixel_size, 2)
+	return cell_mask, Area
+
+def Measure_Cell_Area(crop, inside, params):
+	# Mask and area of the cell with the method of cell_area: "roi" (the picked ROI) or "legacy" (Cell_Area of the crop)
+	if params['cell_area'] == 'legacy':
+		return Cell_Area(crop, params['pixel_size'])
+	return inside, ij_round(inside.sum() * params['pixel_size'] * params['pixel_size'], 2)
+
+def excludeDAPI(crop, cell_mask):
+	# Intensity statistics of the DAPI channel inside the cell
+	pixels = crop[cell_mask].astype(np.float64)
+	DAminV = ij_round(pixels.min(), 2)
+	DAmaxV = ij_round(pixels.max(), 2)
+	DAmeanV = ij_round(pixels.mean(), 2)
+	DAhomogen = ij_round(DAmaxV / DAmeanV, 3)
+	return DAmeanV, DAminV, DAmaxV, DAhomogen
+
+def findFoci(crop, cell_mask, threshold, noise_tolerance, sigma_foci=None):
+	# Foci (maxima) of the GFP channel inside the cell and the intensity statistics of the cell
+	if sigma_foci:
+		crop = gaussian_blur(crop, sigma_foci)
+	pixels = crop[cell_mask].astype(np.float64)
+	minV = ij_round(pixels.min(), 2)
+	maxV = ij_round(pixels.max(), 2)
+	meanV = ij_round(pixels.mean(), 2)
+	PecentAreaThres = ij_round(np.count_nonzero(pixels > threshold) / float(len(pixels)) * 100, 2)
+	GFPhomogen = ij_round(maxV / meanV, 3)
+	maxima_points = find_maxima(crop, noise_tolerance, threshold, cell_mask)
+	return str(len(maxima_points)), maxima_points, meanV, minV, maxV, PecentAreaThres, GFPhomogen
+
+def Sweep_Foci(crop, cell_mask, thresholds, tolerances, sigma_foci=None):
+	# findFoci for all the combinations of thresholds and noise tolerances with one blurring and one measurement of the cell
+	if sigma_foci:
+		crop = gaussian_blur(crop, sigma_foci)
+	pixels = crop[cell_mask].astype(np.float64)
+	minV = ij_round(pixels.min(), 2)
+	maxV = ij_round(pixels.max(), 2)
+	meanV = ij_round(pixels.mean(), 2)
+	GFPhomogen = ij_round(maxV / meanV, 3)
+	combinations = []
+	for threshold in thresholds:
+		PecentAreaThres = ij_round(np.count_nonzero(pixels > threshold) / float(len(pixels)) * 100, 2)
+		for noise_tolerance in tolerances:
+			Points = str(len(find_maxima(crop, noise_tolerance, threshold, cell_mask)))
+			combinations.append((threshold, noise_tolerance, Points, PecentAreaThres))
+	return meanV, minV, maxV, GFPhomogen, combinations
+
+##############################################################################################################################################
+######################################################## MAIN FUNCTION #######################################################################
+##############################################################################################################################################
+
+def Split_Channels(filename, imps):
+	# DAPI and GFP, they are in the opposite direction in the .czi and .zvi image formats
+	if filename.endswith('.czi'):
+		return imps[1], imps[0]
+	return imps[0], imps[1]
+
+def Noise_Tolerance(GFP, noise_toler):
+	# noise tolerance scaled for images with a low exposure
+	helpMax = float(GFP.max())
+	if helpMax < 4095:
+		return ij_round(float(noise_toler) / (4095 / helpMax))
+	return noise_toler
+
+def AnalyseImage(filename, params, resultpath2, store=None):
+	# Analysis of all the cells of the saved ROI manager of one image. Returns the name of the CSV file or '' if skipped.
+	# With a store (FociMF_Store.ResultsStore) the cells are added to the dataset and no CSV file is written.
+	resultpathROI = os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] + "_ROI.zip")
+	if not os.path.isfile(resultpathROI):
+		print('No saved ROI manager for ' + filename + ', the image is skipped.')
+		return ''
+	# only the DAPI and GFP channels are used
+	imps = load_channels(filename)[:2]
+	DAPI, GFP = Split_Channels(filename, imps)
+
+	noise_tolerance = Noise_Tolerance(GFP, params['noise_toler'])
+	if params['TresSelect']:
+		threshold = params['manualTres']
+	else:
+		threshold = ThresholdEst(DAPI, GFP, params['thres_a'], params['thres_b'])
+	sigma_foci = params['sigma_foci'] if params['Gaussian_blur_use'] else None
+
+	nameCSV = os.path.join(resultpath2, os.path.basename(filename)[:-4] + '_results_MaxFind_ROI_noiseTol_' + str(noise_tolerance) + '_UserThreshold_' + str(threshold) + '.csv')
+	rawRows = []
+	for name, polygons in read_rois(resultpathROI):
+		bounds, inside = Cell_ROI(polygons, imps[0].shape)
+		crops = [Crop_Cell(imp, bounds, inside) for imp in imps]
+		# Cell_Area of the Fiji script uses the first slice of the cell stack for both image formats
+		cell_mask, Area_Cell = Measure_Cell_Area(crops[0], inside, params)
+		if not cell_mask.any():
+			continue
+		DAPI_crop, GFP_crop = Split_Channels(filename, crops)
+		DAmeanV, DAminV, DAmaxV, DAhomogen = excludeDAPI(DAPI_crop, cell_mask)
+		Points, maxima_points, meanV, minV, maxV, PecentAreaThres, GFPhomogen = findFoci(GFP_crop, cell_mask, threshold, noise_tolerance, sigma_foci)
+		if int(Points) == 0:
+			FS = "NA"
+		else:
+			FS = ij_round(float(Area_Cell) * float(PecentAreaThres) / 100 / int(Points), 3)
+		rawRows.append([name, DAminV, DAmaxV, DAmeanV, DAhomogen, minV, maxV, meanV, GFPhomogen, PecentAreaThres, FS, Area_Cell, Points, threshold])
+	# the exclusion criteria are applied to the raw measurements like in the Fiji script
+	if store is not None:
+		store.append(os.path.basename(filename)[:-4], noise_tolerance, rawRows, classify_table(raw_table(rawRows), params))
+		return nameCSV
+	with open(Raw_Name(nameCSV), 'w', newline='') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(RAW_HEADER)
+		spamwriter.writerows(rawRows)
+	Write_Results(nameCSV, rawRows, params)
+	return nameCSV
+
+def SweepImage(filename, params, resultpath2):
+	# All the combinations of sweep_noise and sweep_threshold for one image like SweepImage of the Fiji script.
+	# Returns the name of the sweep file or '' if skipped.
+	resultpathROI = os.path.join(os.path.dirname(filename), os.path.basename(filename)[:-4] + "_ROI.zip")
+	if not os.path.isfile(resultpathROI):
+		print('No saved ROI manager for ' + filename + ', the image is skipped.')
+		return ''
+	imps = load_channels(filename)[:2]
+	DAPI, GFP = Split_Channels(filename, imps)
+	if params['sweep_threshold']:
+		thresholds = params['sweep_threshold']
+	elif params['TresSelect']:
+		thresholds = [params['manualTres']]
+	else:
+		thresholds = [ThresholdEst(DAPI, GFP, params['thres_a'], params['thres_b'])]
+	tolerances = [(noise_toler, Noise_Tolerance(GFP, noise_toler)) for noise_toler in sorted(set(params['sweep_noise'] or [params['noise_toler']]))]
+	sigma_foci = params['sigma_foci'] if params['Gaussian_blur_use'] else None
+
+	rows = []
+	for name, polygons in read_rois(resultpathROI):
+		bounds, inside = Cell_ROI(polygons, imps[0].shape)
+		crops = [Crop_Cell(imp, bounds, inside) for imp in imps]
+		cell_mask, Area_Cell = Measure_Cell_Area(crops[0], inside, params)
+		if not cell_mask.any():
+			continue
+		DAPI_crop, GFP_crop = Split_Channels(filename, crops)
+		DAmeanV, DAminV, DAmaxV, DAhomogen = excludeDAPI(DAPI_crop, cell_mask)
+		meanV, minV, maxV, GFPhomogen, combinations = Sweep_Foci(GFP_crop, cell_mask, thresholds, sorted(set(used for noise_toler, used in tolerances)), sigma_foci)
+		for threshold, noise_tolerance, Points, PecentAreaThres in combinations:
+			if int(Points) == 0:
+				FS = "NA"
+			else:
+				FS = ij_round(float(Area_Cell) * float(PecentAreaThres) / 100 / int(Points), 3)
+			for noise_toler, used in tolerances:
+				if used == noise_tolerance:
+					rows.append([noise_toler, noise_tolerance, threshold, name, DAminV, DAmaxV, DAmeanV, DAhomogen,
+						minV, maxV, meanV, GFPhomogen, PecentAreaThres, FS, Area_Cell, Points])
+	# one block of cells per combination, the exclusion criteria are applied to all the rows at once (RAW_HEADER = HEADER + threshold)
+	rows.sort(key=lambda row: (row[0], row[2]))
+	rawRows = [row[3:] + [row[2]] for row in rows]
+	rows = [row[:3] + result for row, result in zip(rows, legacy_rows(rawRows, classify_table(raw_table(rawRows), params)))]
+	nameCSV = os.path.join(resultpath2, os.path.basename(filename)[:-4] + '_sweep_MaxFind.csv')
+	with open(nameCSV, 'w', newline='') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(SWEEP_HEADER)
+		spamwriter.writerows(rows)
+	return nameCSV
+
+def merge_sweeps(nameCSVs, nameMerged):
+	# One long table with the sweep files of all the images and an additional column with the name of the image
+	with open(nameMerged, 'w', newline='') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(['Image'] + SWEEP_HEADER)
+		for nameCSV in nameCSVs:
+			image = os.path.basename(nameCSV).split('_sweep_MaxFind')[0]
+			with open(nameCSV, 'r', newline='') as f:
+				rows = csv.reader(f, delimiter=',', quotechar='|')
+				next(rows, None)
+				for row in rows:
+					spamwriter.writerow([image] + row)
+
+def compare_results(engine_csv, fiji_csv):
+	# Differences between the CSV file of this engine and the one of Fiji for the same image. Returns (ok, report).
+	def read(name):
+		with open(name, 'r') as f:
+			return dict((row['Cell No'], row) for row in csv.DictReader(f, delimiter=',', quotechar='|'))
+	engine, fiji = read(engine_csv), read(fiji_csv)
+	cells = sorted(set(engine) & set(fiji))
+	report = {'cells': len(cells), 'missing': sorted(set(engine) ^ set(fiji))}
+	if not cells:
+		return False, report
+	def numbers(column):
+		pairs = []
+		for cell in cells:
+			try:
+				pairs.append((float(engine[cell][column]), float(fiji[cell][column])))
+			except ValueError:
+				pass
+		return np.array(pairs).reshape(-1, 2)
+	foci = numbers('N_Foci')
+	report['N_Foci'] = float(np.mean(foci[:, 0] == foci[:, 1])) if len(foci) else 1.0
+	report['N_Foci_diff'] = float(np.abs(foci[:, 0] - foci[:, 1]).max()) if len(foci) else 0.0
+	for column in ('Cell Area', 'Foci size'):
+		pairs = numbers(column)
+		report[column] = float((np.abs(pairs[:, 0] - pairs[:, 1]) / np.maximum(np.abs(pairs[:, 1]), 1e-9)).max()) if len(pairs) else 0.0
+	pairs = numbers('% Area above threshold GFP')
+	report['% Area above threshold GFP'] = float(np.abs(pairs[:, 0] - pairs[:, 1]).max()) if len(pairs) else 0.0
+	engine_threshold = float(engine_csv.rsplit('_UserThreshold_', 1)[1][:-4])
+	fiji_threshold = float(fiji_csv.rsplit('_UserThreshold_', 1)[1][:-4])
+	report['threshold'] = abs(engine_threshold - fiji_threshold) / max(abs(fiji_threshold), 1e-9)
+	ok = (not report['missing'] and report['N_Foci'] >= TOLERANCE['N_Foci'] and report['N_Foci_diff'] <= TOLERANCE['N_Foci_diff'] and
+		all(report[column] <= TOLERANCE[column] for column in ('Cell Area', '% Area above threshold GFP', 'Foci size', 'threshold')))
+	return ok, report
+
+def main():
+	parser = argparse.ArgumentParser(description='Foci analysis of the saved ROI managers without Fiji.')
+	parser.add_argument('param_file', help='parameter file (.json or .yaml) as for the batch mode of the Fiji script')
+	parser.add_argument('directory', help='directory with the images and their _ROI.zip files')
+	parser.add_argument('--compare', action='store_true', help='compare the results with the Fiji results in Results/')
+	args = parser.parse_args()
+
+	params = load_params(args.param_file)
+	resultpath2 = os.path.join(args.directory, 'Results_numpy')
+	if not os.path.isdir(resultpath2):
+		os.mkdir(resultpath2)
+	workDir = sorted(glob.glob(os.path.join(args.directory, '*' + params['image_type'])))
+	print('There are ' + str(len(workDir)) + ' images for analysis in this folder.')
+	if params['sweep_noise'] or params['sweep_threshold']:
+		nameCSVs = [nameCSV for nameCSV in (SweepImage(filename, params, resultpath2) for filename in workDir) if nameCSV]
+		merge_sweeps(nameCSVs, os.path.join(resultpath2, os.path.basename(os.path.normpath(args.directory)) + '_sweep_MaxFind_merged.csv'))
+		return 0
+	# one dataset for the whole run instead of the CSV files, the Fiji CSV files are compared with the CSV files only
+	store = None
+	if params['results_store'] == 'parquet' and not args.compare:
+		store = ResultsStore(default_path(resultpath2))
+	failed = 0
+	try:
+		for filename in workDir:
+			nameCSV = AnalyseImage(filename, params, resultpath2, store)
+			if nameCSV and args.compare:
+				# the Fiji CSV of the same image, its threshold can be a bit different
+				fiji = glob.glob(os.path.join(args.directory, 'Results', os.path.basename(filename)[:-4] + '_results_MaxFind_ROI_*.csv'))
+				if not fiji:
+					print('No Fiji results for ' + filename)
+					continue
+				ok, report = compare_results(nameCSV, max(fiji, key=os.path.getmtime))
+				failed += not ok
+				print(('OK      ' if ok else 'DIFFERS ') + os.path.basename(filename) + ' ' + json.dumps(report))
+	finally:
+		if store is not None:
+			store.close()
+			print('Results written to ' + store.path)
+	return 1 if failed else 0
+
+if __name__ == '__main__':
+	raise SystemExit(main())
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+#########################################################################################################################################################
+############################################## EXCLUSION CRITERIA APPLIED TO SAVED RAW MEASUREMENTS ####################################################
+#########################################################################################################################################################
+
+# The Fiji script (and FociMF_Engine.py) saves the measurements of every cell before the exclusion criteria in
+# Results/<image>_raw_MaxFind_*.csv. This script applies the exclusion criteria of a parameter file to these measurements again,
+# so the criteria can be tuned without opening any image:
+#
+#     python3 FociMF_Reclassify.py params.json /path/to/images/Results [--grid grid.json] [--output reclassified.csv]
+#
+# Without --grid the results files (<image>_results_MaxFind_*.csv) are written again with the criteria of params.json.
+# With --grid (a .json file with a list of values for some of the exclusion parameters, e.g. {"zeroMax": [2, 3, 4]}) all the
+# combinations are applied and written to one table (default Results/reclassified.csv) with a column for every parameter of the grid.
+# The table is typed: N_Foci and Foci size are numbers (empty for excluded cells and cells without foci), the column Status tells
+# what the criteria decided (counted, zero, divided, size or overexposed) and the Flag columns which rules apply to the cell.
+# The criteria are applied as rules over whole columns (RULES), so a parameter set takes about the same time for any number of cells.
+
+#########################################################################################################################################################
+#########################################IMPORT OF ALL THE USED LIBRARIES AND SELECTION OF PARAMETERS ###################################################
+#########################################################################################################################################################
+
+import argparse, csv, glob, itertools, json, os
+
+import numpy as np
+
+# The parameters of the exclusion criteria with the defaults of the Fiji script
+EXCLUSION_DEFAULTS = {
+	'Min_cellarea': 15.0,
+	'Max_cellarea': 300.0,
+	'ExclutionCriteria': False,
+	'zeroMax': 3.0,
+	'zeroHom': 2.0,
+	'ExcluMean': 4.0,
+	'AreaAboveThres': 75.0,
+	'MaxFS': 5.0,
+	'DivideOEcells': False,
+	'HomoToDiv': 2.3,
+	'UserEstFociSize': 3.5,
+}
+
+HEADER = ['Cell No', 'DAPI min', 'DAPI max', 'DAPI mean', 'DAPI homogeneity', 'GFP min', 'GFP max', 'GFP mean', 'GFP homogeneity',
+	'% Area above threshold GFP', 'Foci size', 'Cell Area', 'N_Foci']
+RAW_HEADER = HEADER + ['Threshold']
+
+# Status of a cell after the exclusion criteria: counted (the found foci), zero (a zero cell), divided (the foci estimated from the
+# area above the threshold, DivideOEcells), size (outside Min_cellarea and Max_cellarea) or overexposed. The results files of the
+# Fiji script write the excluded cells (size and overexposed) as "OE".
+EXCLUDED = ('size', 'overexposed')
+
+# The exclusion criteria as rules over whole columns of raw measurements: (status, flag column, condition). A cell gets the status
+# of the first rule that applies, like the elif chain of Classify in the Fiji script, the flag columns show all the rules that apply.
+RULES = [
+	('size', 'Flag size', lambda t, p: (t['Cell Area'] < p['Min_cellarea']) | (t['Cell Area'] > p['Max_cellarea'])),
+	('zero', 'Flag zero area', lambda t, p: t['% Area above threshold GFP'] == 0),
+	('zero', 'Flag zero max', lambda t, p: (t['GFP max'] < p['zeroMax'] * t['Threshold']) & (t['GFP homogeneity'] < p['zeroHom'])),
+	# the foci size is NaN for cells without foci and so never above MaxFS
+	('overexposed', 'Flag overexposed', lambda t, p: (t['GFP mean'] > p['ExcluMean'] * t['Threshold']) |
+		(t['% Area above threshold GFP'] > p['AreaAboveThres']) | (t['Foci size'] >= p['MaxFS'])),
+]
+FLAGS = [flag for status, flag, rule in RULES]
+# Columns of the typed results: N_Foci and Foci size are numbers (empty for excluded cells and cells without foci)
+TYPED_HEADER = HEADER + ['Status'] + FLAGS
+
+def py2_round(x):
+	# round() of the Jython 2 used by Fiji for arrays: halves are rounded away from zero
+	return np.floor(np.abs(x) + 0.5) * np.where(x < 0, -1, 1)
+
+def raw_table(rawRows):
+	# Columns of raw measurements rows (RAW_HEADER) as arrays, the foci size "NA" is NaN
+	columns = list(zip(*rawRows)) or [()] * len(RAW_HEADER)
+	table = {'Cell No': np.array(columns[0], dtype=object)}
+	for name, values in zip(RAW_HEADER[1:], columns[1:]):
+		table[name] = np.array([np.nan if value == 'NA' else float(value) for value in values], dtype=float)
+	return table
+
+def classify_table(table, params):
+	# Applies the exclusion criteria to all the cells of a raw_table at once. Returns the typed results: N_Foci and Foci size
+	# (NaN for excluded cells and cells without foci), Status and the flags of RULES.
+	points = table['N_Foci'].copy()
+	FS = table['Foci size'].copy()
+	status = np.full(len(points), 'counted', dtype=object)
+	classified = {}
+	undecided = np.full(len(points), params['ExclutionCriteria'] == True)
+	with np.errstate(invalid='ignore'):
+		for rule_status, flag, rule in RULES:
+			hit = rule(table, params)
+			classified[flag] = hit
+			status[hit & undecided] = rule_status
+			undecided &= ~hit
+	zero = status == 'zero'
+	points[zero] = 0
+	FS[zero | (status == 'size')] = 0
+	overexposed = status == 'overexposed'
+	if params['DivideOEcells'] == True:
+		# the overexposed cells are counted, the homogeneous ones get at least the estimate from the area above the threshold
+		estimate = py2_round(table['Cell Area'] * table['% Area above threshold GFP'] / 100 / params['UserEstFociSize'])
+		divided = overexposed & (table['GFP homogeneity'] > params['HomoToDiv']) & (points < estimate)
+		points[divided] = estimate[divided]
+		status[overexposed] = 'counted'
+		status[divided] = 'divided'
+	points[np.isin(status, EXCLUDED)] = np.nan
+	classified.update({'N_Foci': points, 'Foci size': FS, 'Status': status})
+	return classified
+
+def legacy_rows(rawRows, classified):
+	# Results rows (HEADER) with "OE" and "NA" as written by Classify of the Fiji script. Points is the text of the raw count there,
+	# so its last rule ("elif Points == 0") never applies and cells without foci keep the foci size "NA".
+	rows = []
+	for row, status, points in zip(rawRows, classified['Status'], classified['N_Foci']):
+		if status in EXCLUDED:
+			Points = "OE"
+		elif status == 'zero':
+			Points = 0
+		elif status == 'divided':
+			Points = float(points)
+		else:
+			Points = row[12]
+		if status in ('size', 'zero'):
+			FS = 0
+		else:
+			FS = row[10]
+		rows.append(list(row[:10]) + [FS, row[11], Points])
+	return rows
+
+def typed_rows(rawRows, classified):
+	# Rows of the typed results (TYPED_HEADER), NaN is written as an empty value
+	rows = []
+	for k, row in enumerate(rawRows):
+		FS, points = classified['Foci size'][k], classified['N_Foci'][k]
+		rows.append(list(row[:10]) + ['' if np.isnan(FS) else FS, row[11], '' if np.isnan(points) else int(points), classified['Status'][k]] +
+			[bool(classified[flag][k]) for flag in FLAGS])
+	return rows
+
+def typed_results(rawRows, resultRows):
+	# Typed results of results rows with "OE" and "NA" (e.g. written by the Fiji script). The status is read from the text,
+	# the flags are unknown (None) without the parameters of the exclusion criteria.
+	classified = {'N_Foci': [], 'Foci size': [], 'Status': []}
+	for raw, row in zip(rawRows, resultRows):
+		Points, FS = str(row[12]), str(row[10])
+		if Points == 'OE':
+			# only the size rule sets the foci size to the integer 0, a measured foci size is a float
+			status = 'size' if FS == '0' else 'overexposed'
+		elif Points == '0' and FS == '0':
+			status = 'zero'
+		elif '.' in Points:
+			status = 'divided'
+		else:
+			status = 'counted'
+		classified['Status'].append(status)
+		classified['N_Foci'].append(np.nan if Points == 'OE' else float(Points))
+		classified['Foci size'].append(np.nan if FS == 'NA' else float(FS))
+	classified = dict((name, np.array(values, dtype=object if name == 'Status' else float)) for name, values in classified.items())
+	classified.update((flag, np.full(len(resultRows), None, dtype=object)) for flag in FLAGS)
+	return classified
+
+def Write_Results(nameCSV, rawRows, params):
+	# Writes the results file from the raw measurements with the exclusion criteria of params
+	rows = legacy_rows(rawRows, classify_table(raw_table(rawRows), params))
+	with open(nameCSV, 'w', newline='') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(HEADER)
+		spamwriter.writerows(rows)
+
+def Raw_Name(nameCSV):
+	# Name of the raw measurements file that belongs to a results file
+	return os.path.join(os.path.dirname(nameCSV), os.path.basename(nameCSV).replace('_results_MaxFind_', '_raw_MaxFind_', 1))
+
+def load_exclusion_params(param_file):
+	# The exclusion criteria of a parameter file of the batch mode, the other parameters are not needed here
+	with open(param_file, 'r') as f:
+		if param_file.endswith('.yaml') or param_file.endswith('.yml'):
+			import yaml
+			loaded = yaml.safe_load(f) or {}
+		else:
+			loaded = json.load(f)
+	params = dict(EXCLUSION_DEFAULTS)
+	params.update((key, value) for key, value in loaded.items() if key in EXCLUSION_DEFAULTS)
+	return params
+
+def read_raw(resultpath2):
+	# All the raw measurements files of a Results directory: list of (name of the raw file, rows)
+	raw = []
+	for nameRaw in sorted(glob.glob(os.path.join(resultpath2, '*_raw_MaxFind_*.csv'))):
+		with open(nameRaw, 'r', newline='') as f:
+			rows = list(csv.reader(f, delimiter=',', quotechar='|'))
+		raw.append((nameRaw, rows[1:]))
+	return raw
+
+def param_grid(params, grid):
+	# All the combinations of the values of the grid, each as a complete set of exclusion parameters
+	unknown = [key for key in grid if key not in EXCLUSION_DEFAULTS]
+	if unknown:
+		raise ValueError('Only exclusion parameters can be in the grid: ' + ', '.join(sorted(unknown)))
+	keys = sorted(grid)
+	sets = []
+	for values in itertools.product(*[grid[key] for key in keys]):
+		combination = dict(params)
+		combination.update(zip(keys, values))
+		sets.append(combination)
+	return keys, sets
+
+def main():
+	parser = argparse.ArgumentParser(description='Applies the exclusion criteria to saved raw measurements.')
+	parser.add_argument('param_file', help='parameter file (.json or .yaml) with the exclusion criteria')
+	parser.add_argument('results', help='Results directory with the *_raw_MaxFind_*.csv files')
+	parser.add_argument('--grid', help='.json file with lists of values of exclusion parameters')
+	parser.add_argument('--output', help='table of the grid (default: reclassified.csv in the Results directory)')
+	args = parser.parse_args()
+
+	params = load_exclusion_params(args.param_file)
+	raw = read_raw(args.results)
+	if not args.grid:
+		for nameRaw, rows in raw:
+			Write_Results(os.path.join(os.path.dirname(nameRaw), os.path.basename(nameRaw).replace('_raw_MaxFind_', '_results_MaxFind_', 1)), rows, params)
+		print(str(len(raw)) + ' results files written.')
+		return 0
+
+	with open(args.grid, 'r') as f:
+		keys, sets = param_grid(params, json.load(f))
+	output = args.output or os.path.join(args.results, 'reclassified.csv')
+	# all the cells of all the images in one table, every parameter set is applied to the whole table at once
+	images = [os.path.basename(nameRaw).split('_raw_MaxFind_')[0] for nameRaw, rows in raw for row in rows]
+	rawRows = [row for nameRaw, rows in raw for row in rows]
+	table = raw_table(rawRows)
+	with open(output, 'w', newline='') as csvfile:
+		spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+		spamwriter.writerow(['Image'] + keys + TYPED_HEADER)
+		for combination in sets:
+			values = [combination[key] for key in keys]
+			for image, row in zip(images, typed_rows(rawRows, classify_table(table, combination))):
+				spamwriter.writerow([image] + values + row)
+	print(str(len(sets)) + ' parameter sets applied to ' + str(len(raw)) + ' images, written to ' + output)
+	return 0
+
+if __name__ == '__main__':
+	raise SystemExit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+#########################################################################################################################################################
+############################################## COLUMNAR RESULTS STORE (ONE PARQUET DATASET PER RUN) ####################################################
+#########################################################################################################################################################
+
+# The results of all the images of a run in one Parquet file instead of one CSV file per image. Every row is one cell with the name
+# of the image, the parameters (noise tolerance and threshold), the raw measurements and the results after the exclusion criteria.
+# The rows are written in batches (one row group per image), so the whole run does not have to be kept in the memory.
+#
+#     python3 FociMF_Store.py import /path/to/images/Results [dataset.parquet] [--list files.txt]   the CSV files of the Fiji script -> dataset
+#     python3 FociMF_Store.py export dataset.parquet /path/to/csv                 dataset -> the CSV files of the Fiji script
+#
+# The default dataset of a Results directory is Results/<folder>_results.parquet. FociMF_Engine.py writes the dataset directly
+# with "results_store": "parquet" in the parameter file, the Fiji script converts its CSV files at the end of the batch mode.
+# Needs the package pyarrow, the CSV files stay the format of the Fiji script and can be written again from the dataset with export.
+
+#########################################################################################################################################################
+#########################################IMPORT OF ALL THE USED LIBRARIES AND SELECTION OF PARAMETERS ###################################################
+#########################################################################################################################################################
+
+import argparse, csv, glob, math, os, re
+
+from FociMF_Reclassify import FLAGS, HEADER, RAW_HEADER, Raw_Name, legacy_rows, typed_results
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+# Columns of the dataset: (name, type). The results after the exclusion criteria are typed (see classify_table of FociMF_Reclassify.py):
+# 'Foci size' and 'N_Foci' are numbers (NaN for excluded cells and cells without foci), 'Status' tells what the criteria decided and
+# the flags which rules apply (null if the results were imported from CSV files, whose parameters are not known).
+COLUMNS = [
+	('Image', 'string'),
+	('Noise tolerance', 'float64'),
+	('Threshold', 'float64'),
+	('Cell No', 'string'),
+	('DAPI min', 'float64'),
+	('DAPI max', 'float64'),
+	('DAPI mean', 'float64'),
+	('DAPI homogeneity', 'float64'),
+	('GFP min', 'float64'),
+	('GFP max', 'float64'),
+	('GFP mean', 'float64'),
+	('GFP homogeneity', 'float64'),
+	('% Area above threshold GFP', 'float64'),
+	('Cell Area', 'float64'),
+	('Raw foci size', 'float64'),
+	('Raw N_Foci', 'int64'),
+	('Foci size', 'float64'),
+	('N_Foci', 'float64'),
+	('Status', 'string'),
+] + [(flag, 'bool_') for flag in FLAGS] + [
+	('ROI', 'string'),			# ROI: cells of a saved ROI manager, ORIG: cells picked in the run (as in the names of the CSV files)
+	('noiseTol', 'string'),			# noise tolerance and threshold as written in the names of the CSV files (100 or 100.0)
+	('UserThreshold', 'string'),
+]
+
+# <image>_results_MaxFind_<ROI or ORIG>_noiseTol_<noise tolerance>_UserThreshold_<threshold>.csv
+CSV_NAME = re.compile(r'^(?P<image>.*)_results_MaxFind_(?P<roi>ROI|ORIG)_noiseTol_(?P<noise>[^_]*)_UserThreshold_(?P<threshold>.*)\.csv$')
+
+def schema():
+	return pa.schema([(name, getattr(pa, kind)()) for name, kind in COLUMNS])
+
+def number(value):
+	# float of a CSV value, "NA" is NaN
+	return float('nan') if value == 'NA' else float(value)
+
+class ResultsStore(object):
+	# Writes the rows of the images of one run to one Parquet file, one row group per image
+	def __init__(self, path):
+		if pa is None:
+			raise ImportError('The results store needs the package pyarrow (pip install pyarrow)')
+		self.path = path
+		self.writer = pq.ParquetWriter(path, schema(), compression='zstd')
+
+	def append(self, image, noise_tolerance, rawRows, classified, roi='ROI', threshold=None):
+		# rawRows: rows with the RAW_HEADER columns, classified: the typed results of the same cells (classify_table or typed_results).
+		# noise_tolerance and threshold (by default the threshold of the rows) are kept also as the text of the name of the CSV file.
+		columns = dict((name, []) for name, kind in COLUMNS)
+		for k, raw in enumerate(rawRows):
+			columns['Image'].append(image)
+			columns['Noise tolerance'].append(float(noise_tolerance))
+			columns['Threshold'].append(float(raw[13]))
+			columns['Cell No'].append(str(raw[0]))
+			for i in range(1, 10):
+				columns[RAW_HEADER[i]].append(float(raw[i]))
+			columns['Cell Area'].append(float(raw[11]))
+			columns['Raw foci size'].append(number(str(raw[10])))
+			columns['Raw N_Foci'].append(int(raw[12]))
+			columns['Foci size'].append(float(classified['Foci size'][k]))
+			columns['N_Foci'].append(float(classified['N_Foci'][k]))
+			columns['Status'].append(str(classified['Status'][k]))
+			for flag in FLAGS:
+				columns[flag].append(None if classified[flag][k] is None else bool(classified[flag][k]))
+			columns['ROI'].append(roi)
+			columns['noiseTol'].append(str(noise_tolerance))
+			columns['UserThreshold'].append(str(raw[13]) if threshold is None else str(threshold))
+		self.writer.write_table(pa.table(columns, schema=schema()))
+
+	def close(self):
+		self.writer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+def read_csv(nameCSV):
+	with open(nameCSV, 'r', newline='') as f:
+		return list(csv.reader(f, delimiter=',', quotechar='|'))[1:]
+
+def import_csvs(nameCSVs, path):
+	# Collects the results files and their raw measurements into the dataset. Returns the number of images.
+	images = 0
+	with ResultsStore(path) as store:
+		for nameCSV in nameCSVs:
+			match = CSV_NAME.match(os.path.basename(nameCSV))
+			if match is None or not os.path.isfile(Raw_Name(nameCSV)):
+				# merged files and results without raw measurements (older versions of the script)
+				continue
+			rawRows = read_csv(Raw_Name(nameCSV))
+			store.append(match.group('image'), match.group('noise'), rawRows, typed_results(rawRows, read_csv(nameCSV)), match.group('roi'),
+				match.group('threshold'))
+			images += 1
+	return images
+
+def csv_value(value, kind):
+	# Text of a value of the dataset as in the CSV files of the Fiji script
+	if kind == 'float64' and math.isnan(value):
+		return 'NA'
+	return str(value)
+
+def export_csvs(path, outdir):
+	# Writes the results files of all the images of the dataset (the CSV view of the dataset, with "OE" and "NA" like the Fiji script).
+	# Returns the names of the files.
+	if pa is None:
+		raise ImportError('The results store needs the package pyarrow (pip install pyarrow)')
+	table = pq.read_table(path).to_pydict()
+	files = {}
+	for k in range(len(table['Image'])):
+		name = (table['Image'][k] + '_results_MaxFind_' + table['ROI'][k] + '_noiseTol_' + table['noiseTol'][k] +
+			'_UserThreshold_' + table['UserThreshold'][k] + '.csv')
+		raw = [table['Cell No'][k]] + [csv_value(table[column][k], 'float64') for column in HEADER[1:10]] + [csv_value(table['Raw foci size'][k], 'float64'), csv_value(table['Cell Area'][k], 'float64'), str(table['Raw N_Foci'][k])]
+		files.setdefault(name, []).append((raw, table['Status'][k], table['N_Foci'][k]))
+	for name in sorted(files):
+		rows = legacy_rows([raw for raw, status, points in files[name]], {'Status': [status for raw, status, points in files[name]],
+			'N_Foci': [points for raw, status, points in files[name]]})
+		with open(os.path.join(outdir, name), 'w', newline='') as csvfile:
+			spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+			spamwriter.writerow(HEADER)
+			spamwriter.writerows(rows)
+	return sorted(files)
+
+def default_path(resultpath2):
+	# Results/<folder>_results.parquet
+	folder = os.path.basename(os.path.dirname(os.path.abspath(resultpath2)))
+	return os.path.join(resultpath2, folder + '_results.parquet')
+
+def main():
+	parser = argparse.ArgumentParser(description='Columnar results store of the foci analysis.')
+	commands = parser.add_subparsers(dest='command', required=True)
+	command = commands.add_parser('import', help='CSV files of a Results directory -> dataset')
+	command.add_argument('results', help='Results directory with the *_results_MaxFind_*.csv and *_raw_MaxFind_*.csv files')
+	command.add_argument('dataset', nargs='?', help='Parquet file (default: Results/<folder>_results.parquet)')
+	command.add_argument('--list', help='text file with the results files to import, one per line (default: all in the Results directory)')
+	command = commands.add_parser('export', help='dataset -> CSV files')
+	command.add_argument('dataset', help='Parquet file')
+	command.add_argument('outdir', help='directory for the CSV files')
+	args = parser.parse_args()
+
+	if args.command == 'import':
+		path = args.dataset or default_path(args.results)
+		if args.list:
+			with open(args.list, 'r') as f:
+				nameCSVs = [line.strip() for line in f if line.strip()]
+		else:
+			nameCSVs = sorted(glob.glob(os.path.join(args.results, '*_results_MaxFind_*.csv')))
+		images = import_csvs(nameCSVs, path)
+		print(str(images) + ' images written to ' + path)
+	else:
+		if not os.path.isdir(args.outdir):
+			os.makedirs(args.outdir)
+		names = export_csvs(args.dataset, args.outdir)
+		print(str(len(names)) + ' results files written to ' + args.outdir)
+	return 0
+
+if __name__ == '__main__':
+	raise SystemExit(main())